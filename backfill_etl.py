@@ -0,0 +1,231 @@
+"""ETL for extracting users balances over a range of snapshot dates"""
+
+import argparse
+import concurrent.futures
+import functools
+import os
+from datetime import datetime, timedelta
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+from src.balances_collector.balances_replay import AaveV3BalancesReplay
+from src.emodes_collector.emode_map import UserEModeMap
+from src.etl.connections import BUCKET, connect_s3, connect_web3
+from src.etl.snapshot import (
+    BALANCES_REPLAY_PREFIX,
+    EMODE_MAP_PREFIX,
+    OUTPUT_FORMATS,
+    SnapshotResources,
+    checkpoint_store,
+    find_snapshot_blocks,
+    run_snapshot,
+    snapshot_exists,
+)
+from src.etl.streaming import STREAM_CHUNK_SIZE, run_snapshot_streaming
+from src.utils.block_finder_functions import (
+    DEFAULT_BLOCK_INDEX_PATH,
+    BlockTimestampIndex,
+)
+from src.utils.rpc_cache import DEFAULT_RPC_CACHE_PATH
+from src.utils.logs import configure_logging, logger
+from src.utils.metrics import RunMetrics, write_run_reports
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("start_date", help="First snapshot date, YYYY-MM-DD")
+    parser.add_argument("end_date", help="Last snapshot date (included), YYYY-MM-DD")
+    parser.add_argument(
+        "--max-concurrent-dates",
+        type=int,
+        default=2,
+        help="Number of snapshot dates collected at the same time",
+    )
+    parser.add_argument(
+        "--max-rpc-in-flight",
+        type=int,
+        default=16,
+        help="Maximum number of RPC requests in flight at the same time, across all "
+        "dates. The limit adapts below it to the provider latency and throttling",
+    )
+    parser.add_argument(
+        "--overwrite",
+        action="store_true",
+        help="Collect again the dates whose outputs already exist",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Carry the users of the previous snapshot forward, see main_etl.py",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Collect, process and upload the users of each date by chunks, with "
+        "memory bounded by the chunk size instead of the users count",
+    )
+    parser.add_argument(
+        "--stream-chunk-size",
+        type=int,
+        default=STREAM_CHUNK_SIZE,
+        help="Users per chunk of the streaming mode",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=OUTPUT_FORMATS,
+        default="csv",
+        help="Format of the output files",
+    )
+    parser.add_argument(
+        "--checkpoint-location",
+        help='"s3" or a local directory where collection chunks are committed, '
+        "a rerun resumes the failed dates from them",
+    )
+    parser.add_argument(
+        "--emode-map-location",
+        help='"s3" or a local directory keeping the users emodes map, read from the '
+        "UserEModeSet logs instead of one getUserEMode call per user",
+    )
+    parser.add_argument(
+        "--balances-replay-location",
+        help='"s3" or a local directory keeping the balances replayed from the '
+        "tokens logs instead of one getUserReservesData call per user, "
+        "cross-checked on a sample of users. Dates then run in order",
+    )
+    parser.add_argument(
+        "--account-metrics-check",
+        type=int,
+        default=0,
+        metavar="N",
+        help="Check the account metrics of N sampled users of every date with "
+        "getUserAccountData calls",
+    )
+    parser.add_argument(
+        "--block-index-path",
+        default=os.environ.get("BLOCK_INDEX_PATH", DEFAULT_BLOCK_INDEX_PATH),
+        help='File of the known block timestamps, "{chain_id}" is replaced by the '
+        "chain id of the provider. Defaults to BLOCK_INDEX_PATH",
+    )
+    parser.add_argument(
+        "--metrics-dir",
+        default="metrics",
+        help="Directory of the JSON run report and Prometheus textfile",
+    )
+    args = parser.parse_args(argv)
+
+    configure_logging()
+    metrics = RunMetrics()
+    try:
+        logger.info("Starting backfill ETL...")
+        client_s3 = connect_s3(
+            os.environ["AWS_ACCESS_KEY"], os.environ["AWS_SECRET_KEY"]
+        )
+        # All the dates share this w3, the adaptive limit caps the load put on the
+        # provider and backs off when it throttles. Several comma-separated
+        # endpoints in PROVIDER_URL are balanced and failed over
+        w3 = connect_web3(
+            os.environ["PROVIDER_URL"],
+            metrics,
+            args.max_rpc_in_flight,
+            os.environ.get("RPC_CACHE_PATH", DEFAULT_RPC_CACHE_PATH),
+        )
+
+        start_day = datetime.strptime(args.start_date, "%Y-%m-%d")
+        end_day = datetime.strptime(args.end_date, "%Y-%m-%d")
+        snapshot_dates = [
+            (start_day + timedelta(days=offset)).strftime("%Y-%m-%d")
+            for offset in range((end_day - start_day).days + 1)
+        ]
+
+        if not args.overwrite:
+            existing_dates = [
+                snapshot_date
+                for snapshot_date in snapshot_dates
+                if snapshot_exists(client_s3, BUCKET, snapshot_date, args.output_format)
+            ]
+            if existing_dates:
+                logger.info(f"Skipping {len(existing_dates)} dates already collected")
+            snapshot_dates = [
+                snapshot_date
+                for snapshot_date in snapshot_dates
+                if snapshot_date not in existing_dates
+            ]
+
+        logger.info(f"Resolving snapshot blocks of {len(snapshot_dates)} dates...")
+        with metrics.stage("snapshot_blocks"):
+            snapshot_blocks = find_snapshot_blocks(
+                w3=w3,
+                snapshot_dates=snapshot_dates,
+                block_index=BlockTimestampIndex(w3.eth.chain_id, args.block_index_path),
+            )
+
+        resources = SnapshotResources(w3=w3, client_s3=client_s3, bucket=BUCKET)
+        resources.max_rpc_in_flight = args.max_rpc_in_flight
+        resources.account_metrics_check = args.account_metrics_check
+        checkpoints = checkpoint_store(args.checkpoint_location, client_s3, BUCKET)
+        if args.emode_map_location is not None:
+            resources.emode_map = UserEModeMap(
+                checkpoint_store(
+                    args.emode_map_location, client_s3, BUCKET, EMODE_MAP_PREFIX
+                )
+            )
+        if args.balances_replay_location is not None:
+            resources.balances_replay = AaveV3BalancesReplay(
+                AaveV3RawBalancesCollectorCustom(w3=w3, pool_abi=resources.pool_abi),
+                checkpoint_store(
+                    args.balances_replay_location,
+                    client_s3,
+                    BUCKET,
+                    BALANCES_REPLAY_PREFIX,
+                ),
+            )
+
+        if args.incremental:
+            # Each date reads the outputs of the previous one, dates run in order
+            args.max_concurrent_dates = 1
+        if args.balances_replay_location is not None:
+            # Each date replays the logs from the checkpoint of the previous one
+            args.max_concurrent_dates = 1
+
+        if args.streaming:
+            run_date = functools.partial(
+                run_snapshot_streaming, chunk_size=args.stream_chunk_size
+            )
+        else:
+            run_date = run_snapshot
+
+        failed_dates = list()
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.max_concurrent_dates
+        ) as executor:
+            futures = {
+                executor.submit(
+                    run_date,
+                    resources=resources,
+                    snapshot_date=snapshot_date,
+                    block_number=snapshot_blocks[snapshot_date],
+                    incremental=args.incremental,
+                    output_format=args.output_format,
+                    checkpoints=checkpoints,
+                    metrics=metrics,
+                ): snapshot_date
+                for snapshot_date in snapshot_dates
+            }
+            for future in concurrent.futures.as_completed(futures):
+                snapshot_date = futures[future]
+                try:
+                    future.result()
+                except Exception as e:
+                    logger.error(f"Snapshot of {snapshot_date} failed: {e}")
+                    failed_dates.append(snapshot_date)
+
+        if failed_dates:
+            raise Exception(f"Snapshots failed for dates: {sorted(failed_dates)}")
+
+        logger.info("Done!")
+    finally:
+        write_run_reports(metrics, args.metrics_dir)
+
+
+if __name__ == "__main__":
+    main()
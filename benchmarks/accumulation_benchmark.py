@@ -0,0 +1,132 @@
+"""Micro-benchmark of the users balances accumulation, before and after the
+switch from per-user pd.concat to columnar buffers.
+
+Run from the repository root: python -m benchmarks.accumulation_benchmark
+"""
+
+import json
+import random
+import time
+
+import pandas as pd
+from pandas import DataFrame
+from web3 import Web3
+
+from src.balances_collector.balances_collector import (
+    USER_RESERVE_COLUMNS,
+    AaveV3RawBalancesCollector,
+)
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+
+USERS_COUNTS = [1_000, 5_000, 20_000]
+RESERVES_COUNT = 40
+ROW_FORMAT = "{:>8} | {:<24} | {:>10} | {:>10}"
+
+
+def synthetic_responses(users_count: int) -> tuple:
+    random.seed(0)
+    reserves = [f"0x{index:040x}" for index in range(RESERVES_COUNT)]
+    users = [f"0x{index + 10**6:040x}" for index in range(users_count)]
+    results = list()
+    for _ in users:
+        active_reserves = set(random.sample(range(RESERVES_COUNT), 3))
+        response = [
+            (
+                reserve,
+                random.getrandbits(80) if index in active_reserves else 0,
+                True,
+                random.getrandbits(60) if index == min(active_reserves) else 0,
+            )
+            for index, reserve in enumerate(reserves)
+        ]
+        results.append((True, (response, 0)))
+    return users, results
+
+
+def legacy_raw_balances(users: list, results: list) -> DataFrame:
+    all_users_balances = DataFrame()
+    for user_address, (_, result) in zip(users, results):
+        user_data_table = DataFrame(result[0], columns=USER_RESERVE_COLUMNS)
+        user_data_table["user_address"] = user_address
+        user_data_table = user_data_table[
+            (user_data_table.scaledATokenBalance > 0)
+            | (user_data_table.scaledVariableDebt > 0)
+        ]
+        all_users_balances = pd.concat((all_users_balances, user_data_table))
+    return all_users_balances
+
+
+def legacy_users_positions(all_users_positions: dict) -> DataFrame:
+    users_positions = DataFrame()
+    for user, balance in all_users_positions.items():
+        user_data = DataFrame(
+            {
+                "user_address": user,
+                "underlyingAsset": balance["underlyingAsset"],
+                "scaledATokenBalance": balance["scaledATokenBalance"],
+                "scaledVariableDebt": balance["scaledVariableDebt"],
+            }
+        )
+        users_positions = pd.concat((users_positions, user_data))
+    return users_positions
+
+
+def timed(func, *args) -> tuple:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def main():
+    w3 = Web3()
+    with open("./src/abi/ui_pool_data_provider.json") as file:
+        data_provider_abi = json.load(file)
+    with open("./src/abi/pool_abi.json") as file:
+        pool_abi = json.load(file)
+    collector = AaveV3RawBalancesCollector(w3=w3, contract_abi=data_provider_abi)
+    custom_collector = AaveV3RawBalancesCollectorCustom(
+        w3=w3,
+        pool_abi=pool_abi,
+        atoken_abi=[],
+        addresses_provider_abi=[],
+        price_oracle_abi=[],
+    )
+
+    print(ROW_FORMAT.format("users", "path", "before (s)", "after (s)"))
+    for users_count in USERS_COUNTS:
+        users, results = synthetic_responses(users_count)
+        before, expected = timed(legacy_raw_balances, users, results)
+        after, balances = timed(collector._raw_balances_from_results, users, results)
+        pd.testing.assert_frame_equal(expected, balances.to_frame(), check_dtype=False)
+        print(
+            ROW_FORMAT.format(
+                users_count, "collect_raw_balances", f"{before:.3f}", f"{after:.3f}"
+            )
+        )
+
+        all_users_positions = {
+            user: custom_collector._build_user_position(
+                [reserve[0] for reserve in result[0]],
+                [reserve[1] for reserve in result[0]],
+                [reserve[3] for reserve in result[0]],
+            )
+            for user, (_, result) in zip(users, results)
+        }
+        before, expected = timed(legacy_users_positions, all_users_positions)
+        after, positions = timed(
+            custom_collector._set_users_positions, all_users_positions, 0
+        )
+        pd.testing.assert_frame_equal(
+            expected, positions.drop(columns="snapshot_block"), check_dtype=False
+        )
+        print(
+            ROW_FORMAT.format(
+                users_count, "get_all_users_position", f"{before:.3f}", f"{after:.3f}"
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
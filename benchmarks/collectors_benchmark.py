@@ -0,0 +1,338 @@
+"""End-to-end benchmark of the collectors against the local mock JSON-RPC server,
+with throughput and the RPC calls reaching the node for every scenario.
+
+Run from the repository root: python -m benchmarks.collectors_benchmark --users 2000
+"""
+
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import tempfile
+import time
+import tracemalloc
+
+import pandas as pd
+from web3 import Web3
+
+from benchmarks.mock_rpc import MockRpcServer, SyntheticAaveMarket
+from benchmarks.mock_s3 import MockS3Client
+from src.balances_collector.balances_collector import (
+    POOL_ADDRESSES_PROVIDER,
+    AaveV3RawBalancesCollector,
+)
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+from src.balances_collector.balances_replay import AaveV3BalancesReplay
+from src.emodes_collector.emode_map import UserEModeMap
+from src.emodes_collector.emodes_collector import AaveV3EModesCollector
+from src.etl.run import run_snapshot_etl
+from src.etl.snapshot import SnapshotResources, run_snapshot, snapshot_input_path
+from src.etl.streaming import run_snapshot_streaming
+from src.utils.async_engine import get_async_w3
+from src.utils.block_finder_functions import find_closest_block
+from src.utils.checkpoints import S3CheckpointStore
+from src.utils.rpc_batch import JsonRpcBatchTransport
+from src.utils.rpc_limits import install_adaptive_rpc_concurrency
+
+BUCKET = "benchmark-bucket"
+SNAPSHOT_DATE = "2024-12-01"
+ROW_FORMAT = "{:<34} | {:>7} | {:>8} | {:>9} | {:>8} | {:>9} | {}"
+
+
+def load_abi(name: str) -> list:
+    with open(f"./src/abi/{name}.json") as file:
+        return json.load(file)
+
+
+def upload_users(client_s3, users: list):
+    # Pool users and atoken transfers users overlap by half, as in production
+    lists = {
+        "all_active_users.csv": users[: len(users) * 3 // 4],
+        "all_atoken_transfer_users.csv": users[len(users) // 4 :],
+    }
+    for filename, addresses in lists.items():
+        body = io.StringIO()
+        pd.DataFrame({"active_user_address": addresses}).to_csv(body, index=False)
+        client_s3.put_object(
+            Bucket=BUCKET,
+            Key=snapshot_input_path(SNAPSHOT_DATE, filename),
+            Body=body.getvalue().encode(),
+        )
+
+
+def check_batch_requests(w3, market: SyntheticAaveMarket, server: MockRpcServer):
+    """One JSON-RPC batch payload must reach the node as one HTTP request."""
+    contract = AaveV3RawBalancesCollector(
+        w3=w3, contract_abi=load_abi("ui_pool_data_provider")
+    ).data_provider_contract
+    contract_functions = [
+        contract.functions.getUserReservesData(POOL_ADDRESSES_PROVIDER, user_address)
+        for user_address in market.users[:1000]
+    ]
+    server.reset_counters()
+    results = JsonRpcBatchTransport(w3, batch_size=len(contract_functions)).call(
+        contract_functions, market.latest_block - 100
+    )
+    if not all(success for success, _ in results):
+        raise Exception("Batched getUserReservesData calls failed")
+    if server.http_requests != 1:
+        raise Exception(
+            f"One batch of {len(contract_functions)} calls cost "
+            f"{server.http_requests} HTTP requests: {dict(server.rpc_calls)}"
+        )
+    print(f"One batch of {len(contract_functions)} eth_call: 1 HTTP request")
+
+
+def scenarios(w3, market: SyntheticAaveMarket, client_s3, max_in_flight: int) -> list:
+    block = market.latest_block - 100
+    users = market.users
+    users_frame = pd.DataFrame({"active_user_address": users})
+
+    # Per-user calls fanned out to as many threads as the adaptive limit allows
+    collector = AaveV3RawBalancesCollector(
+        w3=w3,
+        contract_abi=load_abi("ui_pool_data_provider"),
+        block_number=block,
+        max_workers=max_in_flight,
+    )
+    sequential_collector = AaveV3RawBalancesCollector(
+        w3=w3,
+        contract_abi=load_abi("ui_pool_data_provider"),
+        block_number=block,
+        max_workers=1,
+    )
+    custom_collector = AaveV3RawBalancesCollectorCustom(
+        w3=w3,
+        pool_abi=load_abi("pool_abi"),
+        atoken_abi=load_abi("atoken_abi"),
+        addresses_provider_abi=load_abi("addresses_provider_abi"),
+        price_oracle_abi=load_abi("price_oracle_abi"),
+        max_workers=max_in_flight,
+    )
+    emodes_collector = AaveV3EModesCollector(
+        w3=w3,
+        pool_abi=load_abi("pool_abi"),
+        block_number=block,
+        max_workers=max_in_flight,
+    )
+    randomizer = random.Random(0)
+    target_blocks = [
+        randomizer.randrange(market.latest_block // 2, market.latest_block)
+        for _ in range(5)
+    ]
+
+    def closest_blocks():
+        for target_block in target_blocks:
+            target_timestamp = market.block_timestamp(target_block) + 5
+            found = find_closest_block(w3, target_timestamp, market.latest_block)
+            assert found == target_block, (found, target_block)
+
+    def async_raw_balances():
+        async def collect():
+            async_collector = AaveV3RawBalancesCollector(
+                w3=await get_async_w3(w3.provider.endpoint_uri),
+                contract_abi=load_abi("ui_pool_data_provider"),
+                block_number=block,
+            )
+            await async_collector.collect_raw_balances_async(
+                users_frame, max_concurrency=max_in_flight
+            )
+            await async_collector.w3.provider.disconnect()
+
+        asyncio.run(collect())
+
+    def custom_positions(**options):
+        custom_collector.get_reserves_data(block)
+        custom_collector.get_all_users_position(users, block, **options)
+        custom_collector.process_users_balances()
+
+    def emodes_from_logs():
+        # A new map scans all the logs, the runs of the next days only their range
+        emode_map = UserEModeMap(S3CheckpointStore(client_s3, BUCKET, "emodes/"))
+        emodes_collector.collect_emodes_from_logs(users_frame, emode_map)
+
+    def replayed_positions():
+        replay = AaveV3BalancesReplay(
+            custom_collector, S3CheckpointStore(client_s3, BUCKET, "replay/")
+        )
+        replay.collect_users_positions(block)
+        replay.cross_check(
+            users, sample_size=100, batch_transport=JsonRpcBatchTransport(w3)
+        )
+
+    def snapshot_resources() -> SnapshotResources:
+        resources = SnapshotResources(w3, client_s3, BUCKET)
+        resources.max_rpc_in_flight = max_in_flight
+        return resources
+
+    def snapshot():
+        resources = snapshot_resources()
+        run_snapshot(resources, SNAPSHOT_DATE, block)
+
+    def streaming_snapshot():
+        resources = snapshot_resources()
+        run_snapshot_streaming(
+            resources, SNAPSHOT_DATE, block, chunk_size=max(len(users) // 10, 1)
+        )
+
+    def snapshot_etl():
+        # The production connection, with its RPC cache and block index in a
+        # temporary directory instead of ~/.cache
+        with tempfile.TemporaryDirectory() as directory:
+            run_snapshot_etl(
+                snapshot_date=SNAPSHOT_DATE,
+                provider_url=w3.provider.endpoint_uri,
+                aws_access_key=None,
+                aws_secret_key=None,
+                bucket=BUCKET,
+                metrics_directory=None,
+                max_rpc_in_flight=max_in_flight,
+                rpc_cache_path=os.path.join(directory, "rpc.sqlite"),
+                block_index_path=os.path.join(directory, "blocks-{chain_id}.csv"),
+                client_s3=client_s3,
+            )
+
+    # (name, users, callable)
+    return [
+        ("find_closest_block x5", 0, closest_blocks),
+        (
+            "raw balances, sequential",
+            len(users),
+            lambda: sequential_collector.collect_raw_balances(users_frame),
+        ),
+        (
+            "raw balances, fanned out",
+            len(users),
+            lambda: collector.collect_raw_balances(users_frame),
+        ),
+        ("raw balances, async", len(users), async_raw_balances),
+        (
+            "raw balances, multicall",
+            len(users),
+            lambda: collector.collect_raw_balances(users_frame, batched=True),
+        ),
+        (
+            "reserves data + processing",
+            len(users),
+            lambda: (
+                collector.collect_reserves_data(),
+                collector.process_raw_balances(),
+            ),
+        ),
+        ("custom, threaded", len(users), custom_positions),
+        (
+            "custom, JSON-RPC batches",
+            len(users),
+            lambda: custom_positions(batch_transport=JsonRpcBatchTransport(w3)),
+        ),
+        (
+            "custom, batches + prefilter",
+            len(users),
+            lambda: custom_positions(
+                batch_transport=JsonRpcBatchTransport(w3),
+                prefilter_with_user_configuration=True,
+            ),
+        ),
+        (
+            "e-modes + configuration",
+            len(users),
+            lambda: (
+                emodes_collector.collect_emodes(users_frame),
+                emodes_collector.collect_emodes_configuration(),
+            ),
+        ),
+        ("e-modes from logs, first scan", len(users), emodes_from_logs),
+        ("event replay + cross-check", len(users), replayed_positions),
+        ("run_snapshot, end to end", len(users), snapshot),
+        ("run_snapshot_streaming, 10 chunks", len(users), streaming_snapshot),
+        ("run_snapshot_etl, with RPC cache", len(users), snapshot_etl),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=2_000)
+    parser.add_argument("--reserves", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, help="HTTP requests per second")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    parser.add_argument(
+        "--only", help="Only run the scenarios whose name contains this text"
+    )
+    parser.add_argument(
+        "--trace-memory",
+        action="store_true",
+        help="Report the peak Python memory of every scenario, slower",
+    )
+    args = parser.parse_args()
+
+    market = SyntheticAaveMarket(users_count=args.users, reserves_count=args.reserves)
+    client_s3 = MockS3Client()
+    upload_users(client_s3, market.users)
+    server = MockRpcServer(
+        market,
+        latency=args.latency_ms / 1000,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+    )
+    with server:
+        w3 = Web3(Web3.HTTPProvider(server.url, exception_retry_configuration=None))
+        # Throttled and failed requests are retried as in the production scripts
+        install_adaptive_rpc_concurrency(w3, args.max_in_flight)
+        check_batch_requests(w3, market, server)
+
+        print(
+            ROW_FORMAT.format(
+                "scenario",
+                "users",
+                "time (s)",
+                "users/s",
+                "HTTP",
+                "RPC calls",
+                "top calls",
+            )
+        )
+        for name, users_count, scenario in scenarios(
+            w3, market, client_s3, args.max_in_flight
+        ):
+            if args.only and args.only not in name:
+                continue
+            server.reset_counters()
+            if args.trace_memory:
+                tracemalloc.start()
+            start = time.perf_counter()
+            scenario()
+            elapsed = time.perf_counter() - start
+            if args.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+            top_calls = ", ".join(
+                f"{function} {calls}"
+                for function, calls in server.eth_calls.most_common(3)
+            )
+            print(
+                ROW_FORMAT.format(
+                    name,
+                    users_count,
+                    f"{elapsed:.2f}",
+                    f"{users_count / elapsed:.0f}" if users_count else "-",
+                    server.http_requests,
+                    sum(server.rpc_calls.values()),
+                    top_calls,
+                )
+            )
+            if args.trace_memory:
+                print(f"    peak traced memory: {peak_memory / 1024**2:.1f} MiB")
+        print(
+            f"S3 stand-in: {client_s3.requests} requests, "
+            f"{client_s3.bytes_written} bytes written"
+        )
+
+
+if __name__ == "__main__":
+    main()
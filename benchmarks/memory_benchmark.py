@@ -0,0 +1,180 @@
+"""Memory benchmark of the raw balances, before and after the switch from object
+DataFrames to compact interned addresses and limb arrays.
+
+Run from the repository root: python -m benchmarks.memory_benchmark --rows 1000000
+"""
+
+import argparse
+import gc
+import random
+import tracemalloc
+
+import pandas as pd
+from pandas import DataFrame
+from web3 import Web3
+
+from benchmarks.ray_math_benchmark import RAW_BALANCES_MERGE_COLUMNS
+from src.balances_collector.balances_collector import (
+    USER_RESERVE_COLUMNS,
+    AaveV3RawBalancesCollector,
+)
+from src.utils.columnar import ColumnarBuffer
+from src.utils.ray_math import current_balances, to_float, to_limbs
+
+RESERVES_COUNT = 40
+POSITIONS_PER_USER = 3
+ROW_FORMAT = "{:<28} | {:>10} | {:>10} | {:>10}"
+
+
+def synthetic_responses(rows_count: int) -> tuple:
+    """Users responses with their non-zero positions only, 3 per user."""
+    random.seed(0)
+    reserves = [f"0x{index:040x}" for index in range(RESERVES_COUNT)]
+    users = [
+        f"0x{index + 10**6:040x}" for index in range(rows_count // POSITIONS_PER_USER)
+    ]
+    results = list()
+    for _ in users:
+        response = [
+            (
+                # Decoded responses hold a new str per position
+                "".join(reserves[index]),
+                random.getrandbits(random.choice([40, 70, 90])),
+                True,
+                random.getrandbits(random.choice([0, 50, 70])),
+            )
+            for index in random.sample(range(RESERVES_COUNT), POSITIONS_PER_USER)
+        ]
+        results.append((True, (response, 0)))
+    reserves_data = DataFrame(
+        {
+            "underlyingAsset": reserves,
+            "name": [f"Token {index}" for index in range(RESERVES_COUNT)],
+            "symbol": [f"TKN{index}" for index in range(RESERVES_COUNT)],
+            "decimals": [random.choice([6, 8, 18]) for _ in reserves],
+            "baseLTVasCollateral": 8000,
+            "reserveLiquidationThreshold": 8250,
+            "reserveLiquidationBonus": 10500,
+            "usageAsCollateralEnabled": True,
+            "liquidityIndex": pd.Series(
+                [10**27 + random.getrandbits(86) for _ in reserves], dtype=object
+            ),
+            "variableBorrowIndex": pd.Series(
+                [10**27 + random.getrandbits(87) for _ in reserves], dtype=object
+            ),
+            "underlyingTokenPriceUSD": [random.random() * 3000 for _ in reserves],
+        }
+    )
+    return users, results, reserves_data
+
+
+def legacy_raw_balances(users: list, results: list) -> DataFrame:
+    all_users_balances = ColumnarBuffer(USER_RESERVE_COLUMNS + ["user_address"])
+    for user_address, (_, result) in zip(users, results):
+        for position, user_reserve in enumerate(result[0]):
+            all_users_balances.append((*user_reserve, user_address), index=position)
+    all_users_balances = all_users_balances.to_frame()
+    all_users_balances["snapshot_block"] = 0
+    return all_users_balances
+
+
+def legacy_process_balances(balances: DataFrame, reserves_data: DataFrame) -> DataFrame:
+    # process_raw_balances merging the reserves data into the object DataFrame
+    merged_reserves_data = reserves_data[RAW_BALANCES_MERGE_COLUMNS].copy()
+    merged_reserves_data.liquidityIndex = (
+        to_float(to_limbs(merged_reserves_data.liquidityIndex)) / 1e27
+    )
+    merged_reserves_data.variableBorrowIndex = (
+        to_float(to_limbs(merged_reserves_data.variableBorrowIndex)) / 1e27
+    )
+    processed_balances = balances.merge(
+        merged_reserves_data, how="left", on="underlyingAsset"
+    )
+    reserve_positions = pd.Index(reserves_data.underlyingAsset).get_indexer(
+        processed_balances.underlyingAsset
+    )
+    processed_balances["currentATokenBalance"] = current_balances(
+        processed_balances.scaledATokenBalance,
+        reserve_positions,
+        reserves_data.liquidityIndex.tolist(),
+        reserves_data.decimals,
+    )
+    processed_balances["currentVariableDebt"] = current_balances(
+        processed_balances.scaledVariableDebt,
+        reserve_positions,
+        reserves_data.variableBorrowIndex.tolist(),
+        reserves_data.decimals,
+    )
+    processed_balances["currentATokenBalanceUSD"] = (
+        processed_balances.currentATokenBalance
+        * processed_balances.underlyingTokenPriceUSD
+    )
+    processed_balances["currentVariableDebtUSD"] = (
+        processed_balances.currentVariableDebt
+        * processed_balances.underlyingTokenPriceUSD
+    )
+    return processed_balances[
+        (processed_balances.currentATokenBalanceUSD > 0.05)
+        | (processed_balances.currentVariableDebtUSD > 0.05)
+    ]
+
+
+def traced_pipeline(rows_count: int, collect, process) -> list:
+    """
+    Memory kept by the raw balances once the responses are freed and peak of
+    their collection, then memory kept with the processed balances and peak of
+    the processing, in bytes.
+    """
+    gc.collect()
+    tracemalloc.start()
+    users, results, reserves_data = synthetic_responses(rows_count)
+    balances = collect(users, results)
+    del users, results
+    gc.collect()
+    raw_kept, raw_peak = tracemalloc.get_traced_memory()
+    tracemalloc.reset_peak()
+    processed = process(balances, reserves_data)
+    gc.collect()
+    processed_kept, processed_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return [
+        (rows_count // POSITIONS_PER_USER * POSITIONS_PER_USER, raw_kept, raw_peak),
+        (len(processed), processed_kept, processed_peak),
+    ]
+
+
+def compact_collect(users: list, results: list):
+    collector = AaveV3RawBalancesCollector(w3=Web3(), contract_abi=[], block_number=0)
+    collector.set_raw_balances(collector._raw_balances_from_results(users, results))
+    return collector
+
+
+def compact_process(collector, reserves_data: DataFrame) -> DataFrame:
+    collector.reserves_data = reserves_data
+    return collector.process_raw_balances()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    args = parser.parse_args()
+
+    print(ROW_FORMAT.format("step", "rows", "kept (MiB)", "peak (MiB)"))
+    for path, collect, process in [
+        ("DataFrame", legacy_raw_balances, legacy_process_balances),
+        ("compact", compact_collect, compact_process),
+    ]:
+        steps = traced_pipeline(args.rows, collect, process)
+        for step, (rows, kept, peak) in zip(["raw balances", "processing"], steps):
+            print(
+                ROW_FORMAT.format(
+                    f"{step}, {path}",
+                    rows,
+                    f"{kept / 1024**2:.1f}",
+                    f"{peak / 1024**2:.1f}",
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,755 @@
+"""Local JSON-RPC stand-in serving a synthetic Aave V3 market from src/abi ABIs
+
+Run from the repository root: python -m benchmarks.mock_rpc --users 10000
+ETL runs pointed at it should set RPC_CACHE_PATH and BLOCK_INDEX_PATH to a
+temporary directory, its blocks are not the ones of a real chain.
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from eth_abi import decode, encode
+from eth_utils import function_abi_to_4byte_selector, keccak, to_checksum_address
+from eth_utils.abi import get_abi_input_types, get_abi_output_types
+
+ABI_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "src", "abi")
+ABI_FILES = [
+    "ui_pool_data_provider",
+    "pool_abi",
+    "atoken_abi",
+    "multicall3_abi",
+    "price_oracle_abi",
+    "addresses_provider_abi",
+]
+
+# Mainnet addresses hard-coded in the collectors
+POOL_ADDRESS = "0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2"
+DATA_PROVIDER_ADDRESS = "0x3F78BBD206e4D3c504Eb854232EdA7e47E9Fd8FC"
+POOL_ADDRESSES_PROVIDER = "0x2f39d218133AFaB8F2B819B1066c7E434Ad94E9e"
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+PRICE_ORACLE_ADDRESS = "0x54586bE62E3c3580375aE3723C145253060Ca0C2"
+
+POOL_DEPLOYMENT_BLOCK = 16_291_127
+USER_EMODE_SET_TOPIC = "0x" + keccak(text="UserEModeSet(address,uint8)").hex()
+MINT_TOPIC = "0x" + keccak(text="Mint(address,address,uint256,uint256,uint256)").hex()
+BURN_TOPIC = "0x" + keccak(text="Burn(address,address,uint256,uint256,uint256)").hex()
+BALANCE_TRANSFER_TOPIC = (
+    "0x" + keccak(text="BalanceTransfer(address,address,uint256,uint256)").hex()
+)
+# Like most providers, eth_getLogs refuses queries returning more logs
+MAX_LOGS_PER_QUERY = 10_000
+
+RAY = 10**27
+WAD = 10**18
+# The local development chain id, the RPC cache and block index of a real
+# chain are never shared with the synthetic market
+CHAIN_ID = 31337
+GENESIS_TIMESTAMP = 1_606_824_023
+SLOT_TIME = 12
+
+
+def load_functions() -> dict:
+    """Functions of the ABIs by 4 bytes selector."""
+    functions = dict()
+    for filename in ABI_FILES:
+        with open(os.path.join(ABI_DIRECTORY, f"{filename}.json")) as file:
+            for entry in json.load(file):
+                if entry.get("type") == "function":
+                    functions.setdefault(function_abi_to_4byte_selector(entry), entry)
+    return functions
+
+
+def _hash_int(*parts) -> int:
+    digest = hashlib.blake2b(
+        "/".join(str(part) for part in parts).encode(), digest_size=16
+    ).digest()
+    return int.from_bytes(digest, "big")
+
+
+def _address(*parts) -> str:
+    digest = hashlib.blake2b(
+        "/".join(str(part) for part in parts).encode(), digest_size=20
+    ).digest()
+    return to_checksum_address(digest.hex())
+
+
+def _struct(components: list, values: dict) -> tuple:
+    # ABI tuple from the `values` of its named components, zero values otherwise
+    fields = list()
+    for component in components:
+        value = values.get(component["name"])
+        if value is None:
+            value = _zero(component)
+        fields.append(value)
+    return tuple(fields)
+
+
+def _zero(component: dict):
+    abi_type = component["type"]
+    if abi_type.endswith("[]"):
+        return []
+    if abi_type == "tuple":
+        return _struct(component["components"], {})
+    if abi_type == "address":
+        return "0x" + "00" * 20
+    if abi_type == "bool":
+        return False
+    if abi_type == "string":
+        return ""
+    if abi_type.startswith("bytes"):
+        return b"" if abi_type == "bytes" else b"\0" * int(abi_type[5:])
+    return 0
+
+
+class ContractRevert(Exception):
+    pass
+
+
+def _address_topic(address: str) -> str:
+    return "0x" + bytes.fromhex(address[2:]).rjust(32, b"\0").hex()
+
+
+def _unscaled_amount(scaled_amount: int, index: int) -> int:
+    # An amount whose half up rayDiv by `index` is `scaled_amount`
+    amount = scaled_amount * index // RAY
+    while (amount * RAY + index // 2) // index < scaled_amount:
+        amount += 1
+    while (amount * RAY + index // 2) // index > scaled_amount:
+        amount -= 1
+    return amount
+
+
+def _token_log(token: str, topics: list, words: list, block: int) -> dict:
+    return {
+        "address": token,
+        "topics": topics,
+        "data": "0x" + encode(["uint256"] * len(words), words).hex(),
+        "blockNumber": block,
+    }
+
+
+class LogsLimitExceeded(Exception):
+    pass
+
+
+class SyntheticAaveMarket:
+    """
+    Deterministic Aave V3 market: `reserves_count` reserves and `users_count`
+    users whose positions, e-modes and configurations derive from `seed`.
+    Unknown users have no position, like on chain.
+    """
+
+    def __init__(
+        self,
+        users_count: int = 10_000,
+        reserves_count: int = 30,
+        latest_block: int = 21_000_000,
+        seed: int = 0,
+    ):
+        self.seed = seed
+        self.latest_block = latest_block
+        self.functions = load_functions()
+        self.users = [_address(seed, "user", index) for index in range(users_count)]
+        self.emodes = [0, 1, 2, 3]
+
+        self.reserves = list()
+        for index in range(reserves_count):
+            decimals = [18, 6, 8][index % 3]
+            self.reserves.append(
+                {
+                    "id": index,
+                    "underlyingAsset": _address(seed, "reserve", index),
+                    "aTokenAddress": _address(seed, "atoken", index),
+                    "variableDebtTokenAddress": _address(seed, "vtoken", index),
+                    "name": f"Synthetic Token {index}",
+                    "symbol": f"SYN{index}",
+                    "decimals": decimals,
+                    "baseLTVasCollateral": 7500,
+                    "reserveLiquidationThreshold": 8000,
+                    "reserveLiquidationBonus": 10500,
+                    "reserveFactor": 1000,
+                    "liquidityIndex": RAY + _hash_int(seed, "li", index) % (RAY // 5),
+                    "variableBorrowIndex": RAY
+                    + _hash_int(seed, "vi", index) % (RAY // 3),
+                    "price": 10**8 * (1 + _hash_int(seed, "price", index) % 3000),
+                }
+            )
+        self.reserves_by_role = dict()
+        for reserve in self.reserves:
+            for role in [
+                "underlyingAsset",
+                "aTokenAddress",
+                "variableDebtTokenAddress",
+            ]:
+                self.reserves_by_role[reserve[role].lower()] = (role, reserve)
+        self._positions = dict()
+        self._logs = None
+        self._lock = threading.Lock()
+
+    # --- Synthetic state ---
+
+    def user_positions(self, user: str) -> list:
+        """(scaled aToken balance, scaled debt, collateral flag) by reserve."""
+        user = user.lower()
+        with self._lock:
+            if user in self._positions:
+                return self._positions[user]
+        known_user = _hash_int(self.seed, "known", user) % 10 < 9
+        positions = list()
+        for reserve in self.reserves:
+            draw = _hash_int(self.seed, user, reserve["id"])
+            unit = 10 ** reserve["decimals"]
+            supply = draw % 4 == 0 and known_user
+            borrow = draw % 9 == 0 and known_user
+            positions.append(
+                (
+                    (draw >> 8) % (10_000 * unit) if supply else 0,
+                    (draw >> 48) % (2_000 * unit) if borrow else 0,
+                    supply and draw % 3 != 0,
+                )
+            )
+        with self._lock:
+            self._positions[user] = positions
+        return positions
+
+    def user_emode(self, user: str) -> int:
+        return self.emodes[_hash_int(self.seed, "emode", user.lower()) % 4]
+
+    def user_configuration(self, user: str) -> int:
+        configuration = 0
+        for reserve, (supply, debt, collateral) in zip(
+            self.reserves, self.user_positions(user)
+        ):
+            if debt > 0:
+                configuration |= 1 << (2 * reserve["id"])
+            if supply > 0 and collateral:
+                configuration |= 1 << (2 * reserve["id"] + 1)
+        return configuration
+
+    def emode_collateral_config(self, emode_id: int) -> tuple:
+        """(LTV, liquidation threshold, liquidation bonus) of an emode."""
+        return (9000 + 10 * emode_id, 9300 + 10 * emode_id, 10100 + emode_id)
+
+    def emode_collateral_bitmap(self, emode_id: int) -> int:
+        # Every third reserve is a collateral of each emode
+        if emode_id == 0:
+            return 0
+        return sum(
+            1 << reserve["id"]
+            for reserve in self.reserves
+            if reserve["id"] % 3 == emode_id % 3
+        )
+
+    def user_account_data(self, user: str) -> list:
+        """getUserAccountData of `user`, computed as the Aave V3.2 GenericLogic."""
+        emode_id = self.user_emode(user)
+        emode_ltv, emode_threshold, _ = self.emode_collateral_config(emode_id)
+        emode_bitmap = self.emode_collateral_bitmap(emode_id)
+        total_collateral, total_debt, ltv_sum, threshold_sum = 0, 0, 0, 0
+        for reserve, (supply, debt, collateral) in zip(
+            self.reserves, self.user_positions(user)
+        ):
+            unit = 10 ** reserve["decimals"]
+            threshold = reserve["reserveLiquidationThreshold"]
+            if collateral and supply and threshold:
+                balance = (supply * reserve["liquidityIndex"] + RAY // 2) // RAY
+                value = reserve["price"] * balance // unit
+                in_emode = emode_id != 0 and emode_bitmap >> reserve["id"] & 1
+                total_collateral += value
+                if reserve["baseLTVasCollateral"]:
+                    ltv_sum += value * (
+                        emode_ltv if in_emode else reserve["baseLTVasCollateral"]
+                    )
+                threshold_sum += value * (emode_threshold if in_emode else threshold)
+            if debt:
+                balance = (debt * reserve["variableBorrowIndex"] + RAY // 2) // RAY
+                total_debt += reserve["price"] * balance // unit
+        ltv = ltv_sum // total_collateral if total_collateral else 0
+        threshold = threshold_sum // total_collateral if total_collateral else 0
+        borrowing_power = (total_collateral * ltv + 5_000) // 10_000
+        health_factor = (
+            ((total_collateral * threshold + 5_000) // 10_000 * WAD + total_debt // 2)
+            // total_debt
+            if total_debt
+            else 2**256 - 1
+        )
+        return [
+            total_collateral,
+            total_debt,
+            max(borrowing_power - total_debt, 0),
+            threshold,
+            ltv,
+            health_factor,
+        ]
+
+    def reserve_configuration(self, reserve: dict) -> int:
+        return (
+            reserve["baseLTVasCollateral"]
+            | reserve["reserveLiquidationThreshold"] << 16
+            | reserve["reserveLiquidationBonus"] << 32
+            | reserve["decimals"] << 48
+            | 1 << 56
+            | 1 << 58
+            | reserve["reserveFactor"] << 64
+        )
+
+    def block_timestamp(self, block: int) -> int:
+        # One missed slot every 97 blocks
+        return GENESIS_TIMESTAMP + SLOT_TIME * (block + block // 97)
+
+    def _event_block(self, *parts) -> int:
+        return POOL_DEPLOYMENT_BLOCK + _hash_int(self.seed, "block", *parts) % (
+            self.latest_block - 1_000 - POOL_DEPLOYMENT_BLOCK
+        )
+
+    def _token_logs(self, user: str) -> list:
+        """Mint, Burn and BalanceTransfer logs ending at the user positions."""
+        logs = list()
+        user_topic = _address_topic(user)
+        for reserve, (supply, debt, _) in zip(self.reserves, self.user_positions(user)):
+            draw = _hash_int(self.seed, "token logs", user, reserve["id"])
+            index = reserve["liquidityIndex"]
+            block = self._event_block(user, reserve["id"])
+            if supply > 0:
+                # Supply of more than the position, then a partial withdrawal
+                # emitted as a Burn or, below the accrued interest, as a Mint
+                extra = 1 + draw % 10**6
+                interest = (draw >> 20) % 10**6
+                amount = _unscaled_amount(supply + extra, index)
+                logs.append(
+                    _token_log(
+                        reserve["aTokenAddress"],
+                        [MINT_TOPIC, user_topic, user_topic],
+                        [amount + interest, interest, index],
+                        block,
+                    )
+                )
+                # A transfer to the pool and back, netting to zero
+                for sender, recipient in [(user, POOL_ADDRESS), (POOL_ADDRESS, user)]:
+                    block += 1
+                    logs.append(
+                        _token_log(
+                            reserve["aTokenAddress"],
+                            [
+                                BALANCE_TRANSFER_TOPIC,
+                                _address_topic(sender),
+                                _address_topic(recipient),
+                            ],
+                            [extra, index],
+                            block,
+                        )
+                    )
+                amount = _unscaled_amount(extra, index)
+                if draw % 2 == 0:
+                    interest = min(interest, amount)
+                    withdrawal = [BURN_TOPIC, [amount - interest, interest, index]]
+                else:
+                    interest = amount + interest
+                    withdrawal = [MINT_TOPIC, [interest - amount, interest, index]]
+                logs.append(
+                    _token_log(
+                        reserve["aTokenAddress"],
+                        [withdrawal[0], user_topic, user_topic],
+                        withdrawal[1],
+                        block + 1,
+                    )
+                )
+            if debt > 0:
+                index = reserve["variableBorrowIndex"]
+                logs.append(
+                    _token_log(
+                        reserve["variableDebtTokenAddress"],
+                        [MINT_TOPIC, user_topic, user_topic],
+                        [_unscaled_amount(debt, index), 0, index],
+                        self._event_block(user, reserve["id"], "borrow"),
+                    )
+                )
+        return logs
+
+    def event_logs(self) -> list:
+        """UserEModeSet and reserves tokens logs of the users, in block order."""
+        with self._lock:
+            if self._logs is not None:
+                return self._logs
+        logs = list()
+        for user in self.users:
+            emode = self.user_emode(user)
+            if emode != 0:
+                logs.append(
+                    {
+                        "address": POOL_ADDRESS,
+                        "topics": [USER_EMODE_SET_TOPIC, _address_topic(user)],
+                        "data": "0x" + encode(["uint8"], [emode]).hex(),
+                        "blockNumber": self._event_block(user, "emode"),
+                    }
+                )
+            logs.extend(self._token_logs(user))
+        logs.sort(key=lambda log: log["blockNumber"])
+        for log_index, log in enumerate(logs):
+            log["logIndex"] = log_index
+        with self._lock:
+            self._logs = logs
+        return logs
+
+    def get_logs(self, filter: dict) -> list:
+        from_block, to_block = int(filter["fromBlock"], 16), int(filter["toBlock"], 16)
+        addresses = filter.get("address") or []
+        if isinstance(addresses, str):
+            addresses = [addresses]
+        addresses = {address.lower() for address in addresses}
+        topics = (filter.get("topics") or [None])[0]
+        if isinstance(topics, str):
+            topics = [topics]
+        logs = [
+            log
+            for log in self.event_logs()
+            if from_block <= log["blockNumber"] <= to_block
+            and log["address"].lower() in addresses
+            and (topics is None or log["topics"][0] in topics)
+        ]
+        if len(logs) > MAX_LOGS_PER_QUERY:
+            raise LogsLimitExceeded(
+                f"query returned more than {MAX_LOGS_PER_QUERY} results"
+            )
+        return [
+            dict(
+                log,
+                blockNumber=hex(log["blockNumber"]),
+                blockHash="0x" + log["blockNumber"].to_bytes(32, "big").hex(),
+                transactionHash="0x" + log["logIndex"].to_bytes(32, "big").hex(),
+                transactionIndex="0x0",
+                logIndex=hex(log["logIndex"]),
+                removed=False,
+            )
+            for log in logs
+        ]
+
+    # --- eth_call ---
+
+    def call(self, to: str, data: bytes) -> bytes:
+        function = self.functions.get(data[:4])
+        if function is None:
+            raise ContractRevert("unknown function selector")
+        args = decode(get_abi_input_types(function), data[4:])
+        result = self._dispatch(to.lower(), function, args)
+        return encode(get_abi_output_types(function), result)
+
+    def _dispatch(self, to: str, function: dict, args: tuple) -> list:
+        name = function["name"]
+        if to == MULTICALL3_ADDRESS.lower() and name == "aggregate3":
+            results = list()
+            for target, allow_failure, call_data in args[0]:
+                try:
+                    results.append((True, self.call(target, call_data)))
+                except ContractRevert:
+                    if not allow_failure:
+                        raise
+                    results.append((False, b""))
+            return [results]
+        if to == DATA_PROVIDER_ADDRESS.lower():
+            return self._data_provider_call(function, name, args)
+        if to == POOL_ADDRESS.lower():
+            return self._pool_call(function, name, args)
+        if to == POOL_ADDRESSES_PROVIDER.lower() and name == "getPriceOracle":
+            return [PRICE_ORACLE_ADDRESS]
+        if to == PRICE_ORACLE_ADDRESS.lower():
+            if name == "BASE_CURRENCY_UNIT":
+                return [10**8]
+            if name == "getAssetsPrices":
+                prices = {
+                    r["underlyingAsset"].lower(): r["price"] for r in self.reserves
+                }
+                return [[prices.get(asset.lower(), 0) for asset in args[0]]]
+        if to in self.reserves_by_role:
+            return self._token_call(to, name, args)
+        raise ContractRevert(f"{name} not served at {to}")
+
+    def _data_provider_call(self, function: dict, name: str, args: tuple) -> list:
+        outputs = function["outputs"]
+        if name == "getUserReservesData":
+            user = args[1]
+            user_reserves = [
+                (reserve["underlyingAsset"], supply, collateral, debt)
+                for reserve, (supply, debt, collateral) in zip(
+                    self.reserves, self.user_positions(user)
+                )
+            ]
+            return [user_reserves, self.user_emode(user)]
+        if name == "getReservesData":
+            reserves = [
+                _struct(
+                    outputs[0]["components"],
+                    dict(
+                        reserve,
+                        usageAsCollateralEnabled=True,
+                        borrowingEnabled=True,
+                        isActive=True,
+                        priceInMarketReferenceCurrency=reserve["price"],
+                        availableLiquidity=10**6 * 10 ** reserve["decimals"],
+                        totalScaledVariableDebt=10**5 * 10 ** reserve["decimals"],
+                    ),
+                )
+                for reserve in self.reserves
+            ]
+            base_currency = _struct(
+                outputs[1]["components"],
+                {
+                    "marketReferenceCurrencyUnit": 10**8,
+                    "marketReferenceCurrencyPriceInUsd": 10**8,
+                    "networkBaseTokenPriceInUsd": 3000 * 10**8,
+                    "networkBaseTokenPriceDecimals": 8,
+                },
+            )
+            return [reserves, base_currency]
+        raise ContractRevert(f"{name} not served by the data provider")
+
+    def _pool_call(self, function: dict, name: str, args: tuple) -> list:
+        outputs = function["outputs"]
+        if name == "getReservesList":
+            return [[reserve["underlyingAsset"] for reserve in self.reserves]]
+        if name == "ADDRESSES_PROVIDER":
+            return [POOL_ADDRESSES_PROVIDER]
+        if name == "getReserveData":
+            _, reserve = self.reserves_by_role[args[0].lower()]
+            return [
+                _struct(
+                    outputs[0]["components"],
+                    dict(
+                        reserve,
+                        configuration=(self.reserve_configuration(reserve),),
+                        stableDebtTokenAddress=reserve["variableDebtTokenAddress"],
+                        interestRateStrategyAddress=reserve["aTokenAddress"],
+                    ),
+                )
+            ]
+        if name == "getUserConfiguration":
+            return [(self.user_configuration(args[0]),)]
+        if name == "getUserEMode":
+            return [self.user_emode(args[0])]
+        if name == "getEModeCategoryCollateralConfig":
+            return [self.emode_collateral_config(args[0])]
+        if name == "getEModeCategoryCollateralBitmap":
+            return [self.emode_collateral_bitmap(args[0])]
+        if name == "getUserAccountData":
+            return self.user_account_data(args[0])
+        if name == "getEModeCategoryLabel":
+            return [f"Synthetic e-mode {args[0]}" if args[0] else ""]
+        raise ContractRevert(f"{name} not served by the pool")
+
+    def _token_call(self, to: str, name: str, args: tuple) -> list:
+        role, reserve = self.reserves_by_role[to]
+        unit = 10 ** reserve["decimals"]
+        if name == "scaledBalanceOf" and role != "underlyingAsset":
+            position = self.user_positions(args[0])[reserve["id"]]
+            return [position[0] if role == "aTokenAddress" else position[1]]
+        if name == "scaledTotalSupply" and role != "underlyingAsset":
+            return [10**5 * unit]
+        if name == "balanceOf":
+            return [10**6 * unit if role == "underlyingAsset" else 1_000 * unit]
+        raise ContractRevert(f"{name} not served by token {to}")
+
+
+class _RpcHTTPServer(ThreadingHTTPServer):
+    # Fanned out collectors open many connections at once
+    request_queue_size = 256
+    daemon_threads = True
+
+
+class MockRpcServer:
+    """
+    Threaded HTTP JSON-RPC server in front of a SyntheticAaveMarket. Every HTTP
+    request waits `latency` seconds, and `slow_latency` more with probability
+    `slow_rate`. Above `rate_limit` HTTP requests per second the server answers
+    429, and each call fails with probability `error_rate`.
+    """
+
+    def __init__(
+        self,
+        market: SyntheticAaveMarket,
+        host: str = "127.0.0.1",
+        port: int = 0,
+        latency: float = 0.0,
+        rate_limit: float = None,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_latency: float = 0.0,
+        seed: int = 0,
+    ):
+        self.market = market
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.http_requests = 0
+        self.throttled_requests = 0
+        self.rpc_calls = Counter()
+        self.eth_calls = Counter()
+        self.errors = 0
+        self._lock = threading.Lock()
+        self._tokens = rate_limit or 0.0
+        self._refilled_at = time.monotonic()
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                status, response = server.handle_http(body)
+                payload = json.dumps(response).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.httpd = _RpcHTTPServer((host, port), Handler)
+        self._thread = None
+
+    @property
+    def url(self) -> str:
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self) -> "MockRpcServer":
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def reset_counters(self):
+        with self._lock:
+            self.http_requests = 0
+            self.throttled_requests = 0
+            self.rpc_calls = Counter()
+            self.eth_calls = Counter()
+            self.errors = 0
+
+    def _take_token(self) -> bool:
+        # Token bucket refilled at `rate_limit` requests per second
+        with self._lock:
+            self.http_requests += 1
+            if self.rate_limit is None:
+                return True
+            now = time.monotonic()
+            self._tokens = min(
+                self.rate_limit,
+                self._tokens + (now - self._refilled_at) * self.rate_limit,
+            )
+            self._refilled_at = now
+            if self._tokens < 1:
+                self.throttled_requests += 1
+                return False
+            self._tokens -= 1
+            return True
+
+    def handle_http(self, body: bytes) -> tuple:
+        latency = self.latency
+        if self.slow_rate:
+            with self._lock:
+                if self.random.random() < self.slow_rate:
+                    latency += self.slow_latency
+        if latency:
+            time.sleep(latency)
+        if not self._take_token():
+            return 429, {"jsonrpc": "2.0", "id": None, "error": {"code": 429}}
+        request = json.loads(body)
+        if isinstance(request, list):
+            return 200, [self.handle_request(entry) for entry in request]
+        return 200, self.handle_request(request)
+
+    def handle_request(self, request: dict) -> dict:
+        method, params = request["method"], request.get("params", [])
+        response = {"jsonrpc": "2.0", "id": request.get("id")}
+        with self._lock:
+            self.rpc_calls[method] += 1
+            injected_error = self.error_rate and self.random.random() < self.error_rate
+            if injected_error:
+                self.errors += 1
+        if injected_error:
+            response["error"] = {"code": -32603, "message": "injected error"}
+            return response
+        try:
+            response["result"] = self._result(method, params)
+        except ContractRevert as e:
+            response["error"] = {"code": 3, "message": f"execution reverted: {e}"}
+        except LogsLimitExceeded as e:
+            response["error"] = {"code": -32005, "message": str(e)}
+        except (KeyError, IndexError, ValueError, NotImplementedError) as e:
+            response["error"] = {"code": -32602, "message": f"invalid params: {e}"}
+        return response
+
+    def _result(self, method: str, params: list):
+        if method == "eth_chainId":
+            return hex(CHAIN_ID)
+        if method == "net_version":
+            return str(CHAIN_ID)
+        if method == "web3_clientVersion":
+            return "MockRpcServer"
+        if method == "eth_blockNumber":
+            return hex(self.market.latest_block)
+        if method == "eth_getBlockByNumber":
+            block = params[0]
+            number = self.market.latest_block if block == "latest" else int(block, 16)
+            return {
+                "number": hex(number),
+                "hash": "0x" + number.to_bytes(32, "big").hex(),
+                "parentHash": "0x" + max(number - 1, 0).to_bytes(32, "big").hex(),
+                "timestamp": hex(self.market.block_timestamp(number)),
+                "transactions": [],
+            }
+        if method == "eth_call":
+            transaction = params[0]
+            data = bytes.fromhex(transaction["data"].removeprefix("0x"))
+            function = self.market.functions.get(data[:4])
+            with self._lock:
+                self.eth_calls[function["name"] if function else "unknown"] += 1
+            return "0x" + self.market.call(transaction["to"], data).hex()
+        if method == "eth_getLogs":
+            return self.market.get_logs(params[0])
+        raise NotImplementedError(method)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--reserves", type=int, default=30)
+    parser.add_argument("--port", type=int, default=8545)
+    parser.add_argument("--latency-ms", type=float, default=0.0)
+    parser.add_argument("--rate-limit", type=float, help="HTTP requests per second")
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = MockRpcServer(
+        SyntheticAaveMarket(users_count=args.users, reserves_count=args.reserves),
+        port=args.port,
+        latency=args.latency_ms / 1000,
+        rate_limit=args.rate_limit,
+        error_rate=args.error_rate,
+    )
+    print(f"Serving a synthetic Aave V3 market at {server.url}")
+    server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""In-memory stand-in of the boto3 S3 client calls used by the ETL"""
+
+import io
+import threading
+
+
+class NoSuchKey(Exception):
+    pass
+
+
+class MockS3Exceptions:
+    NoSuchKey = NoSuchKey
+
+
+class MockS3Client:
+    """Objects of every bucket kept in memory, keyed by (bucket, key)."""
+
+    exceptions = MockS3Exceptions
+
+    def __init__(self):
+        self.objects = dict()
+        self.requests = 0
+        self.bytes_written = 0
+        self._uploads = dict()
+        self._lock = threading.Lock()
+
+    def put_object(self, Bucket: str, Key: str, Body):
+        body = Body.encode() if isinstance(Body, str) else bytes(Body)
+        with self._lock:
+            self.requests += 1
+            self.bytes_written += len(body)
+            self.objects[(Bucket, Key)] = body
+        return {"ETag": f'"{hash(body)}"'}
+
+    def get_object(self, Bucket: str, Key: str):
+        with self._lock:
+            self.requests += 1
+            if (Bucket, Key) not in self.objects:
+                raise NoSuchKey(Key)
+            return {"Body": io.BytesIO(self.objects[(Bucket, Key)])}
+
+    def delete_object(self, Bucket: str, Key: str):
+        with self._lock:
+            self.requests += 1
+            self.objects.pop((Bucket, Key), None)
+        return {}
+
+    def list_objects_v2(self, Bucket: str, Prefix: str = ""):
+        with self._lock:
+            self.requests += 1
+            keys = sorted(
+                key
+                for bucket, key in self.objects
+                if bucket == Bucket and key.startswith(Prefix)
+            )
+        if not keys:
+            return {"KeyCount": 0}
+        return {"KeyCount": len(keys), "Contents": [{"Key": key} for key in keys]}
+
+    def create_multipart_upload(self, Bucket: str, Key: str):
+        with self._lock:
+            self.requests += 1
+            upload_id = str(len(self._uploads) + 1)
+            self._uploads[upload_id] = (Bucket, Key, dict())
+        return {"UploadId": upload_id}
+
+    def upload_part(self, Bucket: str, Key: str, PartNumber: int, UploadId: str, Body):
+        with self._lock:
+            self.requests += 1
+            self.bytes_written += len(Body)
+            self._uploads[UploadId][2][PartNumber] = bytes(Body)
+        return {"ETag": f'"{PartNumber}"'}
+
+    def complete_multipart_upload(
+        self, Bucket: str, Key: str, UploadId: str, MultipartUpload: dict
+    ):
+        with self._lock:
+            self.requests += 1
+            bucket, key, parts = self._uploads.pop(UploadId)
+            self.objects[(bucket, key)] = b"".join(
+                parts[part["PartNumber"]] for part in MultipartUpload["Parts"]
+            )
+        return {}
+
+    def abort_multipart_upload(self, Bucket: str, Key: str, UploadId: str):
+        with self._lock:
+            self.requests += 1
+            self._uploads.pop(UploadId, None)
+        return {}
@@ -0,0 +1,215 @@
+"""Micro-benchmark of the balances processing, before and after the switch from
+float and object-dtype arithmetic to the exact limb rayMul engine.
+
+Run from the repository root: python -m benchmarks.ray_math_benchmark
+"""
+
+import random
+import time
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+from web3 import Web3
+
+from src.balances_collector.balances_collector import AaveV3RawBalancesCollector
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+
+ROWS_COUNTS = [100_000, 1_000_000]
+RESERVES_COUNT = 40
+ROW_FORMAT = "{:>9} | {:<22} | {:>10} | {:>10} | {:>13}"
+
+
+def synthetic_balances(rows_count: int) -> tuple:
+    random.seed(0)
+    reserves = [f"0x{index:040x}" for index in range(RESERVES_COUNT)]
+    reserves_data = DataFrame(
+        {
+            "underlyingAsset": reserves,
+            "name": [f"Token {index}" for index in range(RESERVES_COUNT)],
+            "symbol": [f"TKN{index}" for index in range(RESERVES_COUNT)],
+            "decimals": [random.choice([6, 8, 18]) for _ in reserves],
+            "baseLTVasCollateral": 8000,
+            "reserveLiquidationThreshold": 8250,
+            "reserveLiquidationBonus": 10500,
+            "usageAsCollateralEnabled": True,
+            "liquidityIndex": pd.Series(
+                [10**27 + random.getrandbits(86) for _ in reserves], dtype=object
+            ),
+            "variableBorrowIndex": pd.Series(
+                [10**27 + random.getrandbits(87) for _ in reserves], dtype=object
+            ),
+            "underlyingTokenPriceUSD": [random.random() * 3000 for _ in reserves],
+        }
+    )
+    # Whale balances above int64 turn the scaled balances columns to objects
+    balances = DataFrame(
+        {
+            "underlyingAsset": [
+                reserves[random.randrange(RESERVES_COUNT)] for _ in range(rows_count)
+            ],
+            "scaledATokenBalance": pd.Series(
+                [
+                    random.getrandbits(random.choice([40, 70, 90]))
+                    for _ in range(rows_count)
+                ],
+                dtype=object,
+            ),
+            "usageAsCollateralEnabledOnUser": True,
+            "scaledVariableDebt": pd.Series(
+                [
+                    random.getrandbits(random.choice([0, 50, 70]))
+                    for _ in range(rows_count)
+                ],
+                dtype=object,
+            ),
+            "user_address": [f"0x{index + 10**6:040x}" for index in range(rows_count)],
+            "snapshot_block": 0,
+        }
+    )
+    return reserves_data, balances
+
+
+RAW_BALANCES_MERGE_COLUMNS = [
+    "underlyingAsset",
+    "name",
+    "symbol",
+    "decimals",
+    "baseLTVasCollateral",
+    "reserveLiquidationThreshold",
+    "reserveLiquidationBonus",
+    "usageAsCollateralEnabled",
+    "liquidityIndex",
+    "variableBorrowIndex",
+    "underlyingTokenPriceUSD",
+]
+USERS_BALANCES_MERGE_COLUMNS = [
+    column
+    for column in RAW_BALANCES_MERGE_COLUMNS
+    if column not in ["symbol", "usageAsCollateralEnabled"]
+]
+
+
+def legacy_process_balances(
+    balances: DataFrame, reserves_data: DataFrame, merge_columns: list
+) -> DataFrame:
+    processed_balances = balances.merge(
+        reserves_data[merge_columns], how="left", on="underlyingAsset"
+    )
+
+    processed_balances.liquidityIndex /= 1e27
+    processed_balances.variableBorrowIndex /= 1e27
+
+    processed_balances["currentATokenBalance"] = (
+        processed_balances.scaledATokenBalance
+        / 10**processed_balances.decimals
+        * processed_balances.liquidityIndex
+    )
+    processed_balances["currentVariableDebt"] = (
+        processed_balances.scaledVariableDebt
+        / 10**processed_balances.decimals
+        * processed_balances.variableBorrowIndex
+    )
+
+    processed_balances["currentATokenBalanceUSD"] = (
+        processed_balances.currentATokenBalance
+        * processed_balances.underlyingTokenPriceUSD
+    )
+    processed_balances["currentVariableDebtUSD"] = (
+        processed_balances.currentVariableDebt
+        * processed_balances.underlyingTokenPriceUSD
+    )
+
+    return processed_balances[
+        (processed_balances.currentATokenBalanceUSD > 0.05)
+        | (processed_balances.currentVariableDebtUSD > 0.05)
+    ]
+
+
+def max_relative_error(balances: DataFrame, column: str, indices: dict) -> float:
+    exact = np.array(
+        [
+            ((scaled * indices[asset] + 10**27 // 2) // 10**27) / 10**decimals
+            for scaled, asset, decimals in zip(
+                balances["scaled" + column[len("current") :]],
+                balances.underlyingAsset,
+                balances.decimals,
+            )
+        ]
+    )
+    computed = balances[column].astype(float).to_numpy()
+    return float(np.max(np.abs(computed - exact) / np.maximum(exact, 1e-30)))
+
+
+def timed(func, *args, repeat: int = 3) -> tuple:
+    # Best of `repeat` runs
+    timings = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    w3 = Web3()
+    collector = AaveV3RawBalancesCollector(w3=w3, contract_abi=[])
+    custom_collector = AaveV3RawBalancesCollectorCustom(
+        w3=w3,
+        pool_abi=[],
+        atoken_abi=[],
+        addresses_provider_abi=[],
+        price_oracle_abi=[],
+    )
+
+    print(ROW_FORMAT.format("rows", "path", "before (s)", "after (s)", "max rel. err."))
+    for rows_count in ROWS_COUNTS:
+        reserves_data, balances = synthetic_balances(rows_count)
+        indices = dict(zip(reserves_data.underlyingAsset, reserves_data.liquidityIndex))
+
+        collector.reserves_data = reserves_data
+        collector.all_users_balances = balances
+        before, _ = timed(
+            legacy_process_balances,
+            balances,
+            reserves_data,
+            RAW_BALANCES_MERGE_COLUMNS,
+        )
+        after, processed = timed(collector.process_raw_balances)
+        sample = processed.sample(min(len(processed), 10_000), random_state=0)
+        print(
+            ROW_FORMAT.format(
+                rows_count,
+                "process_raw_balances",
+                f"{before:.3f}",
+                f"{after:.3f}",
+                f"{max_relative_error(sample, 'currentATokenBalance', indices):.1e}",
+            )
+        )
+
+        positions = balances.drop(columns=["usageAsCollateralEnabledOnUser"])
+        custom_collector.reserves_data = reserves_data
+        custom_collector.all_users_positions = positions
+        before, _ = timed(
+            legacy_process_balances,
+            positions,
+            reserves_data,
+            USERS_BALANCES_MERGE_COLUMNS,
+        )
+        after, processed = timed(custom_collector.process_users_balances)
+        sample = processed.sample(min(len(processed), 10_000), random_state=0)
+        print(
+            ROW_FORMAT.format(
+                rows_count,
+                "process_users_balances",
+                f"{before:.3f}",
+                f"{after:.3f}",
+                f"{max_relative_error(sample, 'currentATokenBalance', indices):.1e}",
+            )
+        )
+
+
+if __name__ == "__main__":
+    main()
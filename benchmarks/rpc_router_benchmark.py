@@ -0,0 +1,115 @@
+"""Benchmark of the RPC router against local mock JSON-RPC servers: one endpoint
+with tail latency, alone or routed with a fast endpoint and a dead one.
+
+Run from the repository root: python -m benchmarks.rpc_router_benchmark --users 1000
+"""
+
+import argparse
+import socket
+import time
+
+import pandas as pd
+from web3 import Web3
+
+from benchmarks.mock_rpc import MockRpcServer, SyntheticAaveMarket
+from src.balances_collector.balances_collector import AaveV3RawBalancesCollector
+from src.utils.abis import load_abi
+from src.utils.rpc_limits import install_adaptive_rpc_concurrency
+from src.utils.rpc_router import RoutedHTTPProvider
+
+ROW_FORMAT = "{:<36} | {:>7} | {:>8} | {:>8} | {}"
+
+
+def dead_url() -> str:
+    # Port bound then released, connections to it are refused
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return f"http://127.0.0.1:{sock.getsockname()[1]}"
+
+
+def run_scenario(provider, market: SyntheticAaveMarket, args) -> tuple:
+    w3 = Web3(provider)
+    install_adaptive_rpc_concurrency(w3, args.max_in_flight)
+    collector = AaveV3RawBalancesCollector(
+        w3,
+        load_abi("ui_pool_data_provider"),
+        block_number=market.latest_block - 100,
+        max_workers=args.max_in_flight,
+    )
+    users = pd.DataFrame({"active_user_address": market.users})
+    start = time.perf_counter()
+    collector.collect_raw_balances(users)
+    return time.perf_counter() - start, collector.raw_balances.users_count()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1_000)
+    parser.add_argument("--reserves", type=int, default=30)
+    parser.add_argument("--latency-ms", type=float, default=5.0)
+    parser.add_argument("--slow-rate", type=float, default=0.05)
+    parser.add_argument("--slow-latency-ms", type=float, default=500.0)
+    parser.add_argument("--max-in-flight", type=int, default=16)
+    args = parser.parse_args()
+
+    market = SyntheticAaveMarket(users_count=args.users, reserves_count=args.reserves)
+    latency = args.latency_ms / 1000
+    fast_server = MockRpcServer(market, latency=latency)
+    tail_server = MockRpcServer(
+        market,
+        latency=latency,
+        slow_rate=args.slow_rate,
+        slow_latency=args.slow_latency_ms / 1000,
+    )
+    with fast_server, tail_server:
+        endpoints = [tail_server.url, fast_server.url, dead_url()]
+        scenarios = [
+            (
+                "HTTPProvider, tail endpoint",
+                lambda: Web3.HTTPProvider(
+                    tail_server.url, exception_retry_configuration=None
+                ),
+            ),
+            (
+                "router, tail endpoint",
+                lambda: RoutedHTTPProvider(
+                    endpoints[:1], pool_size=2 * args.max_in_flight
+                ),
+            ),
+            (
+                "router, 3 endpoints, no hedging",
+                lambda: RoutedHTTPProvider(
+                    endpoints, pool_size=2 * args.max_in_flight, hedge_quantile=None
+                ),
+            ),
+            (
+                "router, 3 endpoints",
+                lambda: RoutedHTTPProvider(endpoints, pool_size=2 * args.max_in_flight),
+            ),
+        ]
+        print(ROW_FORMAT.format("scenario", "users", "time (s)", "users/s", "calls"))
+        for name, provider_factory in scenarios:
+            provider = provider_factory()
+            elapsed, users_count = run_scenario(provider, market, args)
+            calls = (
+                ", ".join(
+                    f"{index}: {stats['requests']} ({stats['hedges']} hedges, "
+                    f"{stats['errors']} errors)"
+                    for index, stats in enumerate(provider.endpoint_stats().values())
+                )
+                if isinstance(provider, RoutedHTTPProvider)
+                else ""
+            )
+            print(
+                ROW_FORMAT.format(
+                    name,
+                    users_count,
+                    f"{elapsed:.2f}",
+                    f"{users_count / elapsed:.0f}",
+                    calls,
+                )
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Users collateral, debt, LTV and health factor computed from processed balances"""
+
+import random
+
+import numpy as np
+from pandas import DataFrame
+from src.utils.logs import logger
+from src.utils.multicall import Multicall3
+
+ACCOUNT_METRICS_COLUMNS = [
+    "user_address",
+    "emode",
+    "total_collateral_usd",
+    "total_debt_usd",
+    "available_borrows_usd",
+    "loan_to_value",
+    "liquidation_threshold",
+    "health_factor",
+    "snapshot_block",
+]
+# Differences to getUserAccountData below these bounds are accepted: positions
+# under 0.05 USD are not in the processed balances
+ABSOLUTE_TOLERANCE_USD = 1.0
+RELATIVE_TOLERANCE = 1e-3
+
+
+def _emode_collateral(
+    emodes: np.ndarray, reserves_ids: np.ndarray, bitmaps
+) -> np.ndarray:
+    """Whether each reserve is in the collateral bitmap of the row emode."""
+    # Bitmaps hold up to 128 reserves, split into two uint64 words
+    bitmaps = [0 if bitmap != bitmap else int(bitmap) for bitmap in bitmaps]
+    words = np.array(
+        [[bitmap & (2**64 - 1), bitmap >> 64] for bitmap in bitmaps] or [[0, 0]],
+        dtype=np.uint64,
+    )
+    row_words = words[emodes, reserves_ids // 64]
+    return ((row_words >> (reserves_ids % 64).astype(np.uint64)) & 1).astype(bool)
+
+
+def compute_account_metrics(
+    processed_balances: DataFrame,
+    users_emodes: DataFrame,
+    emodes_configuration: DataFrame,
+    reserves_ids: dict,
+    block_number: int,
+) -> DataFrame:
+    """
+    Per user metrics of getUserAccountData, computed as the Aave V3.2 Pool does
+    from the processed balances. Collaterals are the positions flagged by the
+    user in reserves with a liquidation threshold. The emode LTV and threshold
+    replace the reserve ones for the reserves in the collateral bitmap of the
+    user emode. `reserves_ids` maps the underlying assets to their reserve id.
+    Every user of the processed balances needs an emode in `users_emodes`.
+    Amounts are in USD and ratios in basis points.
+    """
+    emodes = (
+        users_emodes.drop_duplicates(subset="active_user_address")
+        .set_index("active_user_address")
+        .emode
+    )
+    balances = processed_balances
+    without_emode = balances.user_address[~balances.user_address.isin(emodes.index)]
+    if len(without_emode) > 0:
+        raise Exception(
+            f"No emode for {without_emode.nunique()} users of the processed "
+            f"balances, e.g. {without_emode.unique()[:5].tolist()}"
+        )
+
+    # Emodes are looked up by position in their configuration, row 0 being the
+    # reserves parameters of the users out of any emode
+    configuration = emodes_configuration[emodes_configuration.id != 0]
+    emode_positions = np.zeros(
+        max([0, *configuration.id, *emodes.unique()]) + 1, dtype=np.int64
+    )
+    emode_positions[configuration.id.to_numpy(dtype=np.int64)] = np.arange(
+        1, len(configuration) + 1
+    )
+    rows_emodes = balances.user_address.map(emodes).to_numpy(dtype=np.int64)
+    rows_positions = emode_positions[rows_emodes]
+    in_emode = (rows_positions > 0) & _emode_collateral(
+        rows_positions,
+        balances.underlyingAsset.map(reserves_ids).to_numpy(dtype=np.int64),
+        [0, *configuration.collateral_bitmap],
+    )
+    emode_ltv = np.append(0, configuration.loan_to_value.to_numpy(dtype=float))
+    emode_threshold = np.append(
+        0, configuration.liquidation_threshold.to_numpy(dtype=float)
+    )
+
+    reserve_ltv = balances.baseLTVasCollateral.to_numpy(dtype=float)
+    reserve_threshold = balances.reserveLiquidationThreshold.to_numpy(dtype=float)
+    collateral = balances.usageAsCollateralEnabledOnUser.to_numpy(dtype=bool) & (
+        reserve_threshold != 0
+    )
+    collateral_usd = np.where(
+        collateral, balances.currentATokenBalanceUSD.to_numpy(dtype=float), 0.0
+    )
+    # Collaterals with a zero reserve LTV add no borrowing power, even in emode
+    ltv = np.where(
+        reserve_ltv != 0,
+        np.where(in_emode, emode_ltv[rows_positions], reserve_ltv),
+        0.0,
+    )
+    threshold = np.where(in_emode, emode_threshold[rows_positions], reserve_threshold)
+    totals = (
+        DataFrame(
+            {
+                "user_address": balances.user_address.to_numpy(),
+                "total_collateral_usd": collateral_usd,
+                "total_debt_usd": balances.currentVariableDebtUSD.to_numpy(dtype=float),
+                "borrowing_power_usd": collateral_usd * ltv / 1e4,
+                "liquidation_collateral_usd": collateral_usd * threshold / 1e4,
+            }
+        )
+        .groupby("user_address", sort=False)
+        .sum()
+    )
+
+    total_collateral = totals.total_collateral_usd.to_numpy()
+    total_debt = totals.total_debt_usd.to_numpy()
+    with np.errstate(divide="ignore", invalid="ignore"):
+        account_metrics = DataFrame(
+            {
+                "user_address": totals.index,
+                "emode": emodes.reindex(totals.index).to_numpy(),
+                "total_collateral_usd": total_collateral,
+                "total_debt_usd": total_debt,
+                "available_borrows_usd": np.maximum(
+                    totals.borrowing_power_usd.to_numpy() - total_debt, 0.0
+                ),
+                "loan_to_value": np.where(
+                    total_collateral > 0,
+                    1e4 * totals.borrowing_power_usd.to_numpy() / total_collateral,
+                    0.0,
+                ),
+                "liquidation_threshold": np.where(
+                    total_collateral > 0,
+                    1e4
+                    * totals.liquidation_collateral_usd.to_numpy()
+                    / total_collateral,
+                    0.0,
+                ),
+                # Users without debt cannot be liquidated
+                "health_factor": np.where(
+                    total_debt > 0,
+                    totals.liquidation_collateral_usd.to_numpy() / total_debt,
+                    np.inf,
+                ),
+            }
+        )
+    account_metrics["snapshot_block"] = block_number
+    return account_metrics[ACCOUNT_METRICS_COLUMNS]
+
+
+def _differ(local: np.ndarray, onchain: np.ndarray, absolute_tolerance: float):
+    return np.abs(local - onchain) > np.maximum(
+        absolute_tolerance, RELATIVE_TOLERANCE * np.abs(onchain)
+    )
+
+
+def cross_check_account_metrics(
+    w3,
+    pool_contract,
+    account_metrics: DataFrame,
+    block_number: int,
+    base_currency_unit: int,
+    sample_size: int = 200,
+):
+    """
+    Compare the account metrics of a random sample of `sample_size` users with
+    their getUserAccountData at `block_number`, raise on a difference.
+    """
+    sample = account_metrics.iloc[
+        sorted(
+            random.Random(block_number).sample(
+                range(len(account_metrics)), min(sample_size, len(account_metrics))
+            )
+        )
+    ]
+    results = Multicall3(w3).call(
+        [
+            pool_contract.functions.getUserAccountData(user_address)
+            for user_address in sample.user_address
+        ],
+        block_number,
+    )
+    failed = [
+        user_address
+        for user_address, (success, _) in zip(sample.user_address, results)
+        if not success
+    ]
+    if failed:
+        raise Exception(
+            f"getUserAccountData failed for {len(failed)} sampled users, "
+            f"e.g. {failed[:5]}"
+        )
+
+    onchain = DataFrame(
+        [result for _, result in results],
+        columns=[
+            "total_collateral",
+            "total_debt",
+            "available_borrows",
+            "liquidation_threshold",
+            "loan_to_value",
+            "health_factor",
+        ],
+        dtype=object,
+    )
+    onchain_collateral = onchain.total_collateral.to_numpy(dtype=float)
+    onchain_collateral /= base_currency_unit
+    onchain_debt = onchain.total_debt.to_numpy(dtype=float) / base_currency_unit
+    onchain_health_factor = np.array(
+        [
+            np.inf if value == 2**256 - 1 else value / 1e18
+            for value in onchain.health_factor
+        ]
+    )
+    local_health_factor = sample.health_factor.to_numpy()
+    # Health factors of dust debts are not compared
+    compared_health_factor = onchain_debt > ABSOLUTE_TOLERANCE_USD
+    differences = (
+        _differ(
+            sample.total_collateral_usd.to_numpy(),
+            onchain_collateral,
+            ABSOLUTE_TOLERANCE_USD,
+        )
+        | _differ(
+            sample.total_debt_usd.to_numpy(), onchain_debt, ABSOLUTE_TOLERANCE_USD
+        )
+        | (
+            compared_health_factor
+            & _differ(
+                np.where(compared_health_factor, local_health_factor, 0.0),
+                np.where(compared_health_factor, onchain_health_factor, 0.0),
+                0.0,
+            )
+        )
+    )
+    if differences.any():
+        comparison = sample[
+            ["user_address", "total_collateral_usd", "total_debt_usd", "health_factor"]
+        ].assign(
+            total_collateral_usd_onchain=onchain_collateral,
+            total_debt_usd_onchain=onchain_debt,
+            health_factor_onchain=onchain_health_factor,
+        )
+        raise Exception(
+            "Account metrics differ from getUserAccountData for "
+            f"{differences.sum()} of {len(sample)} sampled users:\n"
+            f"{comparison[differences].head(10).to_string()}"
+        )
+    logger.info(f"   --> Account metrics verified on {len(sample)} sampled users")
@@ -1,58 +1,283 @@
 """Class for extracting and processing users reserves data"""
 
+from decimal import Decimal
+import numpy as np
 import pandas as pd
 from pandas import DataFrame
 from web3 import Web3
+from src.utils.abis import get_contract, load_abi
+from src.utils.async_engine import redriven_map
+from src.utils.checkpoints import CollectionCheckpoint
+from src.utils.compact_balances import CompactBalances, CompactBalancesBuffer
+from src.utils.logs import SampledProgress, logger
+from src.utils.multicall import Multicall3
+from src.utils.ray_math import current_balances_from_limbs, to_float, to_limbs
+from src.utils.rpc_limits import fan_out, redrive
+
+POOL_ADDRESSES_PROVIDER = "0x2f39d218133AFaB8F2B819B1066c7E434Ad94E9e"
+
+USER_RESERVE_COLUMNS = [
+    "underlyingAsset",
+    "scaledATokenBalance",
+    "usageAsCollateralEnabledOnUser",
+    "scaledVariableDebt",
+]
+
+
+def read_raw_balances_csv(filepath_or_buffer, chunksize: int = None) -> DataFrame:
+    # Scaled balances may exceed int64 and are read back as exact integers. With
+    # `chunksize`, an iterator of DataFrames of `chunksize` rows is returned
+    return pd.read_csv(
+        filepath_or_buffer,
+        chunksize=chunksize,
+        converters={
+            "scaledATokenBalance": lambda value: int(Decimal(value)),
+            "scaledVariableDebt": lambda value: int(Decimal(value)),
+        },
+    )
 
 
 class AaveV3RawBalancesCollector:
-    def __init__(self, w3, contract_abi: dict, block_number: int = "latest"):
+    def __init__(
+        self,
+        w3,
+        contract_abi: dict = None,
+        block_number: int = "latest",
+        contract=None,
+        max_workers: int = 16,
+    ):
         self.w3 = w3
         self.contract_address = "0x3F78BBD206e4D3c504Eb854232EdA7e47E9Fd8FC"
-        self.contract_abi = contract_abi
-        self.data_provider_contract = self.w3.eth.contract(
-            address=self.contract_address, abi=contract_abi
+        self.contract_abi = contract_abi or load_abi("ui_pool_data_provider")
+        # A contract object built on the same w3 can be shared between collectors
+        self.data_provider_contract = contract or get_contract(
+            self.w3, self.contract_address, self.contract_abi
         )
         self.block_number = block_number
+        # Threads sending the per-user calls, see fan_out
+        self.max_workers = max_workers
 
-        self.all_users_balances: DataFrame = DataFrame()
+        # Raw balances are kept compact, all_users_balances is their DataFrame form
+        self.raw_balances: CompactBalances = CompactBalances.empty()
+        self.users_with_error: list = list()
         self.reserves_data: DataFrame = DataFrame()
         self.processed_balances: DataFrame = DataFrame()
 
-    def collect_raw_balances(self, users: DataFrame):
-        user_reserve_columns = [
-            "underlyingAsset",
-            "scaledATokenBalance",
-            "usageAsCollateralEnabledOnUser",
-            "scaledVariableDebt",
-        ]
-        all_users_balances = DataFrame()
-        for _, user in users.iterrows():
+    @property
+    def all_users_balances(self) -> DataFrame:
+        return self.raw_balances.to_frame()
+
+    @all_users_balances.setter
+    def all_users_balances(self, all_users_balances: DataFrame):
+        self.raw_balances = CompactBalances.from_frame(all_users_balances)
+
+    def collect_raw_balances(self, users: DataFrame, batched: bool = False):
+        if batched:
+            return self._collect_raw_balances_batched(users)
+
+        users_addresses = users["active_user_address"].tolist()
+        progress = SampledProgress("users balances", len(users_addresses))
+
+        def get_user_reserves_data(user_address: str) -> tuple:
             try:
-                user_address = user["active_user_address"]
                 response = self.data_provider_contract.functions.getUserReservesData(
-                    "0x2f39d218133AFaB8F2B819B1066c7E434Ad94E9e", user_address
-                ).call(block_identifier=self.block_number)[0]
-                user_data_table = DataFrame(response, columns=user_reserve_columns)
-                user_data_table["user_address"] = user_address
-                user_data_table = user_data_table[
-                    (user_data_table.scaledATokenBalance > 0)
-                    | (user_data_table.scaledVariableDebt > 0)
-                ]
-                all_users_balances = pd.concat((all_users_balances, user_data_table))
+                    POOL_ADDRESSES_PROVIDER, user_address
+                ).call(block_identifier=self.block_number)
+                return True, response
             except Exception as e:
-                print(f"Warning: got an error for user {user_address}: {e}")
+                return False, e
+
+        results = list()
+        for result in fan_out(
+            get_user_reserves_data, users_addresses, self.max_workers
+        ):
+            results.append(result)
+            progress.update()
+
+        return self.set_raw_balances(
+            self._raw_balances_from_results(users_addresses, results, progress)
+        )
+
+    def collect_raw_balances_checkpointed(
+        self,
+        users: DataFrame,
+        checkpoint: CollectionCheckpoint,
+        batched: bool = False,
+    ) -> CompactBalances:
+        """
+        Collect the raw balances by address-range chunks committed to
+        `checkpoint`, so that a restarted run only collects the missing chunks.
+        """
+        if self.block_number == "latest":
+            raise ValueError("Checkpointed collection requires a fixed block number")
+
+        def collect_chunk(chunk_users: list) -> tuple:
+            errors_count = len(self.users_with_error)
+            chunk_balances = self.collect_raw_balances(
+                DataFrame({"active_user_address": chunk_users}), batched=batched
+            )
+            return chunk_balances.to_frame(), self.users_with_error[errors_count:]
+
+        all_users_balances, users_with_error = checkpoint.run(
+            users["active_user_address"].tolist(), collect_chunk
+        )
+        self.users_with_error = users_with_error
+        return self.set_raw_balances(all_users_balances)
+
+    def redrive_failed_users(
+        self, max_rounds: int = 3, base_delay: float = 5.0, batched: bool = False
+    ) -> CompactBalances:
+        """
+        Collect again the users whose calls failed, adding their balances to the
+        collected ones. Users still failing after `max_rounds` rounds fail the
+        run instead of silently dropping out of the snapshot.
+        """
+        collected_balances = [self.raw_balances]
+
+        def collect_failed(failed_users: list) -> list:
+            self.users_with_error = list()
+            redriven_balances = self.collect_raw_balances(
+                DataFrame({"active_user_address": failed_users}), batched=batched
+            )
+            if len(redriven_balances) > 0:
+                collected_balances.append(redriven_balances)
+            return self.users_with_error
+
+        self.users_with_error = redrive(
+            self.users_with_error, collect_failed, max_rounds, base_delay
+        )
+        self.set_raw_balances(CompactBalances.concat(collected_balances))
+        if self.users_with_error:
+            raise Exception(
+                f"{len(self.users_with_error)} users still failing after "
+                f"{max_rounds} re-drive rounds: {self.users_with_error}"
+            )
+        return self.raw_balances
+
+    def _collect_raw_balances_batched(self, users: DataFrame):
+        multicall = Multicall3(self.w3)
+        users_addresses = users["active_user_address"].tolist()
+        contract_functions = [
+            self.data_provider_contract.functions.getUserReservesData(
+                POOL_ADDRESSES_PROVIDER, user_address
+            )
+            for user_address in users_addresses
+        ]
+        results = multicall.call(contract_functions, block_identifier=self.block_number)
+        return self.set_raw_balances(
+            self._raw_balances_from_results(users_addresses, results)
+        )
+
+    async def collect_raw_balances_async(
+        self, users: DataFrame, max_concurrency: int = 500, max_rounds: int = 3
+    ):
+        """
+        collect_raw_balances on an AsyncWeb3 instance, the failed users are
+        re-driven for `max_rounds` rounds and the users still failing fail the
+        run, as with redrive_failed_users.
+        """
+        # The snapshot block is pinned first, every user is read at the same one
+        if self.block_number == "latest":
+            self.block_number = await self.w3.eth.get_block_number()
+        users_addresses = users["active_user_address"].tolist()
+
+        async def get_user_reserves_data(user_address):
+            return await self.data_provider_contract.functions.getUserReservesData(
+                POOL_ADDRESSES_PROVIDER, user_address
+            ).call(block_identifier=self.block_number)
+
+        responses = await redriven_map(
+            get_user_reserves_data, users_addresses, max_concurrency, max_rounds
+        )
+        results = [
+            (
+                (False, str(response))
+                if isinstance(response, Exception)
+                else (True, response)
+            )
+            for response in responses
+        ]
+
+        self.users_with_error = list()
+        self.set_raw_balances(self._raw_balances_from_results(users_addresses, results))
+        if self.users_with_error:
+            raise Exception(
+                f"{len(self.users_with_error)} users still failing after "
+                f"{max_rounds} re-drive rounds: {self.users_with_error}"
+            )
+        return self.raw_balances
+
+    def _raw_balances_from_results(
+        self, users_addresses: list, results: list, progress: SampledProgress = None
+    ):
+        if progress is None:
+            # Batched and async results all arrive at the end
+            progress = SampledProgress("users balances", len(users_addresses))
+            progress.update(len(users_addresses))
+        all_users_balances = CompactBalancesBuffer()
+        for user_address, (success, result) in zip(users_addresses, results):
+            if not success:
+                progress.error(f"user {user_address}", result)
+                self.users_with_error.append(user_address)
+                continue
+            # Keeping the position of the reserve in the user's response as index
+            for position, user_reserve in enumerate(result[0]):
+                underlying_asset, scaled_atoken, usage_as_collateral, scaled_debt = (
+                    user_reserve
+                )
+                if scaled_atoken > 0 or scaled_debt > 0:
+                    all_users_balances.append(
+                        user_address,
+                        position,
+                        underlying_asset,
+                        scaled_atoken,
+                        usage_as_collateral,
+                        scaled_debt,
+                    )
+        progress.finish()
+        return all_users_balances.to_compact()
+
+    def carry_forward_raw_balances(
+        self, previous_balances: DataFrame, active_users: DataFrame
+    ) -> CompactBalances:
+        """
+        Add to the collected raw balances the positions of the previous snapshot
+        users that were not active since. Their scaled balances are unchanged,
+        process_raw_balances re-values them with the current indices and prices.
+        """
+        carried_forward_balances = previous_balances.loc[
+            ~previous_balances.user_address.isin(active_users.active_user_address),
+            USER_RESERVE_COLUMNS + ["user_address"],
+        ]
+        logger.info(
+            f"   --> Carrying forward {carried_forward_balances.user_address.nunique()} "
+            "inactive users from the previous snapshot"
+        )
+        return self.set_raw_balances(
+            CompactBalances.concat(
+                [
+                    self.raw_balances,
+                    CompactBalances.from_frame(carried_forward_balances),
+                ]
+            )
+        )
 
+    def set_raw_balances(self, all_users_balances) -> CompactBalances:
+        """
+        Set raw balances collected elsewhere, a CompactBalances or a raw balances
+        DataFrame read back from a file, stamped with the collector block.
+        """
+        if isinstance(all_users_balances, DataFrame):
+            all_users_balances = CompactBalances.from_frame(all_users_balances)
         if self.block_number == "latest":
-            block_number = self.w3.eth.get_block_number()
+            all_users_balances.snapshot_block = self.w3.eth.get_block_number()
         else:
-            block_number = self.block_number
-        all_users_balances["snapshot_block"] = block_number
+            all_users_balances.snapshot_block = self.block_number
 
-        self.all_users_balances = all_users_balances
+        self.raw_balances = all_users_balances
         return all_users_balances
 
-    def collect_reserves_data(self) -> dict:
+    def collect_reserves_data(self, reserves_snapshot=None) -> dict:
         reserve_data_columns = [
             "underlyingAsset",
             "name",
@@ -78,11 +303,15 @@ class AaveV3RawBalancesCollector:
             "totalScaledVariableDebt",
             "underlyingTokenPriceUSD",
         ]
-        response, base_currency_info = (
-            self.data_provider_contract.functions.getReservesData(
-                "0x2f39d218133AFaB8F2B819B1066c7E434Ad94E9e"
-            ).call(block_identifier=self.block_number)
-        )
+        if reserves_snapshot is not None:
+            # ReservesSnapshot of the same block, shared with the other steps
+            response, base_currency_info = reserves_snapshot.data_provider_reserves
+        else:
+            response, base_currency_info = (
+                self.data_provider_contract.functions.getReservesData(
+                    POOL_ADDRESSES_PROVIDER
+                ).call(block_identifier=self.block_number)
+            )
         response = [reserve_data[0:23] for reserve_data in response]
         reserves_data = DataFrame(response, columns=reserve_data_columns)
         reserves_data.underlyingTokenPriceUSD = (
@@ -94,7 +323,6 @@ class AaveV3RawBalancesCollector:
 
     def process_raw_balances(self):
         merge_columns = [
-            "underlyingAsset",
             "name",
             "symbol",
             "decimals",
@@ -106,37 +334,57 @@ class AaveV3RawBalancesCollector:
             "variableBorrowIndex",
             "underlyingTokenPriceUSD",
         ]
-        processed_balances = self.all_users_balances.merge(
-            self.reserves_data[merge_columns], how="left", on="underlyingAsset"
+        # Indices are RAY fixed-point integers, converted once per reserve
+        reserves_data = self.reserves_data[merge_columns].copy()
+        reserves_data.liquidityIndex = (
+            to_float(to_limbs(reserves_data.liquidityIndex)) / 1e27
+        )
+        reserves_data.variableBorrowIndex = (
+            to_float(to_limbs(reserves_data.variableBorrowIndex)) / 1e27
         )
 
-        processed_balances.liquidityIndex /= 1e27
-        processed_balances.variableBorrowIndex /= 1e27
+        # Rows refer to their reserve by code, mapped once to the reserves_data
+        # positions instead of merging string columns. Unknown reserves are at -1
+        balances = self.raw_balances
+        reserve_positions = pd.Index(self.reserves_data.underlyingAsset).get_indexer(
+            balances.reserves
+        )[balances.reserve_codes]
 
-        processed_balances["currentATokenBalance"] = (
-            processed_balances.scaledATokenBalance
-            / 10**processed_balances.decimals
-            * processed_balances.liquidityIndex
+        # Exact rayMul of the scaled balances by the reserves indices
+        atoken_balances = current_balances_from_limbs(
+            balances.scaled_atoken,
+            reserve_positions,
+            self.reserves_data.liquidityIndex.tolist(),
+            self.reserves_data.decimals,
         )
-        processed_balances["currentVariableDebt"] = (
-            processed_balances.scaledVariableDebt
-            / 10**processed_balances.decimals
-            * processed_balances.variableBorrowIndex
+        variable_debts = current_balances_from_limbs(
+            balances.scaled_debt,
+            reserve_positions,
+            self.reserves_data.variableBorrowIndex.tolist(),
+            self.reserves_data.decimals,
         )
+        # Position -1 picks the NaN appended after the reserves prices
+        prices = np.append(
+            reserves_data.underlyingTokenPriceUSD.to_numpy(dtype=float), np.nan
+        )[reserve_positions]
+        atoken_balances_usd = atoken_balances * prices
+        variable_debts_usd = variable_debts * prices
 
-        processed_balances["currentATokenBalanceUSD"] = (
-            processed_balances.currentATokenBalance
-            * processed_balances.underlyingTokenPriceUSD
+        # Only the kept rows are turned into a DataFrame, indexed as the rows of
+        # the raw balances
+        kept_rows = np.flatnonzero(
+            (atoken_balances_usd > 0.05) | (variable_debts_usd > 0.05)
         )
-        processed_balances["currentVariableDebtUSD"] = (
-            processed_balances.currentVariableDebt
-            * processed_balances.underlyingTokenPriceUSD
-        )
-
-        processed_balances = processed_balances[
-            (processed_balances.currentATokenBalanceUSD > 0.05)
-            | (processed_balances.currentVariableDebtUSD > 0.05)
-        ]
+        processed_balances = balances.to_frame(kept_rows)
+        processed_balances.index = kept_rows
+        for column in merge_columns:
+            processed_balances[column] = reserves_data[column].to_numpy()[
+                reserve_positions[kept_rows]
+            ]
+        processed_balances["currentATokenBalance"] = atoken_balances[kept_rows]
+        processed_balances["currentVariableDebt"] = variable_debts[kept_rows]
+        processed_balances["currentATokenBalanceUSD"] = atoken_balances_usd[kept_rows]
+        processed_balances["currentVariableDebtUSD"] = variable_debts_usd[kept_rows]
 
         self.processed_balances = processed_balances
         return processed_balances
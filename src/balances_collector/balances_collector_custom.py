@@ -1,6 +1,18 @@
 import pandas as pd
 from pandas import DataFrame
+import asyncio
 import concurrent.futures
+import contextvars
+from src.utils.abis import get_contract, load_abi
+from src.utils.async_engine import gather_or_raise, limited_call, redriven_map
+from src.utils.columnar import ColumnarBuffer
+from src.utils.logs import SampledProgress, logger
+from src.utils.bitmaps import decode_reserve_configurations, decode_user_configurations
+from src.utils.checkpoints import CollectionCheckpoint
+from src.balances_collector.reserves_snapshot import ReservesSnapshot
+from src.utils.ray_math import current_balances, to_float, to_limbs
+from src.utils.rpc_batch import JsonRpcBatchTransport
+from src.utils.rpc_limits import fan_out, redrive
 
 reserves_names_dict = {
     "0xC02aaA39b223FE8D0A0e5C4F27eAD9083C756Cc2": "Wrapped Ether",
@@ -48,70 +60,171 @@ class AaveV3RawBalancesCollectorCustom:
     def __init__(
         self,
         w3,
-        pool_abi: dict,
-        atoken_abi: dict,
-        addresses_provider_abi: dict,
-        price_oracle_abi: dict,
+        pool_abi: dict = None,
+        atoken_abi: dict = None,
+        addresses_provider_abi: dict = None,
+        price_oracle_abi: dict = None,
+        max_workers: int = 16,
     ):
+        # ABIs default to the ones of src/abi, loaded once per process
         # Provider
         self.w3 = w3
+        self.max_workers = max_workers
 
         # Pool contract
         self.pool_address = "0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2"
-        self.pool_abi = pool_abi
-        self.pool_contract = self.w3.eth.contract(
-            address=self.pool_address, abi=self.pool_abi
-        )
+        self.pool_abi = pool_abi or load_abi("pool_abi")
+        self.pool_contract = get_contract(self.w3, self.pool_address, self.pool_abi)
 
         # ABIs
-        self.atoken_abi = atoken_abi
-        self.addresses_provider_abi = addresses_provider_abi
-        self.price_oracle_abi = price_oracle_abi
+        self.atoken_abi = atoken_abi or load_abi("atoken_abi")
+        self.addresses_provider_abi = addresses_provider_abi or load_abi(
+            "addresses_provider_abi"
+        )
+        self.price_oracle_abi = price_oracle_abi or load_abi("price_oracle_abi")
 
         # Computed data
         self.reserves_data: DataFrame = DataFrame()
         self.all_users_positions: DataFrame = DataFrame()
         self.processed_balances: DataFrame = DataFrame()
+        self.users_with_error: list = list()
 
-    def get_reserves_data(self, block_identifier: int) -> DataFrame:
+    def get_reserves_data(
+        self, block_identifier: int, reserves_snapshot: ReservesSnapshot = None
+    ) -> DataFrame:
+        # Two multicall round trips instead of ~3 sequential calls per reserve,
+        # or none when a snapshot of the same block is shared
+        if reserves_snapshot is None:
+            reserves_snapshot = ReservesSnapshot(
+                self.w3, block_identifier, pool_contract=self.pool_contract
+            )
+        configurations = list()
         all_reserves_data = list()
-        reserves_list = self.pool_contract.functions.getReservesList().call(
+        for underlying_asset_address in reserves_snapshot.reserves_list:
+            reserve_data = reserves_snapshot.reserve_data[underlying_asset_address]
+            configurations.append(reserve_data[0][0])
+            data = self._reserve_data_dict(underlying_asset_address, reserve_data)
+            data.update(
+                {
+                    "availableLiquidity": reserves_snapshot.available_liquidity[
+                        underlying_asset_address
+                    ],
+                    "totalScaledVariableDebt": (
+                        reserves_snapshot.total_scaled_variable_debt[
+                            underlying_asset_address
+                        ]
+                    ),
+                }
+            )
+            all_reserves_data.append(data)
+
+        return self._set_reserves_data(
+            configurations,
+            all_reserves_data,
+            reserves_snapshot.prices_list,
+            reserves_snapshot.currency_unit,
+        )
+
+    async def get_reserves_data_async(
+        self, block_identifier: int, max_concurrency: int = 100
+    ) -> DataFrame:
+        # Requires the collector to be built on an AsyncWeb3 instance
+        semaphore = asyncio.Semaphore(max_concurrency)
+        reserves_list = await self.pool_contract.functions.getReservesList().call(
             block_identifier=block_identifier
         )
-        for underlying_asset_address in reserves_list:
-            reserve_data = self.pool_contract.functions.getReserveData(
-                underlying_asset_address
-            ).call(block_identifier=block_identifier)
-            configuration = self._read_reserve_configuration(reserve_data[0][0])
-            data = self._read_reserve_data(
-                block_identifier, underlying_asset_address, reserve_data
+        reserves_raw_data = await gather_or_raise(
+            *(
+                limited_call(
+                    semaphore,
+                    self.pool_contract.functions.getReserveData(underlying_asset),
+                    block_identifier,
+                )
+                for underlying_asset in reserves_list
             )
-            configuration.update(data)
-            all_reserves_data.append(configuration)
+        )
+        configurations = [reserve_data[0][0] for reserve_data in reserves_raw_data]
+        all_reserves_data = [
+            self._reserve_data_dict(underlying_asset, reserve_data)
+            for underlying_asset, reserve_data in zip(reserves_list, reserves_raw_data)
+        ]
 
-        reserves_data = pd.json_normalize(all_reserves_data)
-        reserves_data["name"] = reserves_data.underlyingAsset.map(reserves_names_dict)
+        available_liquidities = gather_or_raise(
+            *(
+                limited_call(
+                    semaphore,
+                    get_contract(
+                        self.w3, data["underlyingAsset"], self.atoken_abi
+                    ).functions.balanceOf(data["aTokenAddress"]),
+                    block_identifier,
+                )
+                for data in all_reserves_data
+            )
+        )
+        total_scaled_variable_debts = gather_or_raise(
+            *(
+                limited_call(
+                    semaphore,
+                    get_contract(
+                        self.w3, data["variableDebtTokenAddress"], self.atoken_abi
+                    ).functions.scaledTotalSupply(),
+                    block_identifier,
+                )
+                for data in all_reserves_data
+            )
+        )
+        available_liquidities, total_scaled_variable_debts = await gather_or_raise(
+            available_liquidities, total_scaled_variable_debts
+        )
+        for data, availableLiquidity, totalScaledVariableDebt in zip(
+            all_reserves_data, available_liquidities, total_scaled_variable_debts
+        ):
+            data.update(
+                {
+                    "availableLiquidity": availableLiquidity,
+                    "totalScaledVariableDebt": totalScaledVariableDebt,
+                }
+            )
 
         # Extracting underlying token price from oracle contract
-        provider_address = self.pool_contract.functions.ADDRESSES_PROVIDER().call(
+        provider_address = await self.pool_contract.functions.ADDRESSES_PROVIDER().call(
             block_identifier=block_identifier
         )
-        provider_contract = self.w3.eth.contract(
-            address=provider_address, abi=self.addresses_provider_abi
+        provider_contract = get_contract(
+            self.w3, provider_address, self.addresses_provider_abi
         )
-        oracle_address = provider_contract.functions.getPriceOracle().call(
+        oracle_address = await provider_contract.functions.getPriceOracle().call(
             block_identifier=block_identifier
         )
-        oracle_contract = self.w3.eth.contract(
-            address=oracle_address, abi=self.price_oracle_abi
+        oracle_contract = get_contract(self.w3, oracle_address, self.price_oracle_abi)
+        prices_list, currency_unit = await gather_or_raise(
+            oracle_contract.functions.getAssetsPrices(reserves_list).call(
+                block_identifier=block_identifier
+            ),
+            oracle_contract.functions.BASE_CURRENCY_UNIT().call(
+                block_identifier=block_identifier
+            ),
         )
 
-        prices_list = oracle_contract.functions.getAssetsPrices(
-            reserves_data.underlyingAsset.tolist()
-        ).call(block_identifier=block_identifier)
-        currency_unit = oracle_contract.functions.BASE_CURRENCY_UNIT().call(
-            block_identifier=block_identifier
+        return self._set_reserves_data(
+            configurations, all_reserves_data, prices_list, currency_unit
+        )
+
+    def _set_reserves_data(
+        self,
+        configurations: list,
+        all_reserves_data: list,
+        prices_list: list,
+        currency_unit: int,
+    ) -> DataFrame:
+        reserves_data = pd.concat(
+            (
+                DataFrame(decode_reserve_configurations(configurations)),
+                pd.json_normalize(all_reserves_data),
+            ),
+            axis=1,
         )
+        reserves_data["name"] = reserves_data.underlyingAsset.map(reserves_names_dict)
         reserves_data["underlyingTokenPriceUSD"] = prices_list
         reserves_data.underlyingTokenPriceUSD = (
             reserves_data.underlyingTokenPriceUSD / currency_unit
@@ -120,55 +233,365 @@ class AaveV3RawBalancesCollectorCustom:
         self.reserves_data = reserves_data
         return self.reserves_data
 
-    def get_all_users_position(self, users: list, block_identifier: int):
-        all_users_positions = dict()
+    def get_all_users_position(
+        self,
+        users: list,
+        block_identifier: int,
+        batch_transport: JsonRpcBatchTransport = None,
+        users_per_payload_group: int = 500,
+        prefilter_with_user_configuration: bool = False,
+        max_workers: int = None,
+    ):
+        """
+        Collect the scaled balances of `users` in every reserve. With
+        `prefilter_with_user_configuration`, the debt token balances are only
+        read in the reserves flagged as borrowed in the users' configuration
+        bitmaps, the aToken balances are read in every reserve.
+        """
+        max_workers = max_workers or self.max_workers
+        reserves_contracts = self._get_reserves_contracts()
         users_with_error = list()
+        if prefilter_with_user_configuration:
+            users_borrowed_reserves, users_with_error = (
+                self.get_users_borrowed_reserves(
+                    users, block_identifier, batch_transport, max_workers
+                )
+            )
+            users = [user for user in users if user in users_borrowed_reserves]
+        else:
+            all_reserves = set(reserves_contracts.keys())
+            users_borrowed_reserves = {user: all_reserves for user in users}
+
+        if batch_transport is not None:
+            all_users_positions, users_with_position_error = (
+                self._get_users_position_batched(
+                    batch_transport,
+                    reserves_contracts,
+                    users_borrowed_reserves,
+                    users,
+                    block_identifier,
+                    users_per_payload_group,
+                )
+            )
+        else:
+            all_users_positions, users_with_position_error = (
+                self._get_users_position_threaded(
+                    reserves_contracts,
+                    users_borrowed_reserves,
+                    users,
+                    block_identifier,
+                    max_workers,
+                )
+            )
+        self.users_with_error = users_with_error + users_with_position_error
+        return self._set_users_positions(all_users_positions, block_identifier)
+
+    def get_all_users_position_checkpointed(
+        self,
+        users: list,
+        block_identifier: int,
+        checkpoint: CollectionCheckpoint,
+        **collection_options,
+    ) -> DataFrame:
+        """
+        Run get_all_users_position by address-range chunks committed to
+        `checkpoint`, so that a restarted run only collects the missing chunks.
+        """
+
+        def collect_chunk(chunk_users: list) -> tuple:
+            chunk_positions = self.get_all_users_position(
+                chunk_users, block_identifier, **collection_options
+            )
+            return chunk_positions, self.users_with_error
+
+        all_users_positions, self.users_with_error = checkpoint.run(
+            users, collect_chunk
+        )
+        all_users_positions["snapshot_block"] = block_identifier
+        self.all_users_positions = all_users_positions
+        return all_users_positions
+
+    def redrive_failed_users(
+        self,
+        block_identifier: int,
+        max_rounds: int = 3,
+        base_delay: float = 5.0,
+        **collection_options,
+    ) -> DataFrame:
+        """
+        Collect again the users whose calls failed, adding their positions to
+        the collected ones. Users still failing after `max_rounds` rounds fail
+        the run instead of silently dropping out of the snapshot.
+        """
+        collected_positions = [self.all_users_positions]
+
+        def collect_failed(failed_users: list) -> list:
+            redriven_positions = self.get_all_users_position(
+                failed_users, block_identifier, **collection_options
+            )
+            if len(redriven_positions) > 0:
+                collected_positions.append(redriven_positions)
+            return self.users_with_error
+
+        self.users_with_error = redrive(
+            self.users_with_error, collect_failed, max_rounds, base_delay
+        )
+        self.all_users_positions = pd.concat(collected_positions)
+        if self.users_with_error:
+            raise Exception(
+                f"{len(self.users_with_error)} users still failing after "
+                f"{max_rounds} re-drive rounds: {self.users_with_error}"
+            )
+        return self.all_users_positions
+
+    async def get_all_users_position_async(
+        self,
+        users: list,
+        block_identifier: int,
+        max_concurrency: int = 1_000,
+        max_rounds: int = 3,
+    ):
+        """
+        get_all_users_position on an AsyncWeb3 instance, the failed users are
+        re-driven for `max_rounds` rounds and the users still failing fail the
+        run, as with redrive_failed_users.
+        """
+        reserves_contracts = self._get_reserves_contracts()
+        underlying_assets = list(reserves_contracts.keys())
+        semaphore = asyncio.Semaphore(max_concurrency)
+
+        async def get_user_position(user):
+            # A user fails as a whole once all its calls completed
+            balances = await gather_or_raise(
+                *(
+                    limited_call(
+                        semaphore,
+                        contract.functions.scaledBalanceOf(user),
+                        block_identifier,
+                    )
+                    for contracts in reserves_contracts.values()
+                    for contract in contracts
+                )
+            )
+            return self._build_user_position(
+                underlying_assets, balances[0::2], balances[1::2]
+            )
+
+        # Enough users in flight to keep `max_concurrency` requests busy
+        users_concurrency = max_concurrency // max(1, 2 * len(underlying_assets)) + 1
+        results = await redriven_map(
+            get_user_position, users, users_concurrency, max_rounds
+        )
+
+        all_users_positions = dict()
+        self.users_with_error = list()
+        progress = SampledProgress("users positions", len(users))
+        for user, result in zip(users, results):
+            if isinstance(result, Exception):
+                progress.error(f"user {user}", result)
+                self.users_with_error.append(user)
+            else:
+                all_users_positions.update({user: result})
+        progress.update(len(users))
+        progress.finish()
+        self._set_users_positions(all_users_positions, block_identifier)
+        if self.users_with_error:
+            raise Exception(
+                f"{len(self.users_with_error)} users still failing after "
+                f"{max_rounds} re-drive rounds: {self.users_with_error}"
+            )
+        return self.all_users_positions
+
+    def _set_users_positions(
+        self, all_users_positions: dict, block_identifier: int
+    ) -> DataFrame:
+        users_positions = ColumnarBuffer(
+            [
+                "user_address",
+                "underlyingAsset",
+                "scaledATokenBalance",
+                "scaledVariableDebt",
+            ]
+        )
+        for user, balance in all_users_positions.items():
+            n_assets = len(balance["underlyingAsset"])
+            users_positions.extend(
+                [
+                    [user] * n_assets,
+                    balance["underlyingAsset"],
+                    balance["scaledATokenBalance"],
+                    balance["scaledVariableDebt"],
+                ],
+                index=range(n_assets),
+            )
+        users_positions = users_positions.to_frame()
+        users_positions["snapshot_block"] = block_identifier
+        self.all_users_positions = users_positions
+        return users_positions
 
-        # Creating atoken and vtoken contracts for each reserve
+    def _get_reserves_contracts(self) -> dict:
+        # Atoken and vtoken contracts of each reserve, built once per process
         reserves_contracts = dict()
         for _, row in self.reserves_data.iterrows():
-            atoken_contract = self.w3.eth.contract(
-                address=row["aTokenAddress"], abi=self.atoken_abi
+            atoken_contract = get_contract(
+                self.w3, row["aTokenAddress"], self.atoken_abi
             )
-            vtoken_contract = self.w3.eth.contract(
-                address=row["variableDebtTokenAddress"], abi=self.atoken_abi
+            vtoken_contract = get_contract(
+                self.w3, row["variableDebtTokenAddress"], self.atoken_abi
             )
             reserves_contracts.update(
                 {row["underlyingAsset"]: [atoken_contract, vtoken_contract]}
             )
+        return reserves_contracts
+
+    def get_users_borrowed_reserves(
+        self,
+        users: list,
+        block_identifier: int,
+        batch_transport: JsonRpcBatchTransport = None,
+        max_workers: int = None,
+    ):
+        """
+        Read the users' configuration bitmaps and return, for each user, the
+        set of reserves flagged as borrowed. The borrowing bit is set exactly
+        while the user has a debt in the reserve, whereas supplies that are not
+        enabled as collateral are not flagged, hence only the debt side is
+        pre-filtered.
+        """
+        contract_functions = [
+            self.pool_contract.functions.getUserConfiguration(user) for user in users
+        ]
+        if batch_transport is not None:
+            results = batch_transport.call(
+                contract_functions, block_identifier=block_identifier
+            )
+        else:
+            results = list(
+                fan_out(
+                    lambda contract_function: _safe_call(
+                        contract_function, block_identifier
+                    ),
+                    contract_functions,
+                    max_workers or self.max_workers,
+                )
+            )
 
-        # Extracting position for each user
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        users_with_configuration = list()
+        configurations = list()
+        users_with_error = list()
+        progress = SampledProgress("users configurations", len(users))
+        for user, (success, result) in zip(users, results):
+            if success:
+                users_with_configuration.append(user)
+                configurations.append(result[0])
+            else:
+                progress.error(f"user {user}", result)
+                users_with_error.append(user)
+        progress.update(len(users))
+        progress.finish()
+
+        underlying_assets = self.reserves_data.underlyingAsset.to_numpy()
+        is_borrowing, _ = decode_user_configurations(
+            configurations, self.reserves_data.reserveId.tolist()
+        )
+        users_borrowed_reserves = {
+            user: set(underlying_assets[is_borrowing[index]].tolist())
+            for index, user in enumerate(users_with_configuration)
+        }
+        return users_borrowed_reserves, users_with_error
+
+    def _get_users_position_threaded(
+        self,
+        reserves_contracts: dict,
+        users_borrowed_reserves: dict,
+        users: list,
+        block_identifier: int,
+        max_workers: int = None,
+    ):
+        all_users_positions = dict()
+        users_with_error = list()
+
+        # Extracting position for each user. With an adaptive RPC concurrency
+        # limit on w3, `max_workers` should be at least its maximum
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
             futures = {
                 executor.submit(
-                    self._get_user_position, reserves_contracts, user, block_identifier
+                    contextvars.copy_context().run,
+                    self._get_user_position,
+                    reserves_contracts,
+                    users_borrowed_reserves[user],
+                    user,
+                    block_identifier,
                 ): user
                 for user in users
             }
+            progress = SampledProgress("users positions", len(users))
             for future in concurrent.futures.as_completed(futures):
                 user = futures[future]
                 try:
                     result = future.result()
-                    print(f"Result: {result}")
                     all_users_positions.update({user: result})
-                except:
-                    print(f"Found an error for user: {user}")
+                except Exception as e:
+                    progress.error(f"user {user}", e)
                     users_with_error.append(user)
+                progress.update()
+            progress.finish()
+        return all_users_positions, users_with_error
 
-        users_positions = DataFrame()
-        for user, balance in all_users_positions.items():
-            user_data = DataFrame(
-                {
-                    "user_address": user,
-                    "underlyingAsset": balance["underlyingAsset"],
-                    "scaledATokenBalance": balance["scaledATokenBalance"],
-                    "scaledVariableDebt": balance["scaledVariableDebt"],
-                }
+    def _get_users_position_batched(
+        self,
+        batch_transport: JsonRpcBatchTransport,
+        reserves_contracts: dict,
+        users_borrowed_reserves: dict,
+        users: list,
+        block_identifier: int,
+        users_per_payload_group: int,
+    ):
+        all_users_positions = dict()
+        users_with_error = list()
+
+        # One scaledBalanceOf call per (user, reserve, token), flattened across
+        # reserves and users so that batch payloads mix both
+        progress = SampledProgress("users positions", len(users))
+        for start in range(0, len(users), users_per_payload_group):
+            users_group = users[start : start + users_per_payload_group]
+            users_functions = [
+                self._user_position_functions(
+                    reserves_contracts, users_borrowed_reserves[user], user
+                )
+                for user in users_group
+            ]
+            contract_functions = [
+                contract_function
+                for user_functions in users_functions
+                for contract_function in user_functions
+            ]
+            results = batch_transport.call(
+                contract_functions, block_identifier=block_identifier
             )
-            users_positions = pd.concat((users_positions, user_data))
-        users_positions["snapshot_block"] = block_identifier
-        self.all_users_positions = users_positions
-        return users_positions
+
+            offset = 0
+            for user, user_functions in zip(users_group, users_functions):
+                calls_count = len(user_functions)
+                user_results = results[offset : offset + calls_count]
+                offset += calls_count
+                errors = [result for success, result in user_results if not success]
+                if errors:
+                    progress.error(f"user {user}", errors[0])
+                    users_with_error.append(user)
+                    continue
+                all_users_positions.update(
+                    {
+                        user: self._position_from_balances(
+                            reserves_contracts,
+                            users_borrowed_reserves[user],
+                            [result for _, result in user_results],
+                        )
+                    }
+                )
+            progress.update(len(users_group))
+        progress.finish()
+        return all_users_positions, users_with_error
 
     def process_users_balances(self):
         merge_columns = [
@@ -182,22 +605,33 @@ class AaveV3RawBalancesCollectorCustom:
             "variableBorrowIndex",
             "underlyingTokenPriceUSD",
         ]
+        # Indices are RAY fixed-point integers, converted once per reserve
+        reserves_data = self.reserves_data[merge_columns].copy()
+        reserves_data.liquidityIndex = (
+            to_float(to_limbs(reserves_data.liquidityIndex)) / 1e27
+        )
+        reserves_data.variableBorrowIndex = (
+            to_float(to_limbs(reserves_data.variableBorrowIndex)) / 1e27
+        )
         processed_balances = self.all_users_positions.merge(
-            self.reserves_data[merge_columns], how="left", on="underlyingAsset"
+            reserves_data, how="left", on="underlyingAsset"
         )
 
-        processed_balances.liquidityIndex /= 1e27
-        processed_balances.variableBorrowIndex /= 1e27
-
-        processed_balances["currentATokenBalance"] = (
-            processed_balances.scaledATokenBalance
-            / 10**processed_balances.decimals
-            * processed_balances.liquidityIndex
+        # Exact rayMul of the scaled balances by the reserves indices
+        reserve_positions = pd.Index(self.reserves_data.underlyingAsset).get_indexer(
+            processed_balances.underlyingAsset
+        )
+        processed_balances["currentATokenBalance"] = current_balances(
+            processed_balances.scaledATokenBalance,
+            reserve_positions,
+            self.reserves_data.liquidityIndex.tolist(),
+            self.reserves_data.decimals,
         )
-        processed_balances["currentVariableDebt"] = (
-            processed_balances.scaledVariableDebt
-            / 10**processed_balances.decimals
-            * processed_balances.variableBorrowIndex
+        processed_balances["currentVariableDebt"] = current_balances(
+            processed_balances.scaledVariableDebt,
+            reserve_positions,
+            self.reserves_data.variableBorrowIndex.tolist(),
+            self.reserves_data.decimals,
         )
 
         processed_balances["currentATokenBalanceUSD"] = (
@@ -217,26 +651,12 @@ class AaveV3RawBalancesCollectorCustom:
         self.processed_balances = processed_balances
         return processed_balances
 
-    def _read_reserve_configuration(self, configuration: int) -> dict:
-        binary = bin(configuration)
-        reserve_factor = int(binary[-79:-64], 2) if binary[-79:-64] != "" else 0
-        configuration_dict = {
-            "baseLTVasCollateral": int(binary[-15:], 2),
-            "reserveLiquidationThreshold": int(binary[-31:-16], 2),
-            "reserveLiquidationBonus": int(binary[-47:-32], 2),
-            "decimals": int(binary[-55:-48], 2),
-            "isActive": bool(int(binary[-56], 2)),
-            "isFrozen": bool(int(binary[-57], 2)),
-            "borrowingEnabled": bool(int(binary[-58], 2)),
-            "reserveFactor": reserve_factor,
-        }
-        return configuration_dict
-
-    def _read_reserve_data(
-        self, block_identifier: int, underlying_asset_address: str, reserve_data: tuple
+    def _reserve_data_dict(
+        self, underlying_asset_address: str, reserve_data: tuple
     ) -> dict:
-        reserve_data_dict = {
+        return {
             "underlyingAsset": underlying_asset_address,
+            "reserveId": reserve_data[7],
             "liquidityIndex": reserve_data[1],
             "variableBorrowIndex": reserve_data[3],
             "liquidityRate": reserve_data[2],
@@ -247,44 +667,70 @@ class AaveV3RawBalancesCollectorCustom:
             "interestRateStrategyAddress": reserve_data[11],
             "accruedToTreasury": reserve_data[12],
         }
-        underlying_asset_contract = self.w3.eth.contract(
-            address=underlying_asset_address, abi=self.atoken_abi
-        )
-        vtoken_contract = self.w3.eth.contract(
-            address=reserve_data_dict["variableDebtTokenAddress"], abi=self.atoken_abi
-        )
-        availableLiquidity = underlying_asset_contract.functions.balanceOf(
-            reserve_data_dict["aTokenAddress"]
-        ).call(block_identifier=block_identifier)
-        totalScaledVariableDebt = vtoken_contract.functions.scaledTotalSupply().call(
-            block_identifier=block_identifier
-        )
-        reserve_data_dict.update(
-            {
-                "availableLiquidity": availableLiquidity,
-                "totalScaledVariableDebt": totalScaledVariableDebt,
-            }
-        )
-        return reserve_data_dict
 
     def _get_user_position(
-        self, reserves_contracts: dict, user_address: str, block_identifier: int
+        self,
+        reserves_contracts: dict,
+        borrowed_reserves: set,
+        user_address: str,
+        block_identifier: int,
     ):
-        print(f"   --> Extracting position for user: {user_address}")
+        logger.debug(f"   --> Extracting position for user: {user_address}")
+        balances = [
+            contract_function.call(block_identifier=block_identifier)
+            for contract_function in self._user_position_functions(
+                reserves_contracts, borrowed_reserves, user_address
+            )
+        ]
+        return self._position_from_balances(
+            reserves_contracts, borrowed_reserves, balances
+        )
+
+    def _user_position_functions(
+        self, reserves_contracts: dict, borrowed_reserves: set, user_address: str
+    ) -> list:
+        """
+        scaledBalanceOf calls of the aToken of every reserve, each followed by
+        the one of the debt token when the reserve is in `borrowed_reserves`.
+        """
+        return [
+            contract.functions.scaledBalanceOf(user_address)
+            for underlying_asset, contracts in reserves_contracts.items()
+            for contract in (
+                contracts if underlying_asset in borrowed_reserves else contracts[:1]
+            )
+        ]
+
+    def _position_from_balances(
+        self, reserves_contracts: dict, borrowed_reserves: set, balances: list
+    ) -> dict:
+        # Balances are ordered like the calls of _user_position_functions
+        balances = iter(balances)
+        underlying_assets = list()
+        scaled_atoken_balances = list()
+        scaled_variable_debts = list()
+        for underlying_asset in reserves_contracts:
+            underlying_assets.append(underlying_asset)
+            scaled_atoken_balances.append(next(balances))
+            scaled_variable_debts.append(
+                next(balances) if underlying_asset in borrowed_reserves else 0
+            )
+        return self._build_user_position(
+            underlying_assets, scaled_atoken_balances, scaled_variable_debts
+        )
+
+    def _build_user_position(
+        self,
+        underlying_assets: list,
+        scaled_atoken_balances: list,
+        scaled_variable_debts: list,
+    ) -> dict:
         assets = list()
         atoken_balances = list()
         vtoken_balances = list()
-        for underlying_asset, contracts in reserves_contracts.items():
-            scaledATokenBalance = (
-                contracts[0]
-                .functions.scaledBalanceOf(user_address)
-                .call(block_identifier=block_identifier)
-            )
-            scaledVariableDebt = (
-                contracts[1]
-                .functions.scaledBalanceOf(user_address)
-                .call(block_identifier=block_identifier)
-            )
+        for underlying_asset, scaledATokenBalance, scaledVariableDebt in zip(
+            underlying_assets, scaled_atoken_balances, scaled_variable_debts
+        ):
             if (scaledATokenBalance > 0) or (scaledVariableDebt > 0):
                 assets.append(underlying_asset)
                 atoken_balances.append(scaledATokenBalance)
@@ -296,3 +742,10 @@ class AaveV3RawBalancesCollectorCustom:
         }
 
         return user_position
+
+
+def _safe_call(contract_function, block_identifier) -> tuple:
+    try:
+        return True, contract_function.call(block_identifier=block_identifier)
+    except Exception as e:
+        return False, str(e)
@@ -0,0 +1,350 @@
+"""Users scaled balances rebuilt by replaying the reserves tokens events"""
+
+import json
+import random
+
+from eth_utils import keccak, to_checksum_address
+from pandas import DataFrame
+
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+from src.utils.bitmaps import decode_user_configurations
+from src.utils.columnar import ColumnarBuffer
+from src.utils.compact_balances import CompactBalances, CompactBalancesBuffer
+from src.utils.event_logs import POOL_DEPLOYMENT_BLOCK, get_logs_chunked
+from src.utils.logs import logger
+from src.utils.multicall import Multicall3
+from src.utils.ray_math import RAY
+
+MINT_TOPIC = keccak(text="Mint(address,address,uint256,uint256,uint256)")
+BURN_TOPIC = keccak(text="Burn(address,address,uint256,uint256,uint256)")
+BALANCE_TRANSFER_TOPIC = keccak(text="BalanceTransfer(address,address,uint256,uint256)")
+REPLAY_CHECKPOINTS_KEY = "balances_replay/checkpoints.json"
+
+
+def ray_div(a: int, b: int) -> int:
+    # WadRayMath.rayDiv, rounding half up
+    return (a * RAY + b // 2) // b
+
+
+def _topic_address(topic: bytes) -> str:
+    return "0x" + bytes(topic[-20:]).hex()
+
+
+def _data_words(data: bytes) -> list:
+    return [
+        int.from_bytes(data[start : start + 32], "big")
+        for start in range(0, len(data), 32)
+    ]
+
+
+class AaveV3BalancesReplay:
+    """
+    Scaled aToken and variable debt balances of every user, rebuilt from the
+    Mint, Burn and BalanceTransfer logs of the reserves tokens instead of
+    per-user calls. These logs carry every scaled balance change: supplies,
+    withdrawals, borrows, repayments, liquidations, transfers and treasury
+    mints all go through them, so the Pool events are not needed.
+
+    Balances are kept by token address then user, and checkpointed in `store`
+    at every replayed block, of which the latest `max_checkpoints` are kept.
+    Replaying a snapshot block starts from the latest checkpoint before it and
+    costs one log range.
+    """
+
+    def __init__(
+        self,
+        collector: AaveV3RawBalancesCollectorCustom,
+        store=None,
+        chunk_size: int = 5_000,
+        max_checkpoints: int = 7,
+    ):
+        self.collector = collector
+        self.store = store
+        self.chunk_size = chunk_size
+        self.max_checkpoints = max_checkpoints
+        self.last_block = POOL_DEPLOYMENT_BLOCK - 1
+        # {token address: {user address: scaled balance}}, lowercase addresses
+        self.balances = dict()
+        # {lowercase user address: [(reserve position, scaled aToken balance,
+        # scaled debt)]} of the replayed block
+        self.positions_by_user = dict()
+
+    def _checkpoint_key(self, block_number: int) -> str:
+        return f"balances_replay/block={block_number}.json"
+
+    def _checkpoint_blocks(self) -> list:
+        body = self.store.read(REPLAY_CHECKPOINTS_KEY)
+        return json.loads(body) if body is not None else []
+
+    def load_checkpoint(self, block_number: int):
+        """Start from the latest checkpoint at or before `block_number`."""
+        self.last_block = POOL_DEPLOYMENT_BLOCK - 1
+        self.balances = dict()
+        if self.store is None:
+            return
+        blocks = [block for block in self._checkpoint_blocks() if block <= block_number]
+        if not blocks:
+            return
+        state = json.loads(self.store.read(self._checkpoint_key(max(blocks))))
+        self.last_block = state["last_block"]
+        self.balances = state["balances"]
+        logger.info(f"   --> Replay resumed from the checkpoint of block {max(blocks)}")
+
+    def save_checkpoint(self):
+        state = {"last_block": self.last_block, "balances": self.balances}
+        self.store.write(
+            self._checkpoint_key(self.last_block), json.dumps(state).encode()
+        )
+        # The list of checkpoints is written last, it commits the checkpoint
+        blocks = sorted(set(self._checkpoint_blocks()) | {self.last_block})
+        kept_blocks = blocks[-self.max_checkpoints :]
+        self.store.write(REPLAY_CHECKPOINTS_KEY, json.dumps(kept_blocks).encode())
+        # Checkpoints out of the list are deleted once it no longer lists them
+        for block in blocks[: -self.max_checkpoints]:
+            self.store.delete(self._checkpoint_key(block))
+
+    def apply_log(self, log):
+        token_balances = self.balances[log["address"].lower()]
+        topic = bytes(log["topics"][0])
+        words = _data_words(bytes(log["data"]))
+        if topic == BALANCE_TRANSFER_TOPIC:
+            # The value of BalanceTransfer is already scaled
+            sender = _topic_address(log["topics"][1])
+            recipient = _topic_address(log["topics"][2])
+            token_balances[sender] = token_balances.get(sender, 0) - words[0]
+            token_balances[recipient] = token_balances.get(recipient, 0) + words[0]
+            return
+        value, balance_increase, index = words
+        if topic == MINT_TOPIC:
+            user = _topic_address(log["topics"][2])
+            # A burn smaller than the accrued interest is emitted as a Mint of
+            # the difference, then value < balanceIncrease
+            scaled_change = (
+                ray_div(value - balance_increase, index)
+                if value >= balance_increase
+                else -ray_div(balance_increase - value, index)
+            )
+        else:
+            user = _topic_address(log["topics"][1])
+            scaled_change = -ray_div(value + balance_increase, index)
+        token_balances[user] = token_balances.get(user, 0) + scaled_change
+
+    def replay(self, block_number: int) -> int:
+        """Apply the tokens logs up to `block_number`, return their count."""
+        if block_number < self.last_block:
+            self.load_checkpoint(block_number)
+        tokens = (
+            self.collector.reserves_data.aTokenAddress.tolist()
+            + self.collector.reserves_data.variableDebtTokenAddress.tolist()
+        )
+        for token in tokens:
+            self.balances.setdefault(token.lower(), dict())
+
+        logs_count = 0
+        for log in get_logs_chunked(
+            self.collector.w3,
+            tokens,
+            [
+                [
+                    "0x" + topic.hex()
+                    for topic in [MINT_TOPIC, BURN_TOPIC, BALANCE_TRANSFER_TOPIC]
+                ]
+            ],
+            self.last_block + 1,
+            block_number,
+            self.chunk_size,
+        ):
+            self.apply_log(log)
+            logs_count += 1
+        logger.info(
+            f"   --> Replayed {logs_count} token logs in "
+            f"[{self.last_block + 1}, {block_number}]"
+        )
+        self.last_block = block_number
+        return logs_count
+
+    def users_positions(self) -> DataFrame:
+        """Non-zero balances, in the all_users_positions schema of the collector."""
+        reserves = self.collector.reserves_data
+        users_positions = dict()
+        for balance_position, tokens_column in enumerate(
+            ["aTokenAddress", "variableDebtTokenAddress"]
+        ):
+            for underlying_asset, token in zip(
+                reserves.underlyingAsset, reserves[tokens_column]
+            ):
+                for user, balance in self.balances[token.lower()].items():
+                    if balance == 0:
+                        continue
+                    position = users_positions.setdefault(
+                        (user, underlying_asset), [0, 0]
+                    )
+                    position[balance_position] = balance
+
+        positions = ColumnarBuffer(
+            [
+                "user_address",
+                "underlyingAsset",
+                "scaledATokenBalance",
+                "scaledVariableDebt",
+            ]
+        )
+        checksum_addresses = dict()
+        for (user, underlying_asset), (atoken_balance, debt) in sorted(
+            users_positions.items()
+        ):
+            if user not in checksum_addresses:
+                checksum_addresses[user] = to_checksum_address(user)
+            positions.append(
+                (checksum_addresses[user], underlying_asset, atoken_balance, debt),
+                index=0,
+            )
+        positions = positions.to_frame()
+        positions["snapshot_block"] = self.last_block
+        return positions
+
+    def collect_users_positions(self, block_number: int) -> DataFrame:
+        """
+        Replay the logs up to `block_number` from the latest checkpoint, and set
+        the all_users_positions of the collector, ready for
+        process_users_balances.
+        """
+        self.collector.get_reserves_data(block_number)
+        self.load_checkpoint(block_number)
+        self.replay(block_number)
+        positions = self.users_positions()
+        if positions.empty:
+            # E.g. a block before the deployment of the Pool, at
+            # POOL_DEPLOYMENT_BLOCK, would publish empty snapshots
+            raise Exception(
+                f"The replay up to block {block_number} yields no positions"
+            )
+        if self.store is not None:
+            self.save_checkpoint()
+        self.collector.all_users_positions = positions
+        self.positions_by_user = self._positions_by_user(positions)
+        return self.collector.all_users_positions
+
+    def _positions_by_user(self, positions: DataFrame) -> dict:
+        reserves = self.collector.reserves_data
+        # Rows keep the position of the reserve in getUserReservesData
+        reserve_positions = {
+            underlying_asset: position
+            for position, underlying_asset in enumerate(reserves.underlyingAsset)
+        }
+        positions_by_user = dict()
+        for user, underlying_asset, atoken_balance, debt in zip(
+            positions.user_address,
+            positions.underlyingAsset,
+            positions.scaledATokenBalance,
+            positions.scaledVariableDebt,
+        ):
+            positions_by_user.setdefault(user.lower(), list()).append(
+                (reserve_positions[underlying_asset], atoken_balance, debt)
+            )
+        return positions_by_user
+
+    def users_raw_balances(self, users_addresses: list) -> CompactBalances:
+        """
+        Replayed positions of `users_addresses` as the raw balances of
+        AaveV3RawBalancesCollector, with the collateral flags of the users
+        getUserConfiguration at the replayed block. Users without a position
+        have no row, as in the collected raw balances.
+        """
+        reserves = self.collector.reserves_data
+        users_positions = self.positions_by_user
+        users_addresses = [
+            user_address
+            for user_address in users_addresses
+            if user_address.lower() in users_positions
+        ]
+
+        results = Multicall3(self.collector.w3).call(
+            [
+                self.collector.pool_contract.functions.getUserConfiguration(
+                    user_address
+                )
+                for user_address in users_addresses
+            ],
+            self.last_block,
+        )
+        failed = [
+            user_address
+            for user_address, (success, _) in zip(users_addresses, results)
+            if not success
+        ]
+        if failed:
+            raise Exception(
+                f"getUserConfiguration failed for {len(failed)} replayed users, "
+                f"e.g. {failed[:5]}"
+            )
+        _, is_using_as_collateral = decode_user_configurations(
+            [result[0] for _, result in results], reserves.reserveId.tolist()
+        )
+
+        raw_balances = CompactBalancesBuffer()
+        for index, user_address in enumerate(users_addresses):
+            for position, atoken_balance, debt in sorted(
+                users_positions[user_address.lower()]
+            ):
+                raw_balances.append(
+                    user_address,
+                    position,
+                    reserves.underlyingAsset.iloc[position],
+                    atoken_balance,
+                    bool(is_using_as_collateral[index, position]),
+                    debt,
+                )
+        return raw_balances.to_compact(self.last_block)
+
+    def cross_check(
+        self, users_addresses: list, sample_size: int = 200, **collection_options
+    ):
+        """
+        Compare the replayed positions of a random sample of `users_addresses`,
+        the users of the snapshot, with their scaledBalanceOf calls at the
+        replayed block, raise on a difference. Sampling the snapshot users also
+        catches the positions the replay misses entirely.
+        """
+        replayed = self.collector.all_users_positions
+        users = sorted(set(users_addresses))
+        sample = random.Random(self.last_block).sample(
+            users, min(sample_size, len(users))
+        )
+        expected = self.collector.get_all_users_position(
+            sample, self.last_block, **collection_options
+        )
+        # The collection replaced the replayed positions of the collector
+        self.collector.all_users_positions = replayed
+        if self.collector.users_with_error:
+            raise Exception(
+                f"Cross-check calls failed for {len(self.collector.users_with_error)}"
+                " sampled users"
+            )
+
+        # Snapshot users lists and replayed positions may differ in case
+        sample = {user.lower() for user in sample}
+        columns = ["user", "underlyingAsset"]
+        replayed = replayed.assign(user=replayed.user_address.str.lower())
+        expected = expected.assign(user=expected.user_address.str.lower())
+        differences = replayed[replayed.user.isin(sample)].merge(
+            expected.drop(columns=["user_address"]),
+            how="outer",
+            on=columns,
+            suffixes=("", "_calls"),
+            indicator=True,
+        )
+        differences = differences[
+            (differences._merge != "both")
+            | (differences.scaledATokenBalance != differences.scaledATokenBalance_calls)
+            | (differences.scaledVariableDebt != differences.scaledVariableDebt_calls)
+        ]
+        if len(differences) > 0:
+            raise Exception(
+                f"Replayed balances differ from the calls on {len(differences)} "
+                f"positions of {len(sample)} sampled users:\n"
+                f"{differences.head(10).to_string()}"
+            )
+        logger.info(f"   --> Replayed balances verified on {len(sample)} sampled users")
@@ -0,0 +1,128 @@
+"""Reserves data and treasury balances of one block, in two multicall round trips"""
+
+from src.utils.abis import get_contract
+from src.utils.multicall import Multicall3
+
+POOL_ADDRESS = "0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2"
+DATA_PROVIDER_ADDRESS = "0x3F78BBD206e4D3c504Eb854232EdA7e47E9Fd8FC"
+POOL_ADDRESSES_PROVIDER = "0x2f39d218133AFaB8F2B819B1066c7E434Ad94E9e"
+TREASURY_COLLECTOR_ADDRESS = "0x464C71f6c2F760DdA6093dCB91C24c39e5d6e18c"
+# Positions in the getReservesData reserve tuples of the data provider
+RESERVE_NAME = 1
+RESERVE_ATOKEN_ADDRESS = 17
+RESERVE_VTOKEN_ADDRESS = 18
+# Position of the reserve id, its bit in the bitmaps, in the Pool getReserveData
+RESERVE_DATA_ID = 7
+
+
+class ReservesSnapshot:
+    """
+    Everything the collectors and the treasury step read about the reserves at
+    `block_number`: the data provider getReservesData response, the Pool
+    getReserveData of every reserve, available liquidities, scaled variable
+    debt supplies, oracle prices and treasury balances. The first round trip
+    gets the reserves list, token addresses and oracle address, the second one
+    all the per-reserve calls.
+    """
+
+    def __init__(
+        self,
+        w3,
+        block_number: int,
+        data_provider_contract=None,
+        pool_contract=None,
+    ):
+        self.w3 = w3
+        self.block_number = block_number
+        self.data_provider_contract = data_provider_contract or get_contract(
+            w3, DATA_PROVIDER_ADDRESS, "ui_pool_data_provider"
+        )
+        self.pool_contract = pool_contract or get_contract(w3, POOL_ADDRESS, "pool_abi")
+
+        self.data_provider_reserves = None
+        self.reserves_list = list()
+        self.reserve_data = dict()
+        self.available_liquidity = dict()
+        self.total_scaled_variable_debt = dict()
+        self.treasury_balances = dict()
+        self.prices_list = list()
+        self.currency_unit = None
+        self.collect()
+
+    def _call(self, contract_functions: list) -> list:
+        # A multicall per round, the large getReservesData response of the first
+        # one must not size the batches of the second one
+        multicall = Multicall3(self.w3, initial_batch_size=len(contract_functions))
+        results = multicall.call(contract_functions, self.block_number)
+        for contract_function, (success, result) in zip(contract_functions, results):
+            if not success:
+                raise Exception(
+                    f"Reserves snapshot call {contract_function.fn_name} failed at "
+                    f"block {self.block_number}: {result}"
+                )
+        return [result for _, result in results]
+
+    def collect(self):
+        addresses_provider = get_contract(
+            self.w3, POOL_ADDRESSES_PROVIDER, "addresses_provider_abi"
+        )
+        self.data_provider_reserves, self.reserves_list, oracle_address = self._call(
+            [
+                self.data_provider_contract.functions.getReservesData(
+                    POOL_ADDRESSES_PROVIDER
+                ),
+                self.pool_contract.functions.getReservesList(),
+                addresses_provider.functions.getPriceOracle(),
+            ]
+        )
+        reserves = {reserve[0]: reserve for reserve in self.data_provider_reserves[0]}
+
+        contract_functions = list()
+        for underlying_asset in self.reserves_list:
+            reserve = reserves[underlying_asset]
+            underlying_contract = get_contract(self.w3, underlying_asset, "atoken_abi")
+            atoken_contract = get_contract(
+                self.w3, reserve[RESERVE_ATOKEN_ADDRESS], "atoken_abi"
+            )
+            vtoken_contract = get_contract(
+                self.w3, reserve[RESERVE_VTOKEN_ADDRESS], "atoken_abi"
+            )
+            # The GHO treasury balance is held in GHO, not in an aToken
+            treasury_token = (
+                underlying_contract
+                if reserve[RESERVE_NAME] == "Gho Token"
+                else atoken_contract
+            )
+            contract_functions.extend(
+                [
+                    self.pool_contract.functions.getReserveData(underlying_asset),
+                    underlying_contract.functions.balanceOf(
+                        reserve[RESERVE_ATOKEN_ADDRESS]
+                    ),
+                    vtoken_contract.functions.scaledTotalSupply(),
+                    treasury_token.functions.balanceOf(TREASURY_COLLECTOR_ADDRESS),
+                ]
+            )
+        oracle_contract = get_contract(self.w3, oracle_address, "price_oracle_abi")
+        contract_functions.extend(
+            [
+                oracle_contract.functions.getAssetsPrices(self.reserves_list),
+                oracle_contract.functions.BASE_CURRENCY_UNIT(),
+            ]
+        )
+
+        results = self._call(contract_functions)
+        for position, underlying_asset in enumerate(self.reserves_list):
+            (
+                self.reserve_data[underlying_asset],
+                self.available_liquidity[underlying_asset],
+                self.total_scaled_variable_debt[underlying_asset],
+                self.treasury_balances[underlying_asset],
+            ) = results[4 * position : 4 * position + 4]
+        self.prices_list, self.currency_unit = results[-2:]
+
+    def reserves_ids(self) -> dict:
+        return {
+            underlying_asset: reserve_data[RESERVE_DATA_ID]
+            for underlying_asset, reserve_data in self.reserve_data.items()
+        }
@@ -0,0 +1,90 @@
+"""Persistent user e-mode map, updated from the Pool UserEModeSet logs"""
+
+import bisect
+import json
+import threading
+
+from src.utils.event_logs import POOL_DEPLOYMENT_BLOCK, get_logs_chunked
+from src.utils.logs import logger
+
+EMODE_MAP_KEY = "user_emodes.json"
+
+
+class UserEModeMap:
+    """
+    E-mode changes of every user who ever called setUserEMode, as
+    [block, category id] lists, scanned up to `last_block` and kept in `store`
+    (a local or S3 checkpoint store). Users without a change are in e-mode 0.
+    """
+
+    def __init__(self, store, chunk_size: int = 50_000):
+        self.store = store
+        self.chunk_size = chunk_size
+        self.last_block = POOL_DEPLOYMENT_BLOCK - 1
+        self.changes = dict()
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        body = self.store.read(EMODE_MAP_KEY)
+        if body is None:
+            return
+        state = json.loads(body)
+        self.last_block = state["last_block"]
+        self.changes = state["changes"]
+
+    def save(self):
+        state = {"last_block": self.last_block, "changes": self.changes}
+        self.store.write(EMODE_MAP_KEY, json.dumps(state).encode())
+
+    def update(self, pool_contract, block_number: int) -> int:
+        """Scan the UserEModeSet logs up to `block_number`, return their count."""
+        # Snapshots of several dates share the map, the lowest blocks are read
+        # from the history of changes
+        with self._lock:
+            if block_number <= self.last_block:
+                return 0
+            return self._update(pool_contract, block_number)
+
+    def _update(self, pool_contract, block_number: int) -> int:
+        event = pool_contract.events.UserEModeSet()
+        logs_count = 0
+        for log in get_logs_chunked(
+            pool_contract.w3,
+            pool_contract.address,
+            [event.topic],
+            self.last_block + 1,
+            block_number,
+            self.chunk_size,
+        ):
+            decoded_log = event.process_log(log)
+            user_changes = self.changes.setdefault(
+                decoded_log["args"]["user"].lower(), []
+            )
+            if user_changes and user_changes[-1][0] == log["blockNumber"]:
+                # Only the last change of a block is visible at that block
+                user_changes[-1][1] = decoded_log["args"]["categoryId"]
+            else:
+                user_changes.append(
+                    [log["blockNumber"], decoded_log["args"]["categoryId"]]
+                )
+            logs_count += 1
+        logger.info(
+            f"   --> E-mode map: {logs_count} UserEModeSet logs in "
+            f"[{self.last_block + 1}, {block_number}]"
+        )
+        self.last_block = block_number
+        self.save()
+        return logs_count
+
+    def emode_at(self, user_address: str, block_number: int) -> int:
+        if block_number > self.last_block:
+            raise ValueError(
+                f"E-mode map only scanned up to block {self.last_block}, "
+                f"not {block_number}"
+            )
+        user_changes = self.changes.get(user_address.lower())
+        if not user_changes:
+            return 0
+        position = bisect.bisect_right(user_changes, block_number, key=lambda c: c[0])
+        return user_changes[position - 1][1] if position > 0 else 0
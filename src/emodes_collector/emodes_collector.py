@@ -1,16 +1,33 @@
-import pandas as pd
+import random
+
 from pandas import DataFrame
+from src.emodes_collector.emode_map import UserEModeMap
+from src.utils.abis import get_contract, load_abi
+from src.utils.async_engine import redriven_map
+from src.utils.columnar import ColumnarBuffer
+from src.utils.logs import SampledProgress, logger
+from src.utils.rpc_limits import fan_out, redrive
 
 
 class AaveV3EModesCollector:
-    def __init__(self, w3, pool_abi: dict, block_number: int = "latest"):
+    def __init__(
+        self,
+        w3,
+        pool_abi: dict = None,
+        block_number: int = "latest",
+        contract=None,
+        max_workers: int = 16,
+    ):
         self.w3 = w3
         self.contract_address = "0x87870Bca3F3fD6335C3F4ce8392D69350B4fA4E2"
-        self.contract_abi = pool_abi
-        self.pool_contract = self.w3.eth.contract(
-            address=self.contract_address, abi=pool_abi
+        self.contract_abi = pool_abi or load_abi("pool_abi")
+        # A contract object built on the same w3 can be shared between collectors
+        self.pool_contract = contract or get_contract(
+            self.w3, self.contract_address, self.contract_abi
         )
         self.block_number = block_number
+        # Threads sending the per-user calls, see fan_out
+        self.max_workers = max_workers
 
         self.active_users_emodes: DataFrame = DataFrame()
         self.emodes_caracteristics: DataFrame = DataFrame()
@@ -18,38 +35,219 @@ class AaveV3EModesCollector:
     def collect_emodes(self, users: DataFrame) -> DataFrame:
         users_ = users.copy()
         users_["snapshot_block"] = self.block_number
-        users_["emode"] = 0
-        for index, user in users_.iterrows():
-            user_address = user["active_user_address"]
-            user_emode = self.pool_contract.functions.getUserEMode(user_address).call(
+        users_["emode"] = self._get_users_emodes(users_["active_user_address"].tolist())
+
+        # self.active_users_emodes = users_[users_.emode != 0]
+        self.active_users_emodes = users_
+        return self.active_users_emodes
+
+    def _get_users_emodes(
+        self, users_addresses: list, max_rounds: int = 3, base_delay: float = 5.0
+    ) -> list:
+        """
+        getUserEMode of every user. The users whose call failed are collected
+        again at the end, as the raw balances ones, and users still failing
+        after `max_rounds` rounds fail the run instead of aborting it at the
+        first error.
+        """
+        emodes = dict()
+
+        def get_user_emode(user_address: str) -> tuple:
+            try:
+                emode = self.pool_contract.functions.getUserEMode(user_address).call(
+                    block_identifier=self.block_number
+                )
+                return True, emode
+            except Exception as e:
+                return False, e
+
+        def collect(users_addresses: list) -> list:
+            failed_users = list()
+            progress = SampledProgress("users emodes", len(users_addresses))
+            for user_address, (success, result) in zip(
+                users_addresses,
+                fan_out(get_user_emode, users_addresses, self.max_workers),
+            ):
+                if success:
+                    emodes[user_address] = result
+                else:
+                    progress.error(f"user {user_address}", result)
+                    failed_users.append(user_address)
+                progress.update()
+            progress.finish()
+            return failed_users
+
+        failed_users = redrive(
+            collect(users_addresses), collect, max_rounds, base_delay
+        )
+        if failed_users:
+            raise Exception(
+                f"{len(failed_users)} users emodes still failing after "
+                f"{max_rounds} re-drive rounds: {failed_users}"
+            )
+        return [emodes[user_address] for user_address in users_addresses]
+
+    def carried_forward_emodes(
+        self,
+        users_addresses: list,
+        previous_emodes: dict,
+        emode_map: UserEModeMap = None,
+    ) -> DataFrame:
+        """
+        Emodes of the previous snapshot users that were not active since. They
+        are read from `emode_map` when given, else from `previous_emodes`, the
+        emode by address of the previous snapshot, and the users missing from it
+        are collected with getUserEMode.
+        """
+        if emode_map is not None:
+            emode_map.update(self.pool_contract, self.block_number)
+            emodes = [
+                emode_map.emode_at(user_address, self.block_number)
+                for user_address in users_addresses
+            ]
+        else:
+            emodes = [
+                previous_emodes.get(user_address) for user_address in users_addresses
+            ]
+            missing_users = [
+                user_address
+                for user_address, emode in zip(users_addresses, emodes)
+                if emode is None
+            ]
+            if missing_users:
+                logger.info(
+                    f"   --> Collecting the emodes of {len(missing_users)} carried "
+                    "forward users missing from the previous snapshot"
+                )
+                collected_emodes = iter(self._get_users_emodes(missing_users))
+                emodes = [
+                    next(collected_emodes) if emode is None else emode
+                    for emode in emodes
+                ]
+        return DataFrame(
+            {
+                "active_user_address": users_addresses,
+                "snapshot_block": self.block_number,
+                "emode": emodes,
+            }
+        )
+
+    def collect_emodes_from_logs(
+        self, users: DataFrame, emode_map: UserEModeMap, verification_sample: int = 200
+    ) -> DataFrame:
+        """
+        Read the users emodes from `emode_map`, updated up to the snapshot block,
+        and check a random sample of `verification_sample` users with
+        getUserEMode calls.
+        """
+        emode_map.update(self.pool_contract, self.block_number)
+        users_ = users.copy()
+        users_["snapshot_block"] = self.block_number
+        users_["emode"] = [
+            emode_map.emode_at(user_address, self.block_number)
+            for user_address in users_["active_user_address"]
+        ]
+
+        sample = random.Random(self.block_number).sample(
+            range(len(users_)), min(verification_sample, len(users_))
+        )
+        mismatches = list()
+        for position in sample:
+            user_address, emode = users_.iloc[position][
+                ["active_user_address", "emode"]
+            ]
+            onchain_emode = self.pool_contract.functions.getUserEMode(
+                user_address
+            ).call(block_identifier=self.block_number)
+            if onchain_emode != emode:
+                mismatches.append((user_address, emode, onchain_emode))
+        if mismatches:
+            raise Exception(
+                f"E-mode map differs from getUserEMode for {len(mismatches)}/"
+                f"{len(sample)} sampled users, e.g. {mismatches[:5]}"
+            )
+        logger.info(f"   --> E-mode map verified on {len(sample)} sampled users")
+
+        self.active_users_emodes = users_
+        return self.active_users_emodes
+
+    async def collect_emodes_async(
+        self, users: DataFrame, max_concurrency: int = 500, max_rounds: int = 3
+    ) -> DataFrame:
+        """
+        collect_emodes on an AsyncWeb3 instance, the failed users are re-driven
+        for `max_rounds` rounds and the users still failing fail the run.
+        """
+        users_ = users.copy()
+        users_["snapshot_block"] = self.block_number
+
+        async def get_user_emode(user_address):
+            return await self.pool_contract.functions.getUserEMode(user_address).call(
                 block_identifier=self.block_number
             )
-            users_.loc[index, "emode"] = user_emode
 
-        # self.active_users_emodes = users_[users_.emode != 0]
+        emodes = await redriven_map(
+            get_user_emode,
+            users_["active_user_address"].tolist(),
+            max_concurrency,
+            max_rounds,
+        )
+        users_with_error = [
+            user_address
+            for user_address, emode in zip(users_["active_user_address"], emodes)
+            if isinstance(emode, Exception)
+        ]
+        if users_with_error:
+            raise Exception(
+                f"{len(users_with_error)} users emodes still failing after "
+                f"{max_rounds} re-drive rounds: {users_with_error}"
+            )
+        users_["emode"] = emodes
+
         self.active_users_emodes = users_
         return self.active_users_emodes
 
-    def collect_emodes_configuration(self) -> DataFrame:
-        emodes_ids = self.active_users_emodes.emode.unique().tolist()
-        emodes_caracteristics = DataFrame()
+    def collect_emodes_configuration(self, emodes_ids: list = None) -> DataFrame:
+        # Defaults to the emodes of the collected users
+        if emodes_ids is None:
+            emodes_ids = self.active_users_emodes.emode.unique().tolist()
+        emodes_caracteristics = ColumnarBuffer(
+            [
+                "id",
+                "label",
+                "loan_to_value",
+                "liquidation_threshold",
+                "liquidation_bonus",
+                "collateral_bitmap",
+            ]
+        )
         for emode_id in emodes_ids:
-            emode_data = self.pool_contract.functions.getEModeCategoryCollateralConfig(
-                emode_id
-            ).call(block_identifier=self.block_number)
+            loan_to_value, liquidation_threshold, liquidation_bonus = (
+                self.pool_contract.functions.getEModeCategoryCollateralConfig(
+                    emode_id
+                ).call(block_identifier=self.block_number)
+            )
             label = self.pool_contract.functions.getEModeCategoryLabel(emode_id).call(
                 block_identifier=self.block_number
             )
-            id_data = DataFrame(
-                {
-                    "id": [emode_id],
-                    "label": [label],
-                    "loan_to_value": [emode_data[0]],
-                    "liquidation_threshold": [emode_data[1]],
-                    "liquidation_threshold": [emode_data[2]],
-                }
+            # Bit `id` is set for the reserves whose LTV and liquidation threshold
+            # are replaced by the emode ones
+            collateral_bitmap = (
+                self.pool_contract.functions.getEModeCategoryCollateralBitmap(
+                    emode_id
+                ).call(block_identifier=self.block_number)
+            )
+            emodes_caracteristics.append(
+                (
+                    emode_id,
+                    label,
+                    loan_to_value,
+                    liquidation_threshold,
+                    liquidation_bonus,
+                    collateral_bitmap,
+                ),
+                index=0,
             )
-            emodes_caracteristics = pd.concat((emodes_caracteristics, id_data))
 
-        self.emodes_caracteristics = emodes_caracteristics
+        self.emodes_caracteristics = emodes_caracteristics.to_frame()
         return self.emodes_caracteristics
@@ -0,0 +1,65 @@
+"""S3 client and web3 connection of the ETL, with the RPC middlewares installed"""
+
+from web3 import Web3
+
+from src.utils.logs import logger
+from src.utils.metrics import RunMetrics, install_rpc_metrics
+from src.utils.rpc_cache import (
+    DEFAULT_RPC_CACHE_PATH,
+    RpcResponseCache,
+    install_rpc_cache,
+)
+from src.utils.rpc_limits import install_adaptive_rpc_concurrency
+from src.utils.rpc_router import RoutedHTTPProvider
+
+AWS_API_ENDPOINT = "https://minio-simple.lab.groupe-genes.fr"
+BUCKET = "projet-datalab-group-jprat"
+
+
+def connect_s3(
+    access_key: str,
+    secret_key: str,
+    endpoint_url: str = AWS_API_ENDPOINT,
+    verify: bool = False,
+):
+    # boto3 takes a while to import, it is only loaded when a run starts
+    import boto3
+
+    return boto3.client(
+        "s3",
+        endpoint_url=endpoint_url,
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        verify=verify,
+    )
+
+
+def connect_web3(
+    provider_url: str,
+    metrics: RunMetrics,
+    max_rpc_in_flight: int = 16,
+    rpc_cache_path: str = DEFAULT_RPC_CACHE_PATH,
+):
+    # `provider_url` may list several comma-separated endpoints, requests are
+    # balanced between them, hedged and failed over. Each endpoint keeps a
+    # keep-alive pool large enough for the in-flight requests and their hedges.
+    # Retries are left to the adaptive concurrency middleware below
+    w3 = Web3(
+        RoutedHTTPProvider(
+            [url.strip() for url in provider_url.split(",") if url.strip()],
+            pool_size=2 * max_rpc_in_flight,
+        )
+    )
+    # Every call is pinned to a historical block, so responses are cached on
+    # disk and reused by reruns
+    install_rpc_cache(w3, RpcResponseCache(rpc_cache_path))
+    # Throttled and failed requests back off and are retried with jitter. All
+    # the snapshots of a run share this w3, the adaptive limit caps the load
+    # put on the provider
+    limiter = install_adaptive_rpc_concurrency(w3, max_rpc_in_flight)
+    install_rpc_metrics(w3, metrics, limiter)
+    if w3.is_connected():
+        logger.info("Successfully connected to provider")
+    else:
+        raise Exception("Could not connect to provider")
+    return w3
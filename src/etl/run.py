@@ -0,0 +1,147 @@
+"""Importable entry point running the snapshot ETL of one date"""
+
+from src.balances_collector.balances_collector_custom import (
+    AaveV3RawBalancesCollectorCustom,
+)
+from src.balances_collector.balances_replay import AaveV3BalancesReplay
+from src.emodes_collector.emode_map import UserEModeMap
+from src.etl.connections import BUCKET, connect_s3, connect_web3
+from src.etl.snapshot import (
+    BALANCES_REPLAY_PREFIX,
+    EMODE_MAP_PREFIX,
+    SnapshotResources,
+    checkpoint_store,
+    find_snapshot_blocks,
+    merge_snapshot_shards,
+    run_snapshot,
+    run_snapshot_shard,
+)
+from src.etl.streaming import STREAM_CHUNK_SIZE, run_snapshot_streaming
+from src.utils.block_finder_functions import (
+    DEFAULT_BLOCK_INDEX_PATH,
+    BlockTimestampIndex,
+)
+from src.utils.logs import logger
+from src.utils.metrics import RunMetrics, write_run_reports
+from src.utils.rpc_cache import DEFAULT_RPC_CACHE_PATH
+
+
+def run_snapshot_etl(
+    snapshot_date: str,
+    provider_url: str,
+    aws_access_key: str,
+    aws_secret_key: str,
+    bucket: str = BUCKET,
+    shard: tuple = None,
+    merge_shards: int = None,
+    incremental: bool = False,
+    streaming: bool = False,
+    stream_chunk_size: int = STREAM_CHUNK_SIZE,
+    output_format: str = "csv",
+    checkpoint_location: str = None,
+    emode_map_location: str = None,
+    balances_replay_location: str = None,
+    account_metrics_check: int = 0,
+    metrics_directory: str = "metrics",
+    max_rpc_in_flight: int = 16,
+    rpc_cache_path: str = DEFAULT_RPC_CACHE_PATH,
+    block_index_path: str = DEFAULT_BLOCK_INDEX_PATH,
+    client_s3=None,
+    w3=None,
+):
+    """
+    Collect the snapshot of `snapshot_date`: all its users, the users of
+    `shard` (shard index, shard count), or the merge of `merge_shards` shards.
+    With `streaming`, a full snapshot is collected by chunks of
+    `stream_chunk_size` users with bounded memory, see run_snapshot_streaming.
+    With `balances_replay_location`, the users balances are replayed from the
+    tokens logs, checkpointed there, see AaveV3BalancesReplay.
+    The account metrics of `account_metrics_check` sampled users are checked
+    with getUserAccountData calls. Return the output path, or the partial
+    output paths of a shard. The run metrics are written to
+    `metrics_directory` when it ends or fails.
+    `client_s3` and `w3` replace the default connections when given.
+    """
+    if streaming and (shard is not None or merge_shards is not None):
+        raise ValueError("Streaming only applies to full snapshots")
+    metrics = RunMetrics()
+    try:
+        logger.info("Starting ETL...")
+        if client_s3 is None:
+            client_s3 = connect_s3(aws_access_key, aws_secret_key)
+        if w3 is None:
+            w3 = connect_web3(provider_url, metrics, max_rpc_in_flight, rpc_cache_path)
+
+        with metrics.stage("snapshot_block", snapshot_date):
+            block_number = find_snapshot_blocks(
+                w3=w3,
+                snapshot_dates=[snapshot_date],
+                block_index=BlockTimestampIndex(w3.eth.chain_id, block_index_path),
+                verbose=True,
+            )[snapshot_date]
+
+        resources = SnapshotResources(w3=w3, client_s3=client_s3, bucket=bucket)
+        resources.max_rpc_in_flight = max_rpc_in_flight
+        resources.account_metrics_check = account_metrics_check
+        checkpoints = checkpoint_store(checkpoint_location, client_s3, bucket)
+        if emode_map_location is not None:
+            resources.emode_map = UserEModeMap(
+                checkpoint_store(
+                    emode_map_location, client_s3, bucket, EMODE_MAP_PREFIX
+                )
+            )
+        if balances_replay_location is not None:
+            resources.balances_replay = AaveV3BalancesReplay(
+                AaveV3RawBalancesCollectorCustom(w3=w3, pool_abi=resources.pool_abi),
+                checkpoint_store(
+                    balances_replay_location, client_s3, bucket, BALANCES_REPLAY_PREFIX
+                ),
+            )
+
+        if shard is not None:
+            output_path = run_snapshot_shard(
+                resources=resources,
+                snapshot_date=snapshot_date,
+                block_number=block_number,
+                shard_index=shard[0],
+                shard_count=shard[1],
+                output_format=output_format,
+                checkpoints=checkpoints,
+                metrics=metrics,
+            )
+        elif merge_shards is not None:
+            output_path = merge_snapshot_shards(
+                resources=resources,
+                snapshot_date=snapshot_date,
+                block_number=block_number,
+                shard_count=merge_shards,
+                incremental=incremental,
+                output_format=output_format,
+                metrics=metrics,
+            )
+        elif streaming:
+            output_path = run_snapshot_streaming(
+                resources=resources,
+                snapshot_date=snapshot_date,
+                block_number=block_number,
+                incremental=incremental,
+                output_format=output_format,
+                checkpoints=checkpoints,
+                metrics=metrics,
+                chunk_size=stream_chunk_size,
+            )
+        else:
+            output_path = run_snapshot(
+                resources=resources,
+                snapshot_date=snapshot_date,
+                block_number=block_number,
+                incremental=incremental,
+                output_format=output_format,
+                checkpoints=checkpoints,
+                metrics=metrics,
+            )
+        logger.info("Done!")
+        return output_path
+    finally:
+        if metrics_directory is not None:
+            write_run_reports(metrics, metrics_directory)
@@ -0,0 +1,688 @@
+"""Functions for running the users balances snapshot ETL of one date"""
+
+import concurrent.futures
+import hashlib
+import io
+import threading
+import pandas as pd
+from datetime import datetime, timedelta, timezone
+from src.balances_collector.account_metrics import (
+    compute_account_metrics,
+    cross_check_account_metrics,
+)
+from src.balances_collector.balances_collector import (
+    AaveV3RawBalancesCollector,
+    read_raw_balances_csv,
+)
+from src.balances_collector.reserves_snapshot import ReservesSnapshot
+from src.emodes_collector.emodes_collector import AaveV3EModesCollector
+from src.treasury.reserves_treasury import collect_reserves_treasury
+from src.utils.abis import load_abi
+from src.utils.block_finder_functions import find_closest_block
+from src.utils.checkpoints import (
+    CollectionCheckpoint,
+    LocalCheckpointStore,
+    S3CheckpointStore,
+)
+from src.utils.logs import logger
+from src.utils.metrics import RunMetrics
+from src.utils.s3_upload import S3MultipartWriter
+
+INPUT_PREFIX = "aave-raw-datasource/daily-decoded-events/decoded_events_snapshot_date="
+OUTPUT_PREFIX = "aave-raw-datasource/daily-users-balances/users_balances_snapshot_date="
+OUTPUT_NAMES = [
+    "active_users_balances",
+    "atoken_transfer_users_balances",
+    "reserves_data",
+    "active_users_emodes",
+    "emodes_configuration",
+    "active_users_account_metrics",
+]
+# Outputs of every snapshot, including the ones written before the account
+# metrics: a date with all of them is complete
+REQUIRED_OUTPUT_NAMES = OUTPUT_NAMES[:5]
+OUTPUT_FORMATS = ["csv", "parquet"]
+# Partial outputs of a shard, joined by merge_snapshot_shards
+SHARD_OUTPUT_NAMES = ["raw_balances", "active_users_emodes"]
+CHECKPOINT_PREFIX = "aave-raw-datasource/collection-checkpoints/"
+EMODE_MAP_PREFIX = "aave-raw-datasource/user-emodes/"
+BALANCES_REPLAY_PREFIX = "aave-raw-datasource/"
+CSV_CHUNK_SIZE = 100_000
+
+
+class SnapshotResources:
+    """Connections, ABIs and contract objects shared by the snapshots of a run."""
+
+    def __init__(self, w3, client_s3, bucket: str):
+        self.w3 = w3
+        self.client_s3 = client_s3
+        self.bucket = bucket
+
+        self.data_provider_abi = load_abi("ui_pool_data_provider")
+        self.pool_abi = load_abi("pool_abi")
+
+        # Filled by the first snapshot and reused by the following ones
+        self.data_provider_contract = None
+        self.pool_contract = None
+        # ReservesSnapshot by block, shared by the steps reading the reserves
+        self.reserves_snapshots = dict()
+        # UserEModeMap set by the caller to read the users emodes from logs
+        self.emode_map = None
+        # AaveV3BalancesReplay set by the caller to rebuild the users balances
+        # from the tokens logs instead of one getUserReservesData call per user
+        self.balances_replay = None
+        # Threads fanning out the per-user calls of the collectors, set by the
+        # caller to the maximum of the adaptive RPC limit of w3
+        self.max_rpc_in_flight = 16
+        # Users whose account metrics are checked with getUserAccountData calls,
+        # set by the caller
+        self.account_metrics_check = 0
+
+
+def snapshot_input_path(snapshot_date: str, filename: str) -> str:
+    return f"{INPUT_PREFIX}{snapshot_date}/{filename}"
+
+
+def snapshot_output_path(snapshot_date: str) -> str:
+    return f"{OUTPUT_PREFIX}{snapshot_date}/"
+
+
+def snapshot_target_timestamp(snapshot_date: str) -> float:
+    # A snapshot is taken at the last block of its day
+    snapshot_day = datetime.strptime(snapshot_date, "%Y-%m-%d").replace(
+        tzinfo=timezone.utc
+    )
+    return (snapshot_day + timedelta(days=1)).timestamp()
+
+
+def find_snapshot_blocks(
+    w3, snapshot_dates: list, block_index=None, verbose: bool = False
+) -> dict:
+    """Resolve the snapshot block of every date in one pass, latest date first."""
+    snapshot_blocks = dict()
+    upper_block = w3.eth.get_block_number()
+    for snapshot_date in sorted(snapshot_dates, reverse=True):
+        snapshot_blocks[snapshot_date] = find_closest_block(
+            w3=w3,
+            target_timestamp=snapshot_target_timestamp(snapshot_date),
+            initial_block=upper_block,
+            verbose=verbose,
+            block_index=block_index,
+        )
+        upper_block = snapshot_blocks[snapshot_date] + 1
+    return snapshot_blocks
+
+
+def checkpoint_store(
+    location: str, client_s3, bucket: str, prefix: str = CHECKPOINT_PREFIX
+):
+    """Checkpoints kept in `bucket` for location "s3", or in a local directory."""
+    if location is None:
+        return None
+    if location == "s3":
+        return S3CheckpointStore(client_s3, bucket, prefix)
+    return LocalCheckpointStore(location)
+
+
+def output_filenames(output_format: str = "csv", names: list = OUTPUT_NAMES) -> list:
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {output_format}")
+    return [f"{name}.{output_format}" for name in names]
+
+
+def snapshot_exists(
+    client_s3, bucket: str, snapshot_date: str, output_format: str = "csv"
+) -> bool:
+    output_path = snapshot_output_path(snapshot_date)
+    response = client_s3.list_objects_v2(Bucket=bucket, Prefix=output_path)
+    existing_keys = {content["Key"] for content in response.get("Contents", [])}
+    return all(
+        output_path + filename in existing_keys
+        for filename in output_filenames(output_format, REQUIRED_OUTPUT_NAMES)
+    )
+
+
+def upload_frame(
+    client_s3, bucket: str, key: str, frame: pd.DataFrame, output_format: str
+):
+    """Stream `frame` to S3 chunk by chunk, without a full in-memory copy."""
+    with S3MultipartWriter(client_s3, bucket, key) as writer:
+        if output_format == "parquet":
+            # pyarrow.parquet is only imported when Parquet outputs are written or read
+            from src.utils.parquet_output import write_parquet
+
+            write_parquet(frame, writer)
+        else:
+            for start in range(0, max(len(frame), 1), CSV_CHUNK_SIZE):
+                chunk = frame.iloc[start : start + CSV_CHUNK_SIZE]
+                writer.write(chunk.to_csv(index=False, header=start == 0))
+
+
+def read_frame(client_s3, bucket: str, key: str, output_format: str) -> pd.DataFrame:
+    object = client_s3.get_object(Bucket=bucket, Key=key)
+    if output_format == "parquet":
+        from src.utils.parquet_output import read_parquet
+
+        return read_parquet(io.BytesIO(object["Body"].read()))
+    return read_raw_balances_csv(object["Body"])
+
+
+def read_snapshot_balances(
+    client_s3, bucket: str, snapshot_date: str, output_format: str = "csv"
+) -> pd.DataFrame:
+    key = snapshot_output_path(snapshot_date) + f"active_users_balances.{output_format}"
+    return read_frame(client_s3, bucket, key, output_format)
+
+
+def read_snapshot_emodes(
+    client_s3, bucket: str, snapshot_date: str, output_format: str = "csv"
+) -> dict:
+    """Emode by user address of a snapshot, empty without an emodes output."""
+    key = snapshot_output_path(snapshot_date) + f"active_users_emodes.{output_format}"
+    try:
+        users_emodes = read_frame(client_s3, bucket, key, output_format)
+    except client_s3.exceptions.NoSuchKey:
+        return dict()
+    return dict(zip(users_emodes.active_user_address, users_emodes.emode))
+
+
+def parse_shard(shard: str) -> tuple:
+    """Parse a "i/N" shard specification into (i, N), with 0 <= i < N."""
+    shard_index, shard_count = (int(part) for part in shard.split("/"))
+    if not 0 <= shard_index < shard_count:
+        raise ValueError(f"Invalid shard {shard}, expected i/N with 0 <= i < N")
+    return shard_index, shard_count
+
+
+def address_shard(address: str, shard_count: int) -> int:
+    # Stable across processes and nodes, unlike the builtin hash
+    digest = hashlib.blake2b(address.lower().encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % shard_count
+
+
+def shard_users(users: pd.DataFrame, shard_index: int, shard_count: int):
+    shards = users.active_user_address.map(
+        lambda address: address_shard(address, shard_count)
+    )
+    return users[shards == shard_index].reset_index(drop=True)
+
+
+def shard_output_path(
+    snapshot_date: str, name: str, shard_index: int, shard_count: int, output_format
+) -> str:
+    return (
+        f"{snapshot_output_path(snapshot_date)}shards/"
+        f"{name}-{shard_index:03d}-of-{shard_count:03d}.{output_format}"
+    )
+
+
+def read_snapshot_users(client_s3, bucket: str, snapshot_date: str) -> tuple:
+    """Pool users, atoken transfers users and the distinct users of both lists."""
+    object = client_s3.get_object(
+        Bucket=bucket, Key=snapshot_input_path(snapshot_date, "all_active_users.csv")
+    )
+    pool_users_data = pd.read_csv(object["Body"])
+
+    object = client_s3.get_object(
+        Bucket=bucket,
+        Key=snapshot_input_path(snapshot_date, "all_atoken_transfer_users.csv"),
+    )
+    atoken_users_data = pd.read_csv(object["Body"])
+
+    # Each distinct address is collected once, the per-list outputs are filtered
+    # from the shared result
+    all_users = (
+        pd.concat((pool_users_data, atoken_users_data))
+        .drop_duplicates(subset="active_user_address")
+        .reset_index(drop=True)
+    )
+    return pool_users_data, atoken_users_data, all_users
+
+
+class SnapshotRunLog:
+    """Prefixed log lines and per-stage metrics of one snapshot run."""
+
+    def __init__(self, snapshot_date: str, prefix: str, metrics: RunMetrics = None):
+        self.snapshot_date = snapshot_date
+        self.prefix = prefix
+        self.metrics = metrics or RunMetrics()
+
+    def __call__(self, message: str):
+        logger.info(f"[{self.prefix}] {message}")
+
+    def step(self, message: str, stage: str):
+        self(message)
+        return self.metrics.stage(stage, self.snapshot_date)
+
+    def rows(self, output: str, frame: pd.DataFrame):
+        self.metrics.record_rows(output, len(frame))
+
+
+def reserves_snapshot(resources: SnapshotResources, block_number: int):
+    if block_number not in resources.reserves_snapshots:
+        resources.reserves_snapshots[block_number] = ReservesSnapshot(
+            resources.w3,
+            block_number,
+            data_provider_contract=resources.data_provider_contract,
+            pool_contract=resources.pool_contract,
+        )
+    return resources.reserves_snapshots[block_number]
+
+
+def users_account_metrics(
+    resources: SnapshotResources,
+    block_number: int,
+    processed_balances: pd.DataFrame,
+    users_emodes: pd.DataFrame,
+    emodes_configuration: pd.DataFrame,
+) -> pd.DataFrame:
+    return compute_account_metrics(
+        processed_balances,
+        users_emodes,
+        emodes_configuration,
+        reserves_snapshot(resources, block_number).reserves_ids(),
+        block_number,
+    )
+
+
+def check_account_metrics(
+    resources: SnapshotResources, block_number: int, account_metrics: pd.DataFrame
+):
+    if resources.account_metrics_check:
+        cross_check_account_metrics(
+            resources.w3,
+            resources.pool_contract,
+            account_metrics,
+            block_number,
+            reserves_snapshot(resources, block_number).currency_unit,
+            resources.account_metrics_check,
+        )
+
+
+# The replay holds the positions of one block, shared by the chunks of users
+_balances_replay_lock = threading.Lock()
+
+
+def replayed_raw_balances(balances_replay, block_number: int, users: pd.DataFrame):
+    """
+    Raw balances of `users` replayed up to `block_number`. The first chunk of
+    users of a block replays the logs and cross-checks a sample of its users
+    with scaledBalanceOf calls.
+    """
+    users_addresses = users.active_user_address.tolist()
+    with _balances_replay_lock:
+        if (
+            balances_replay.last_block != block_number
+            or balances_replay.collector.all_users_positions.empty
+        ):
+            balances_replay.collect_users_positions(block_number)
+            balances_replay.cross_check(users_addresses)
+        return balances_replay.users_raw_balances(users_addresses)
+
+
+def _collectors(resources: SnapshotResources, block_number: int) -> tuple:
+    collector = AaveV3RawBalancesCollector(
+        w3=resources.w3,
+        contract_abi=resources.data_provider_abi,
+        block_number=block_number,
+        contract=resources.data_provider_contract,
+        max_workers=resources.max_rpc_in_flight,
+    )
+    resources.data_provider_contract = collector.data_provider_contract
+    emodes_collector = AaveV3EModesCollector(
+        w3=resources.w3,
+        pool_abi=resources.pool_abi,
+        block_number=block_number,
+        contract=resources.pool_contract,
+        max_workers=resources.max_rpc_in_flight,
+    )
+    resources.pool_contract = emodes_collector.pool_contract
+    return collector, emodes_collector
+
+
+def _collect_users(
+    collector: AaveV3RawBalancesCollector,
+    emodes_collector: AaveV3EModesCollector,
+    users: pd.DataFrame,
+    checkpoint_key: str,
+    checkpoints,
+    log: SnapshotRunLog,
+    emode_map=None,
+    balances_replay=None,
+):
+    with log.step("STEP 1: Collecting users balances...", "users_balances"):
+        if balances_replay is not None:
+            collector.set_raw_balances(
+                replayed_raw_balances(balances_replay, collector.block_number, users)
+            )
+        elif checkpoints is not None:
+            # Chunks committed by a previous run of the same block are not collected
+            collector.collect_raw_balances_checkpointed(
+                users, CollectionCheckpoint(checkpoints, checkpoint_key)
+            )
+        else:
+            collector.collect_raw_balances(users)
+        # Failed users are collected again at the end rather than dropped
+        collector.redrive_failed_users()
+        log.rows("raw_balances", collector.raw_balances)
+
+    with log.step("STEP 2: Collecting users emodes...", "users_emodes"):
+        if emode_map is not None:
+            emodes_collector.collect_emodes_from_logs(users, emode_map)
+        else:
+            emodes_collector.collect_emodes(users)
+        log.rows("active_users_emodes", emodes_collector.active_users_emodes)
+
+
+def _publish_snapshot(
+    resources: SnapshotResources,
+    snapshot_date: str,
+    block_number: int,
+    collector: AaveV3RawBalancesCollector,
+    emodes_collector: AaveV3EModesCollector,
+    users_lists: tuple,
+    incremental: bool,
+    output_format: str,
+    log: SnapshotRunLog,
+) -> str:
+    """
+    Steps shared by a full snapshot and the merge of its shards, once the raw
+    balances and users emodes are collected.
+    """
+    client_s3, bucket = resources.client_s3, resources.bucket
+    pool_users_data, atoken_users_data, all_users = users_lists
+    output_path = snapshot_output_path(snapshot_date)
+    previous_snapshot_date = (
+        datetime.strptime(snapshot_date, "%Y-%m-%d") - timedelta(days=1)
+    ).strftime("%Y-%m-%d")
+
+    previous_balances = None
+    if incremental:
+        with log.step("   --> Loading previous snapshot balances...", "carry_forward"):
+            try:
+                previous_balances = read_snapshot_balances(
+                    client_s3, bucket, previous_snapshot_date, output_format
+                )
+                collector.carry_forward_raw_balances(previous_balances, all_users)
+                log.rows("raw_balances", collector.raw_balances)
+                # Their emodes too, for the account metrics
+                carried_forward_users = previous_balances.user_address[
+                    ~previous_balances.user_address.isin(all_users.active_user_address)
+                ].unique()
+                previous_emodes = (
+                    read_snapshot_emodes(
+                        client_s3, bucket, previous_snapshot_date, output_format
+                    )
+                    if resources.emode_map is None
+                    else dict()
+                )
+                carried_forward_emodes = emodes_collector.carried_forward_emodes(
+                    carried_forward_users.tolist(), previous_emodes, resources.emode_map
+                )
+                emodes_collector.active_users_emodes = pd.concat(
+                    (emodes_collector.active_users_emodes, carried_forward_emodes),
+                    ignore_index=True,
+                )
+                log.rows("active_users_emodes", emodes_collector.active_users_emodes)
+            except client_s3.exceptions.NoSuchKey:
+                log(
+                    f"   --> No previous snapshot for {previous_snapshot_date}, "
+                    "full mode"
+                )
+
+    with log.step("STEP 3: Collecting reserves data...", "reserves_data"):
+        collector.collect_reserves_data(reserves_snapshot(resources, block_number))
+        log.rows("reserves_data", collector.reserves_data)
+
+    with log.step("STEP 4: Processing users balances...", "process_balances"):
+        collector.process_raw_balances()
+
+        snapshot_users = pool_users_data.active_user_address
+        if previous_balances is not None:
+            snapshot_users = pd.concat((snapshot_users, previous_balances.user_address))
+        pool_users_balances = collector.processed_balances[
+            collector.processed_balances.user_address.isin(snapshot_users)
+        ]
+        atoken_users_balances = collector.processed_balances[
+            collector.processed_balances.user_address.isin(
+                atoken_users_data.active_user_address
+            )
+        ]
+        log.rows("active_users_balances", pool_users_balances)
+        log.rows("atoken_transfer_users_balances", atoken_users_balances)
+
+    with log.step(
+        "STEP 5: Collecting and matching reserves treasury with reserves data...",
+        "reserves_treasury",
+    ):
+        reserves_data = collect_reserves_treasury(
+            w3=resources.w3,
+            reserves_data=collector.reserves_data,
+            block_number=block_number,
+            treasury_balances=reserves_snapshot(
+                resources, block_number
+            ).treasury_balances,
+        )
+
+    with log.step("   --> Collecting emodes configuration", "emodes_configuration"):
+        emodes_collector.collect_emodes_configuration()
+        log.rows("emodes_configuration", emodes_collector.emodes_caracteristics)
+
+    with log.step("STEP 6: Computing users account metrics...", "account_metrics"):
+        account_metrics = users_account_metrics(
+            resources,
+            block_number,
+            collector.processed_balances,
+            emodes_collector.active_users_emodes,
+            emodes_collector.emodes_caracteristics,
+        )
+        check_account_metrics(resources, block_number, account_metrics)
+        log.rows("active_users_account_metrics", account_metrics)
+
+    outputs = [
+        ("Pool users balances", pool_users_balances),
+        ("AToken transfers users balances", atoken_users_balances),
+        ("Reserves data", reserves_data),
+        ("Active users emodes", emodes_collector.active_users_emodes),
+        ("Emodes configuration", emodes_collector.emodes_caracteristics),
+        ("Users account metrics", account_metrics),
+    ]
+
+    def upload_output(output, filename):
+        description, data = output
+        upload_frame(client_s3, bucket, output_path + filename, data, output_format)
+        log(f"   --> {description}")
+
+    with log.step("STEP 7: Uploading outputs to s3...", "upload_outputs"):
+        # The uploads are independent and mostly wait on the network
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=len(outputs)
+        ) as executor:
+            list(executor.map(upload_output, outputs, output_filenames(output_format)))
+
+    log(f"   --> Outputs successfully generated at: {output_path}")
+    return output_path
+
+
+def run_snapshot(
+    resources: SnapshotResources,
+    snapshot_date: str,
+    block_number: int,
+    incremental: bool = False,
+    output_format: str = "csv",
+    checkpoints=None,
+    metrics: RunMetrics = None,
+) -> str:
+    log = SnapshotRunLog(snapshot_date, snapshot_date, metrics)
+
+    log(f"Date = {snapshot_date}, Snapshot block = {block_number}")
+
+    with log.step(
+        "STEP 0: Extracting pool and atoken transfers users lists...", "users_lists"
+    ):
+        users_lists = read_snapshot_users(
+            resources.client_s3, resources.bucket, snapshot_date
+        )
+        pool_users_data, atoken_users_data, all_users = users_lists
+        log.rows("distinct_users", all_users)
+    log(
+        f"   --> {len(all_users)} distinct users "
+        f"({len(pool_users_data)} pool users, {len(atoken_users_data)} atoken users)"
+    )
+
+    collector, emodes_collector = _collectors(resources, block_number)
+    _collect_users(
+        collector,
+        emodes_collector,
+        all_users,
+        f"raw_balances/block={block_number}",
+        checkpoints,
+        log,
+        resources.emode_map,
+        resources.balances_replay,
+    )
+    return _publish_snapshot(
+        resources,
+        snapshot_date,
+        block_number,
+        collector,
+        emodes_collector,
+        users_lists,
+        incremental,
+        output_format,
+        log,
+    )
+
+
+def run_snapshot_shard(
+    resources: SnapshotResources,
+    snapshot_date: str,
+    block_number: int,
+    shard_index: int,
+    shard_count: int,
+    output_format: str = "csv",
+    checkpoints=None,
+    metrics: RunMetrics = None,
+) -> list:
+    """
+    Collect the raw balances and emodes of the users of one shard, and upload
+    them as partial files for merge_snapshot_shards.
+    """
+    client_s3, bucket = resources.client_s3, resources.bucket
+    log = SnapshotRunLog(
+        snapshot_date, f"{snapshot_date} {shard_index}/{shard_count}", metrics
+    )
+
+    log(f"Date = {snapshot_date}, Snapshot block = {block_number}")
+
+    with log.step(
+        "STEP 0: Extracting pool and atoken transfers users lists...", "users_lists"
+    ):
+        _, _, all_users = read_snapshot_users(client_s3, bucket, snapshot_date)
+        users = shard_users(all_users, shard_index, shard_count)
+        log.rows("distinct_users", users)
+    log(f"   --> {len(users)} of {len(all_users)} distinct users in shard")
+
+    collector, emodes_collector = _collectors(resources, block_number)
+    _collect_users(
+        collector,
+        emodes_collector,
+        users,
+        f"raw_balances/block={block_number}/shard={shard_index}-of-{shard_count}",
+        checkpoints,
+        log,
+        resources.emode_map,
+        resources.balances_replay,
+    )
+
+    partial_paths = list()
+    partial_outputs = [
+        collector.all_users_balances,
+        emodes_collector.active_users_emodes,
+    ]
+    with log.step("STEP 3: Uploading partial outputs to s3...", "upload_outputs"):
+        for name, data in zip(SHARD_OUTPUT_NAMES, partial_outputs):
+            path = shard_output_path(
+                snapshot_date, name, shard_index, shard_count, output_format
+            )
+            upload_frame(client_s3, bucket, path, data, output_format)
+            partial_paths.append(path)
+            log(f"   --> {path}")
+    return partial_paths
+
+
+def merge_snapshot_shards(
+    resources: SnapshotResources,
+    snapshot_date: str,
+    block_number: int,
+    shard_count: int,
+    incremental: bool = False,
+    output_format: str = "csv",
+    metrics: RunMetrics = None,
+) -> str:
+    """
+    Join the partial files of the `shard_count` shards of a snapshot with the
+    reserves data, treasury and emodes configuration into the final outputs.
+    """
+    client_s3, bucket = resources.client_s3, resources.bucket
+    log = SnapshotRunLog(snapshot_date, f"{snapshot_date} merge", metrics)
+
+    log(f"Date = {snapshot_date}, Snapshot block = {block_number}")
+
+    with log.step(
+        "STEP 0: Extracting pool and atoken transfers users lists...", "users_lists"
+    ):
+        users_lists = read_snapshot_users(client_s3, bucket, snapshot_date)
+        log.rows("distinct_users", users_lists[2])
+
+    paths = {
+        name: [
+            shard_output_path(
+                snapshot_date, name, shard_index, shard_count, output_format
+            )
+            for shard_index in range(shard_count)
+        ]
+        for name in SHARD_OUTPUT_NAMES
+    }
+
+    def read_partials(name: str) -> pd.DataFrame:
+        return pd.concat(
+            [
+                read_frame(client_s3, bucket, path, output_format)
+                for path in paths[name]
+            ],
+            ignore_index=True,
+        )
+
+    collector, emodes_collector = _collectors(resources, block_number)
+    with log.step("STEP 1: Reading the shards partial outputs...", "read_shards"):
+        response = client_s3.list_objects_v2(
+            Bucket=bucket, Prefix=snapshot_output_path(snapshot_date) + "shards/"
+        )
+        existing_keys = {content["Key"] for content in response.get("Contents", [])}
+        missing_paths = [
+            path for name in paths for path in paths[name] if path not in existing_keys
+        ]
+        if missing_paths:
+            raise Exception(f"Missing shards partial outputs: {missing_paths}")
+
+        collector.set_raw_balances(read_partials("raw_balances"))
+        emodes_collector.active_users_emodes = read_partials("active_users_emodes")
+        log.rows("raw_balances", collector.raw_balances)
+        log.rows("active_users_emodes", emodes_collector.active_users_emodes)
+    log(
+        f"   --> {collector.raw_balances.users_count()} users with "
+        f"balances from {shard_count} shards"
+    )
+
+    return _publish_snapshot(
+        resources,
+        snapshot_date,
+        block_number,
+        collector,
+        emodes_collector,
+        users_lists,
+        incremental,
+        output_format,
+        log,
+    )
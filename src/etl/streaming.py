@@ -0,0 +1,458 @@
+"""Bounded-memory snapshot run, streaming the users lists to the outputs by chunks"""
+
+import collections
+import concurrent.futures
+import contextlib
+import contextvars
+import io
+from datetime import datetime, timedelta
+
+import numpy as np
+import pandas as pd
+from src.balances_collector.balances_collector import (
+    USER_RESERVE_COLUMNS,
+    read_raw_balances_csv,
+)
+from src.etl.snapshot import (
+    SnapshotResources,
+    SnapshotRunLog,
+    _collect_users,
+    _collectors,
+    check_account_metrics,
+    output_filenames,
+    reserves_snapshot,
+    snapshot_input_path,
+    snapshot_output_path,
+    upload_frame,
+    users_account_metrics,
+)
+from src.treasury.reserves_treasury import collect_reserves_treasury
+from src.utils.metrics import RunMetrics
+from src.utils.s3_upload import S3MultipartWriter
+
+STREAM_CHUNK_SIZE = 10_000
+
+
+class OutputStream:
+    """One output file of a snapshot, appended chunk by chunk to S3."""
+
+    def __init__(self, client_s3, bucket: str, key: str, output_format: str):
+        self.writer = S3MultipartWriter(client_s3, bucket, key)
+        self.output_format = output_format
+        self.chunks = 0
+        if output_format == "parquet":
+            # pyarrow.parquet is only imported when Parquet outputs are written
+            from src.utils.parquet_output import ParquetChunkWriter
+
+            self.parquet_writer = ParquetChunkWriter(self.writer)
+
+    def write(self, frame: pd.DataFrame):
+        if self.output_format == "parquet":
+            self.parquet_writer.write(frame)
+        else:
+            # The header is written once, even when the first chunk is empty
+            self.writer.write(frame.to_csv(index=False, header=self.chunks == 0))
+        self.chunks += 1
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None and self.output_format == "parquet":
+            self.parquet_writer.close()
+        self.writer.__exit__(exc_type, exc_value, traceback)
+
+
+def _in_set(values, addresses: set) -> np.ndarray:
+    # Boolean mask, without converting the whole set as isin would for each chunk
+    return np.fromiter((value in addresses for value in values), bool, len(values))
+
+
+def iter_csv_chunks(client_s3, bucket: str, key: str, chunk_size: int, **options):
+    object = client_s3.get_object(Bucket=bucket, Key=key)
+    yield from pd.read_csv(object["Body"], chunksize=chunk_size, **options)
+
+
+def iter_output_chunks(
+    client_s3, bucket: str, key: str, output_format: str, chunk_size: int
+):
+    """Chunks of a previous snapshot output, without reading it all as a frame."""
+    object = client_s3.get_object(Bucket=bucket, Key=key)
+    if output_format == "parquet":
+        from src.utils.parquet_output import iter_parquet
+
+        # Parquet readers need a seekable file, the compressed file is buffered
+        yield from iter_parquet(io.BytesIO(object["Body"].read()), chunk_size)
+    else:
+        yield from read_raw_balances_csv(object["Body"], chunksize=chunk_size)
+
+
+def _previous_users(
+    client_s3, bucket: str, key: str, output_format: str, chunk_size: int
+) -> set:
+    if output_format == "parquet":
+        return {
+            user
+            for chunk in iter_output_chunks(
+                client_s3, bucket, key, output_format, chunk_size
+            )
+            for user in chunk.user_address
+        }
+    return {
+        user
+        for chunk in iter_csv_chunks(
+            client_s3, bucket, key, chunk_size, usecols=["user_address"]
+        )
+        for user in chunk.user_address
+    }
+
+
+def _previous_emodes(
+    client_s3,
+    bucket: str,
+    snapshot_date: str,
+    output_format: str,
+    chunk_size: int,
+    users: set,
+) -> dict:
+    """Emode by address of `users` in a snapshot, empty without an emodes output."""
+    key = snapshot_output_path(snapshot_date) + f"active_users_emodes.{output_format}"
+    try:
+        return {
+            user_address: emode
+            for chunk in iter_output_chunks(
+                client_s3, bucket, key, output_format, chunk_size
+            )
+            for user_address, emode in zip(chunk.active_user_address, chunk.emode)
+            if user_address in users
+        }
+    except client_s3.exceptions.NoSuchKey:
+        return dict()
+
+
+def _whole_users_chunks(chunks):
+    """
+    Chunks of balances never splitting the rows of a user, contiguous in the
+    outputs, so that the account metrics of each chunk are complete.
+    """
+    remainder = None
+    for chunk in chunks:
+        if remainder is not None:
+            chunk = pd.concat((remainder, chunk), ignore_index=True)
+        if len(chunk) == 0:
+            continue
+        last_user = chunk.user_address.to_numpy() == chunk.user_address.iloc[-1]
+        remainder = chunk[last_user]
+        if not last_user.all():
+            yield chunk[~last_user]
+    if remainder is not None and len(remainder) > 0:
+        yield remainder
+
+
+def _collect_users_chunk(
+    resources: SnapshotResources,
+    block_number: int,
+    reserves_data: pd.DataFrame,
+    users: pd.DataFrame,
+    index: int,
+    checkpoints,
+    log: SnapshotRunLog,
+) -> tuple:
+    """Processed balances and emodes of one chunk of users."""
+    chunk_log = SnapshotRunLog(
+        log.snapshot_date, f"{log.prefix} chunk {index}", log.metrics
+    )
+    collector, emodes_collector = _collectors(resources, block_number)
+    _collect_users(
+        collector,
+        emodes_collector,
+        users,
+        f"raw_balances/block={block_number}/stream-chunk={index:05d}",
+        checkpoints,
+        chunk_log,
+        resources.emode_map,
+        resources.balances_replay,
+    )
+    with chunk_log.step("STEP 3: Processing chunk balances...", "process_balances"):
+        # Reserves data is shared by all the chunks, process_raw_balances copies it
+        collector.reserves_data = reserves_data
+        collector.process_raw_balances()
+    return collector.processed_balances, emodes_collector.active_users_emodes
+
+
+def run_snapshot_streaming(
+    resources: SnapshotResources,
+    snapshot_date: str,
+    block_number: int,
+    incremental: bool = False,
+    output_format: str = "csv",
+    checkpoints=None,
+    metrics: RunMetrics = None,
+    chunk_size: int = STREAM_CHUNK_SIZE,
+    max_chunks_in_flight: int = 4,
+) -> str:
+    """
+    Same outputs as run_snapshot, with memory bounded by the chunk size instead
+    of the users count. The users lists are read from S3 by chunks of
+    `chunk_size` rows, collected by at most `max_chunks_in_flight` workers,
+    processed and appended to the multipart outputs in the order of the lists.
+    Only the sets of users addresses are kept for the whole run, to drop the
+    duplicates between the lists and split the balances between the outputs.
+    """
+    client_s3, bucket = resources.client_s3, resources.bucket
+    log = SnapshotRunLog(snapshot_date, snapshot_date, metrics)
+    output_path = snapshot_output_path(snapshot_date)
+    (
+        pool_balances_filename,
+        atoken_balances_filename,
+        reserves_data_filename,
+        users_emodes_filename,
+        emodes_configuration_filename,
+        account_metrics_filename,
+    ) = output_filenames(output_format)
+    pool_users_key = snapshot_input_path(snapshot_date, "all_active_users.csv")
+    atoken_users_key = snapshot_input_path(
+        snapshot_date, "all_atoken_transfer_users.csv"
+    )
+
+    log(f"Date = {snapshot_date}, Snapshot block = {block_number} (streaming)")
+
+    collector, emodes_collector = _collectors(resources, block_number)
+    with log.step("STEP 0: Collecting reserves data...", "reserves_data"):
+        collector.collect_reserves_data(reserves_snapshot(resources, block_number))
+        log.rows("reserves_data", collector.reserves_data)
+
+    with log.step("STEP 1: Reading atoken transfers users...", "users_lists"):
+        atoken_users = {
+            user
+            for chunk in iter_csv_chunks(
+                client_s3, bucket, atoken_users_key, chunk_size
+            )
+            for user in chunk.active_user_address
+        }
+
+    previous_users = set()
+    previous_balances_key = None
+    if incremental:
+        previous_snapshot_date = (
+            datetime.strptime(snapshot_date, "%Y-%m-%d") - timedelta(days=1)
+        ).strftime("%Y-%m-%d")
+        with log.step("   --> Reading previous snapshot users...", "carry_forward"):
+            key = (
+                snapshot_output_path(previous_snapshot_date)
+                + f"active_users_balances.{output_format}"
+            )
+            try:
+                previous_users = _previous_users(
+                    client_s3, bucket, key, output_format, chunk_size
+                )
+                previous_balances_key = key
+            except client_s3.exceptions.NoSuchKey:
+                log(
+                    f"   --> No previous snapshot for {previous_snapshot_date}, "
+                    "full mode"
+                )
+
+    # Each distinct address is collected once, in its first list
+    seen_users = set()
+
+    def users_chunks():
+        for key, in_pool_list in [(pool_users_key, True), (atoken_users_key, False)]:
+            for chunk in iter_csv_chunks(client_s3, bucket, key, chunk_size):
+                chunk = chunk.drop_duplicates(subset="active_user_address")
+                chunk = chunk[
+                    ~_in_set(chunk.active_user_address, seen_users)
+                ].reset_index(drop=True)
+                seen_users.update(chunk.active_user_address)
+                if len(chunk) > 0:
+                    yield chunk, in_pool_list
+
+    # Emodes configurations collected at the first appearance of their id, in
+    # the order of run_snapshot
+    emodes_configurations = list()
+    emodes_ids = set()
+
+    def emodes_configuration() -> pd.DataFrame:
+        if not emodes_configurations:
+            return emodes_collector.collect_emodes_configuration([])
+        return pd.concat(emodes_configurations)
+
+    # Account metrics of the users with the lowest random keys, a uniform sample
+    # of the whole run for the getUserAccountData check
+    sample_keys = np.random.default_rng(block_number)
+    account_metrics_sample = None
+    with contextlib.ExitStack() as stack:
+        pool_output, atoken_output, emodes_output, account_metrics_output = (
+            stack.enter_context(
+                OutputStream(client_s3, bucket, output_path + filename, output_format)
+            )
+            for filename in [
+                pool_balances_filename,
+                atoken_balances_filename,
+                users_emodes_filename,
+                account_metrics_filename,
+            ]
+        )
+
+        def write_emodes_and_metrics(
+            processed_balances: pd.DataFrame, users_emodes: pd.DataFrame
+        ):
+            nonlocal account_metrics_sample
+            emodes_output.write(users_emodes)
+            new_emodes_ids = [
+                emode_id
+                for emode_id in users_emodes.emode.unique().tolist()
+                if emode_id not in emodes_ids
+            ]
+            if new_emodes_ids:
+                emodes_ids.update(new_emodes_ids)
+                emodes_configurations.append(
+                    emodes_collector.collect_emodes_configuration(new_emodes_ids)
+                )
+            account_metrics = users_account_metrics(
+                resources,
+                block_number,
+                processed_balances,
+                users_emodes,
+                emodes_configuration(),
+            )
+            account_metrics_output.write(account_metrics)
+            if resources.account_metrics_check:
+                candidates = account_metrics.assign(
+                    sample_key=sample_keys.random(len(account_metrics))
+                )
+                if account_metrics_sample is not None:
+                    candidates = pd.concat((account_metrics_sample, candidates))
+                account_metrics_sample = candidates.nsmallest(
+                    resources.account_metrics_check, "sample_key"
+                )
+            log.rows("active_users_emodes", users_emodes)
+            log.rows("active_users_account_metrics", account_metrics)
+
+        def write_chunk(future, in_pool_list: bool):
+            processed_balances, users_emodes = future.result()
+            users = processed_balances.user_address
+            pool_balances = (
+                processed_balances
+                if in_pool_list
+                else processed_balances[_in_set(users, previous_users)]
+            )
+            atoken_balances = processed_balances[_in_set(users, atoken_users)]
+            pool_output.write(pool_balances)
+            atoken_output.write(atoken_balances)
+            log.rows("active_users_balances", pool_balances)
+            log.rows("atoken_transfer_users_balances", atoken_balances)
+            write_emodes_and_metrics(processed_balances, users_emodes)
+
+        with log.step("STEP 2: Streaming users chunks...", "stream_users"):
+            pending = collections.deque()
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=max_chunks_in_flight
+            ) as executor:
+                for index, (users, in_pool_list) in enumerate(users_chunks()):
+                    # Chunks are written in order, the oldest one is awaited
+                    # before reading a new chunk once the workers are all busy
+                    if len(pending) >= max_chunks_in_flight:
+                        write_chunk(*pending.popleft())
+                    # Chunk workers keep the stage of this step in their metrics
+                    future = executor.submit(
+                        contextvars.copy_context().run,
+                        _collect_users_chunk,
+                        resources,
+                        block_number,
+                        collector.reserves_data,
+                        users,
+                        index,
+                        checkpoints,
+                        log,
+                    )
+                    pending.append((future, in_pool_list))
+                while pending:
+                    write_chunk(*pending.popleft())
+            log(f"   --> {len(seen_users)} distinct users")
+            log.metrics.record_rows("distinct_users", len(seen_users))
+
+        if previous_balances_key is not None:
+            with log.step(
+                "   --> Carrying forward previous snapshot balances...",
+                "carry_forward",
+            ):
+                previous_emodes = (
+                    _previous_emodes(
+                        client_s3,
+                        bucket,
+                        previous_snapshot_date,
+                        output_format,
+                        chunk_size,
+                        previous_users - seen_users,
+                    )
+                    if resources.emode_map is None
+                    else dict()
+                )
+                carried_forward_users = set()
+                for chunk in _whole_users_chunks(
+                    iter_output_chunks(
+                        client_s3,
+                        bucket,
+                        previous_balances_key,
+                        output_format,
+                        chunk_size,
+                    )
+                ):
+                    # Scaled balances are unchanged, re-valued at this block
+                    chunk = chunk.loc[
+                        ~_in_set(chunk.user_address, seen_users),
+                        USER_RESERVE_COLUMNS + ["user_address"],
+                    ].copy()
+                    carried_forward_users.update(chunk.user_address)
+                    collector.set_raw_balances(chunk)
+                    pool_balances = collector.process_raw_balances()
+                    pool_output.write(pool_balances)
+                    log.rows("active_users_balances", pool_balances)
+                    write_emodes_and_metrics(
+                        pool_balances,
+                        emodes_collector.carried_forward_emodes(
+                            chunk.user_address.unique().tolist(),
+                            previous_emodes,
+                            resources.emode_map,
+                        ),
+                    )
+                log(
+                    f"   --> Carried forward {len(carried_forward_users)} inactive "
+                    "users from the previous snapshot"
+                )
+
+    with log.step(
+        "STEP 4: Collecting and matching reserves treasury with reserves data...",
+        "reserves_treasury",
+    ):
+        reserves_data = collect_reserves_treasury(
+            w3=resources.w3,
+            reserves_data=collector.reserves_data,
+            block_number=block_number,
+            treasury_balances=reserves_snapshot(
+                resources, block_number
+            ).treasury_balances,
+        )
+
+    with log.step("   --> Collecting emodes configuration", "emodes_configuration"):
+        emodes_collector.emodes_caracteristics = emodes_configuration()
+        log.rows("emodes_configuration", emodes_collector.emodes_caracteristics)
+
+    if account_metrics_sample is not None:
+        with log.step("   --> Checking users account metrics...", "account_metrics"):
+            check_account_metrics(
+                resources,
+                block_number,
+                account_metrics_sample.drop(columns="sample_key"),
+            )
+
+    with log.step("STEP 5: Uploading outputs to s3...", "upload_outputs"):
+        for filename, data in [
+            (reserves_data_filename, reserves_data),
+            (emodes_configuration_filename, emodes_collector.emodes_caracteristics),
+        ]:
+            upload_frame(client_s3, bucket, output_path + filename, data, output_format)
+
+    log(f"   --> Outputs successfully generated at: {output_path}")
+    return output_path
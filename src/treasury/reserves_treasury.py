@@ -1,17 +1,40 @@
 """Functions for extracting reserves' treasury"""
 
-import json
 import pandas as pd
 from pandas import DataFrame
-
-
-with open("src/abi/atoken_abi.json") as file:
-    atoken_abi = json.load(file)
+from src.utils.abis import get_contract
+from src.utils.logs import logger
 
 
 def collect_reserves_treasury(
-    w3, reserves_data: DataFrame, block_number: int = "latest"
+    w3,
+    reserves_data: DataFrame,
+    block_number: int = "latest",
+    atoken_contracts: dict = None,
+    treasury_balances: dict = None,
 ) -> DataFrame:
+    # Balances by underlying asset, read from a ReservesSnapshot of the block
+    if treasury_balances is not None:
+        reserves_data["treasury_balance"] = reserves_data.underlyingAsset.map(
+            treasury_balances
+        )
+    else:
+        collect_treasury_balances(w3, reserves_data, block_number, atoken_contracts)
+    reserves_data["treasury_balance_usd"] = (
+        reserves_data.treasury_balance
+        / 10**reserves_data.decimals
+        * reserves_data.underlyingTokenPriceUSD
+    )
+    return reserves_data
+
+
+def collect_treasury_balances(
+    w3, reserves_data: DataFrame, block_number, atoken_contracts: dict = None
+):
+    # Contracts are cached by address in `atoken_contracts` when it is given,
+    # and once per process otherwise
+    if atoken_contracts is None:
+        atoken_contracts = dict()
     reserves_data["treasury_balance"] = None
     treasury_collector_address = "0x464C71f6c2F760DdA6093dCB91C24c39e5d6e18c"
     for index, row in reserves_data.iterrows():
@@ -20,15 +43,15 @@ def collect_reserves_treasury(
             atoken_address = row["underlyingAsset"]
         else:
             atoken_address = row["aTokenAddress"]
-        print(f"      --> Collecting treasury balance for reserve: {reserve_name}...")
-        atoken_contract = w3.eth.contract(address=atoken_address, abi=atoken_abi)
+        logger.info(
+            f"      --> Collecting treasury balance for reserve: {reserve_name}..."
+        )
+        if atoken_address not in atoken_contracts:
+            atoken_contracts[atoken_address] = get_contract(
+                w3, atoken_address, "atoken_abi"
+            )
+        atoken_contract = atoken_contracts[atoken_address]
         treasury_balance = atoken_contract.functions.balanceOf(
             treasury_collector_address
         ).call(block_identifier=block_number)
         reserves_data.loc[index, "treasury_balance"] = treasury_balance
-    reserves_data["treasury_balance_usd"] = (
-        reserves_data.treasury_balance
-        / 10**reserves_data.decimals
-        * reserves_data.underlyingTokenPriceUSD
-    )
-    return reserves_data
@@ -0,0 +1,36 @@
+"""ABIs and contract objects, loaded on first use and cached for the process"""
+
+import functools
+import json
+import os
+import threading
+import weakref
+
+ABI_DIRECTORY = os.path.join(os.path.dirname(__file__), "..", "abi")
+
+# {w3: {(address, id(abi)): (abi, contract)}}, the ABI is kept so that its id
+# is never reused by another ABI
+_contracts = weakref.WeakKeyDictionary()
+_contracts_lock = threading.Lock()
+
+
+@functools.cache
+def load_abi(name: str) -> list:
+    """ABI of src/abi/<name>.json, independent of the working directory."""
+    with open(os.path.join(ABI_DIRECTORY, f"{name}.json")) as file:
+        return json.load(file)
+
+
+def get_contract(w3, address: str, abi):
+    """
+    Contract object of `address` on `w3`, built once per process for each ABI.
+    `abi` is an ABI or the name of a file of src/abi.
+    """
+    if isinstance(abi, str):
+        abi = load_abi(abi)
+    with _contracts_lock:
+        contracts = _contracts.setdefault(w3, dict())
+        key = (address, id(abi))
+        if key not in contracts:
+            contracts[key] = (abi, w3.eth.contract(address=address, abi=abi))
+        return contracts[key][1]
@@ -0,0 +1,95 @@
+"""Helpers for running the collectors on AsyncWeb3 with bounded concurrency"""
+
+import asyncio
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from web3 import AsyncHTTPProvider, AsyncWeb3
+
+from src.utils.logs import logger
+from src.utils.rpc_limits import jittered_backoff
+
+
+async def get_async_w3(
+    provider_url: str, max_connections: int = 1_000, timeout: int = 60
+) -> AsyncWeb3:
+    provider = AsyncHTTPProvider(provider_url)
+    session = ClientSession(
+        connector=TCPConnector(limit=max_connections),
+        timeout=ClientTimeout(total=timeout),
+    )
+    await provider.cache_async_session(session)
+    return AsyncWeb3(provider)
+
+
+async def bounded_map(func, items: list, max_concurrency: int) -> list:
+    """
+    Await `func(item)` for every item with at most `max_concurrency` coroutines
+    running at the same time. Results are returned in the order of `items`,
+    exceptions are returned in place of the result of the failing item.
+    """
+    results = [None] * len(items)
+    items_iterator = iter(enumerate(items))
+
+    async def worker():
+        for index, item in items_iterator:
+            try:
+                results[index] = await func(item)
+            except Exception as e:
+                results[index] = e
+
+    await asyncio.gather(
+        *(worker() for _ in range(max(1, min(max_concurrency, len(items)))))
+    )
+    return results
+
+
+async def limited_call(
+    semaphore: asyncio.Semaphore, contract_function, block_identifier
+):
+    async with semaphore:
+        return await contract_function.call(block_identifier=block_identifier)
+
+
+async def gather_or_raise(*awaitables) -> list:
+    """
+    asyncio.gather of `awaitables` that lets all of them complete before
+    raising the first exception, so that no call is left running unawaited.
+    """
+    results = await asyncio.gather(*awaitables, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def redriven_map(
+    func,
+    items: list,
+    max_concurrency: int,
+    max_rounds: int = 3,
+    base_delay: float = 5.0,
+) -> list:
+    """
+    bounded_map, then the failed items are re-driven at the end of the run,
+    for at most `max_rounds` rounds spaced by jittered backoff as redrive does.
+    Items still failing keep their exception as result.
+    """
+    results = await bounded_map(func, items, max_concurrency)
+    for redrive_round in range(max_rounds):
+        failed = [
+            index
+            for index, result in enumerate(results)
+            if isinstance(result, Exception)
+        ]
+        if not failed:
+            break
+        logger.warning(
+            f"   --> Re-driving {len(failed)} failed items ({redrive_round + 1})"
+        )
+        await asyncio.sleep(jittered_backoff(redrive_round + 1, base_delay, 60.0))
+        redriven = await bounded_map(
+            func, [items[index] for index in failed], max_concurrency
+        )
+        for index, result in zip(failed, redriven):
+            results[index] = result
+    return results
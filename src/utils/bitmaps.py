@@ -0,0 +1,55 @@
+"""Vectorized decoders for Aave V3 configuration bitmaps"""
+
+import numpy as np
+
+# (first bit, number of bits) of each field of the ReserveConfigurationMap
+RESERVE_CONFIGURATION_FIELDS = {
+    "baseLTVasCollateral": (0, 16),
+    "reserveLiquidationThreshold": (16, 16),
+    "reserveLiquidationBonus": (32, 16),
+    "decimals": (48, 8),
+    "isActive": (56, 1),
+    "isFrozen": (57, 1),
+    "borrowingEnabled": (58, 1),
+    "reserveFactor": (64, 16),
+}
+RESERVE_CONFIGURATION_FLAGS = ["isActive", "isFrozen", "borrowingEnabled"]
+
+
+def to_uint64_limbs(values: list) -> np.ndarray:
+    """Split uint256 values into a (N, 4) array of little-endian uint64 limbs."""
+    buffer = b"".join(int(value).to_bytes(32, "little") for value in values)
+    return np.frombuffer(buffer, dtype="<u8").reshape(-1, 4)
+
+
+def extract_bits(limbs: np.ndarray, first_bit: int, n_bits: int) -> np.ndarray:
+    limb, offset = divmod(first_bit, 64)
+    mask = np.uint64((1 << n_bits) - 1)
+    return (limbs[:, limb] >> np.uint64(offset)) & mask
+
+
+def decode_reserve_configurations(configurations: list) -> dict:
+    limbs = to_uint64_limbs(configurations)
+    decoded = dict()
+    for field, (first_bit, n_bits) in RESERVE_CONFIGURATION_FIELDS.items():
+        values = extract_bits(limbs, first_bit, n_bits)
+        if field in RESERVE_CONFIGURATION_FLAGS:
+            decoded[field] = values.astype(bool)
+        else:
+            decoded[field] = values.astype(np.int64)
+    return decoded
+
+
+def decode_user_configurations(configurations: list, reserves_ids: list) -> tuple:
+    """
+    Decode UserConfigurationMap bitmaps, where bit 2 * id flags a borrow and
+    bit 2 * id + 1 flags a collateral in the reserve `id`. Returns two boolean
+    arrays of shape (N users, N reserves), ordered like `reserves_ids`.
+    """
+    bits = np.unpackbits(
+        to_uint64_limbs(configurations).view(np.uint8), axis=1, bitorder="little"
+    )
+    reserves_ids = np.asarray(reserves_ids, dtype=np.int64)
+    is_borrowing = bits[:, 2 * reserves_ids].astype(bool)
+    is_using_as_collateral = bits[:, 2 * reserves_ids + 1].astype(bool)
+    return is_borrowing, is_using_as_collateral
@@ -1,36 +1,151 @@
 """Function to find closest block to timestamp"""
 
+import bisect
+import math
+import os
+
+from src.utils.logs import logger
+
+# One index per chain, "{chain_id}" is replaced by the chain id of the provider
+DEFAULT_BLOCK_INDEX_PATH = os.path.join(
+    os.path.expanduser("~"),
+    ".cache",
+    "aavev3-raw-balances-collector",
+    "blocks-{chain_id}.csv",
+)
+
+
+class BlockTimestampIndex:
+    """
+    Append-only on-disk index of known (block, timestamp) pairs of the chain
+    `chain_id`, kept at `path` with its "{chain_id}" placeholder filled.
+    """
+
+    def __init__(self, chain_id: int, path: str = DEFAULT_BLOCK_INDEX_PATH):
+        self.path = path.replace("{chain_id}", str(chain_id))
+        self.timestamps = dict()
+        if os.path.exists(self.path):
+            with open(self.path) as file:
+                for line in file:
+                    block, timestamp = line.strip().split(",")
+                    self.timestamps[int(block)] = int(timestamp)
+        self._blocks = sorted(self.timestamps)
+
+    def get(self, block: int):
+        return self.timestamps.get(block)
+
+    def add(self, block: int, timestamp: int):
+        if block in self.timestamps:
+            return
+        self.timestamps[block] = timestamp
+        bisect.insort(self._blocks, block)
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as file:
+            file.write(f"{block},{timestamp}\n")
+
+    def bracket(self, target_timestamp: int) -> tuple:
+        """Closest known blocks with timestamp < target and timestamp >= target."""
+        lower, upper = None, None
+        position = bisect.bisect_left(
+            self._blocks, target_timestamp, key=lambda block: self.timestamps[block]
+        )
+        if position > 0:
+            lower = self._blocks[position - 1]
+        if position < len(self._blocks):
+            upper = self._blocks[position]
+        return lower, upper
+
 
 def find_closest_block(
-    w3, target_timestamp: int, initial_block: int, step: int, verbose: bool = False
+    w3,
+    target_timestamp: int,
+    initial_block: int,
+    block_time: int = 12,
+    verbose: bool = False,
+    block_index: BlockTimestampIndex = None,
 ) -> int:
-    upper_bound = initial_block
-    lower_bound = initial_block - step
-    lower_timestamp = w3.eth.get_block(lower_bound)["timestamp"]
+    """
+    Return the last block mined strictly before `target_timestamp`, searching
+    below `initial_block`. The search interpolates on block timestamps, which
+    lands on the right block in a few calls given the near-constant slot time.
+    """
+    calls = 0
 
-    while lower_timestamp > target_timestamp:
-        lower_bound -= step
-        upper_bound -= step
-        lower_timestamp = w3.eth.get_block(lower_bound)["timestamp"]
+    def get_timestamp(block: int) -> int:
+        nonlocal calls
+        if block_index is not None and block_index.get(block) is not None:
+            return block_index.get(block)
+        calls += 1
+        timestamp = w3.eth.get_block(block)["timestamp"]
+        if block_index is not None:
+            block_index.add(block, timestamp)
+        return timestamp
 
-    assert w3.eth.get_block(lower_bound)["timestamp"] <= target_timestamp
-    assert w3.eth.get_block(upper_bound)["timestamp"] > target_timestamp
+    upper_bound, lower_bound = initial_block, None
+    if block_index is not None:
+        known_lower, known_upper = block_index.bracket(target_timestamp)
+        if known_upper is not None and known_upper <= initial_block:
+            upper_bound = known_upper
+        if known_lower is not None and known_lower < upper_bound:
+            lower_bound = known_lower
+    upper_timestamp = get_timestamp(upper_bound)
+    if upper_timestamp < target_timestamp:
+        raise ValueError(
+            f"Block {initial_block} is older than the target timestamp {target_timestamp}"
+        )
+    lower_timestamp = None if lower_bound is None else get_timestamp(lower_bound)
 
-    # Starting Dichotomy
+    # Invariant: timestamp(lower_bound) < target_timestamp <= timestamp(upper_bound)
     iteration = 0
-    while abs(upper_bound - lower_bound) > 1:
+    use_bisection = False
+    while lower_bound is None or upper_bound - lower_bound > 1:
         iteration += 1
-        mid_bound = round((lower_bound + upper_bound) / 2)
-        mid_timestamp = w3.eth.get_block(mid_bound)["timestamp"]
+        interval = None if lower_bound is None else upper_bound - lower_bound
+        if lower_bound is None:
+            # Stepping back from the upper bound at the nominal slot time
+            guess = upper_bound - max(
+                1, math.ceil((upper_timestamp - target_timestamp) / block_time)
+            )
+            guess = max(guess, 0)
+        elif use_bisection:
+            guess = (lower_bound + upper_bound) // 2
+        else:
+            # Secant from the closest bound, aiming at the last block before
+            # target. When the average block time is close to the slot time, the
+            # gap is mostly made of consecutive slots and the slot time is exact.
+            average_block_time = (upper_timestamp - lower_timestamp) / interval
+            if abs(average_block_time - block_time) < 0.1 * block_time:
+                average_block_time = block_time
+            if target_timestamp - lower_timestamp <= upper_timestamp - target_timestamp:
+                guess = lower_bound + math.ceil(
+                    (target_timestamp - lower_timestamp) / average_block_time
+                )
+            else:
+                guess = upper_bound - math.floor(
+                    (upper_timestamp - target_timestamp) / average_block_time
+                )
+            guess -= 1
+            guess = min(max(guess, lower_bound + 1), upper_bound - 1)
 
-        if mid_timestamp < target_timestamp:
-            lower_bound = mid_bound
+        guess_timestamp = get_timestamp(guess)
+        if guess_timestamp < target_timestamp:
+            lower_bound, lower_timestamp = guess, guess_timestamp
         else:
-            upper_bound = mid_bound
+            if guess == 0:
+                raise ValueError(
+                    f"No block was mined before the target timestamp {target_timestamp}"
+                )
+            upper_bound, upper_timestamp = guess, guess_timestamp
+
+        # Falling back to bisection when interpolation does not halve the interval
+        if interval is not None:
+            use_bisection = (upper_bound - lower_bound) > interval / 2
 
-        if verbose and iteration % 10 == 0:
-            print(f"Iteration {iteration}")
-            print("   -->lower = ", lower_bound)
-            print("   -->upper = ", upper_bound)
+        if verbose:
+            logger.info(f"Iteration {iteration}")
+            logger.info(f"   -->lower = {lower_bound}")
+            logger.info(f"   -->upper = {upper_bound}")
 
+    if verbose:
+        logger.info(f"Found block {lower_bound} with {calls} get_block calls")
     return lower_bound
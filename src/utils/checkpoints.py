@@ -0,0 +1,144 @@
+"""Chunked collection with local or S3 checkpoints, resumable after a failure"""
+
+import io
+import json
+import os
+from decimal import Decimal
+
+import pandas as pd
+from pandas import DataFrame
+
+from src.utils.logs import logger
+
+
+class LocalCheckpointStore:
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def read(self, key: str) -> bytes:
+        path = os.path.join(self.directory, key)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as file:
+            return file.read()
+
+    def write(self, key: str, body: bytes):
+        path = os.path.join(self.directory, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written aside then renamed, a crash never leaves a truncated file
+        with open(path + ".tmp", "wb") as file:
+            file.write(body)
+        os.replace(path + ".tmp", path)
+
+    def delete(self, key: str):
+        path = os.path.join(self.directory, key)
+        if os.path.exists(path):
+            os.remove(path)
+
+
+class S3CheckpointStore:
+    def __init__(self, client_s3, bucket: str, prefix: str):
+        self.client_s3 = client_s3
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read(self, key: str) -> bytes:
+        try:
+            object = self.client_s3.get_object(
+                Bucket=self.bucket, Key=self.prefix + key
+            )
+        except self.client_s3.exceptions.NoSuchKey:
+            return None
+        return object["Body"].read()
+
+    def write(self, key: str, body: bytes):
+        self.client_s3.put_object(Bucket=self.bucket, Key=self.prefix + key, Body=body)
+
+    def delete(self, key: str):
+        self.client_s3.delete_object(Bucket=self.bucket, Key=self.prefix + key)
+
+
+def address_range_chunks(users: list, chunk_size: int) -> list:
+    """Split users sorted by address into consecutive ranges of `chunk_size`."""
+    sorted_users = sorted(users, key=str.lower)
+    return [
+        sorted_users[start : start + chunk_size]
+        for start in range(0, len(sorted_users), chunk_size)
+    ]
+
+
+class CollectionCheckpoint:
+    """
+    Checkpoints of one collection run, under `run_key` in `store`. A chunk is
+    committed once its manifest, written after its data, exists. A run restarted
+    with the same key and users skips the committed chunks.
+    """
+
+    def __init__(self, store, run_key: str, chunk_size: int = 10_000):
+        self.store = store
+        self.run_key = run_key
+        self.chunk_size = chunk_size
+
+    def _chunk_key(self, index: int, extension: str) -> str:
+        return f"{self.run_key}/chunk-{index:05d}.{extension}"
+
+    def load_chunk(self, index: int, users: list) -> tuple:
+        manifest = self.store.read(self._chunk_key(index, "json"))
+        if manifest is None:
+            return None
+        manifest = json.loads(manifest)
+        if manifest["users"] != [len(users), users[0], users[-1]]:
+            logger.info(
+                f"   --> Checkpoint chunk {index} has other users, collecting again"
+            )
+            return None
+        data = self.store.read(self._chunk_key(index, "csv"))
+        # Imported here, pyarrow.parquet is only loaded when a checkpoint is resumed
+        from src.utils.parquet_output import UINT256_COLUMNS
+
+        frame = pd.read_csv(
+            io.BytesIO(data),
+            index_col=0,
+            converters={
+                column: lambda value: int(Decimal(value)) for column in UINT256_COLUMNS
+            },
+        )
+        return frame, manifest["failed_users"]
+
+    def commit_chunk(self, index: int, users: list, frame: DataFrame, failed_users):
+        self.store.write(self._chunk_key(index, "csv"), frame.to_csv().encode())
+        manifest = {
+            "users": [len(users), users[0], users[-1]],
+            "rows": len(frame),
+            "failed_users": list(failed_users),
+        }
+        self.store.write(self._chunk_key(index, "json"), json.dumps(manifest).encode())
+
+    def run(self, users: list, collect_chunk) -> tuple:
+        """
+        Call `collect_chunk(chunk_users) -> (frame, failed_users)` on every
+        uncommitted address range of `users`, committing each result. Return
+        the concatenated frames and failed users of all the chunks.
+        """
+        chunks = address_range_chunks(users, self.chunk_size)
+        frames, failed_users = list(), list()
+        resumed_chunks = 0
+        for index, chunk_users in enumerate(chunks):
+            checkpoint = self.load_chunk(index, chunk_users)
+            if checkpoint is not None:
+                resumed_chunks += 1
+            else:
+                checkpoint = collect_chunk(chunk_users)
+                self.commit_chunk(index, chunk_users, *checkpoint)
+                logger.info(
+                    f"   --> Committed chunk {index + 1}/{len(chunks)} "
+                    f"({len(checkpoint[1])} failed users)"
+                )
+            frames.append(checkpoint[0])
+            failed_users.extend(checkpoint[1])
+        if resumed_chunks > 0:
+            logger.info(
+                f"   --> Resumed {resumed_chunks}/{len(chunks)} chunks from checkpoint"
+            )
+        frame = pd.concat(frames) if frames else DataFrame()
+        return frame, failed_users
@@ -0,0 +1,31 @@
+"""Append-only columnar buffer turned into a single DataFrame at the end"""
+
+from pandas import DataFrame
+
+
+class ColumnarBuffer:
+    def __init__(self, columns: list):
+        self.columns = columns
+        self.values = [list() for _ in columns]
+        self.index = list()
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def append(self, row: tuple, index=None):
+        for column_values, value in zip(self.values, row):
+            column_values.append(value)
+        self.index.append(len(self.index) if index is None else index)
+
+    def extend(self, columns_values: list, index: list = None):
+        n_rows = len(columns_values[0]) if columns_values else 0
+        for column_values, values in zip(self.values, columns_values):
+            column_values.extend(values)
+        if index is None:
+            index = range(len(self.index), len(self.index) + n_rows)
+        self.index.extend(index)
+
+    def to_frame(self) -> DataFrame:
+        return DataFrame(
+            dict(zip(self.columns, self.values)), columns=self.columns, index=self.index
+        )
@@ -0,0 +1,270 @@
+"""Compact columnar store of raw balances, with interned addresses and limbs"""
+
+import numpy as np
+import pandas as pd
+from pandas import DataFrame
+
+from src.utils.ray_math import LIMB_BITS, to_limbs
+
+RAW_BALANCES_COLUMNS = [
+    "underlyingAsset",
+    "scaledATokenBalance",
+    "usageAsCollateralEnabledOnUser",
+    "scaledVariableDebt",
+    "user_address",
+]
+
+
+def pack_limbs(values) -> np.ndarray:
+    """(rows, limbs) uint32 array of non-negative integers, 4 bytes per limb."""
+    if len(values) == 0:
+        return np.zeros((0, 1), dtype=np.uint32)
+    return np.ascontiguousarray(to_limbs(values), dtype=np.uint32)
+
+
+def unpack_limbs(limbs: np.ndarray) -> list:
+    """Python ints of a (rows, limbs) array, 64 bits at a time."""
+    limbs = _pad_limbs(limbs, limbs.shape[1] + limbs.shape[1] % 2).astype(np.uint64)
+    groups = [
+        (limbs[:, limb] | (limbs[:, limb + 1] << np.uint64(LIMB_BITS))).tolist()
+        for limb in range(0, limbs.shape[1], 2)
+    ]
+    values = groups[0]
+    for position, group in enumerate(groups[1:], start=1):
+        values = [
+            value | (high << (64 * position)) if high else value
+            for value, high in zip(values, group)
+        ]
+    return values
+
+
+def _pad_limbs(limbs: np.ndarray, n_limbs: int) -> np.ndarray:
+    if limbs.shape[1] == n_limbs:
+        return limbs
+    padded = np.zeros((len(limbs), n_limbs), dtype=np.uint32)
+    padded[:, : limbs.shape[1]] = limbs
+    return padded
+
+
+def _concat_limbs(blocks: list) -> np.ndarray:
+    n_limbs = max([block.shape[1] for block in blocks], default=1)
+    if not blocks:
+        return np.zeros((0, n_limbs), dtype=np.uint32)
+    return np.concatenate([_pad_limbs(block, n_limbs) for block in blocks])
+
+
+class CompactBalances:
+    """
+    Raw balances, one row per (user, reserve) position, in fixed-width arrays.
+    Users and reserves addresses are stored once, in `users` and `reserves`,
+    and rows refer to them by integer codes. Scaled balances are (rows, limbs)
+    arrays of 32 bits limbs, exact for any uint256. `positions` keeps the
+    position of the reserve in the user's getUserReservesData response, the
+    index of the DataFrame form.
+    """
+
+    def __init__(
+        self,
+        users: list,
+        user_codes: np.ndarray,
+        reserves: list,
+        reserve_codes: np.ndarray,
+        positions: np.ndarray,
+        usage_as_collateral: np.ndarray,
+        scaled_atoken: np.ndarray,
+        scaled_debt: np.ndarray,
+        snapshot_block: int = None,
+    ):
+        self.users = users
+        self.user_codes = user_codes
+        self.reserves = reserves
+        self.reserve_codes = reserve_codes
+        self.positions = positions
+        self.usage_as_collateral = usage_as_collateral
+        self.scaled_atoken = scaled_atoken
+        self.scaled_debt = scaled_debt
+        self.snapshot_block = snapshot_block
+
+    def __len__(self) -> int:
+        return len(self.user_codes)
+
+    @classmethod
+    def empty(cls) -> "CompactBalances":
+        return cls.from_frame(DataFrame(columns=RAW_BALANCES_COLUMNS))
+
+    @classmethod
+    def from_frame(cls, frame: DataFrame) -> "CompactBalances":
+        """Compact form of a raw balances DataFrame, e.g. read from a file."""
+        user_codes, users = pd.factorize(frame["user_address"])
+        reserve_codes, reserves = pd.factorize(frame["underlyingAsset"])
+        snapshot_block = None
+        if "snapshot_block" in frame.columns and len(frame) > 0:
+            snapshot_block = int(frame["snapshot_block"].iloc[0])
+        return cls(
+            users=users.tolist(),
+            user_codes=user_codes.astype(np.int32),
+            reserves=reserves.tolist(),
+            reserve_codes=reserve_codes.astype(np.int16),
+            positions=np.asarray(frame.index, dtype=np.int32),
+            usage_as_collateral=frame["usageAsCollateralEnabledOnUser"]
+            .to_numpy()
+            .astype(bool),
+            scaled_atoken=pack_limbs(frame["scaledATokenBalance"].tolist()),
+            scaled_debt=pack_limbs(frame["scaledVariableDebt"].tolist()),
+            snapshot_block=snapshot_block,
+        )
+
+    @classmethod
+    def concat(cls, parts: list) -> "CompactBalances":
+        """Rows of all the `parts`, with their addresses tables merged."""
+        users, reserves = dict(), dict()
+        user_codes, reserve_codes = list(), list()
+        for part in parts:
+            # Codes of a part are remapped to the merged tables
+            part_users = [users.setdefault(user, len(users)) for user in part.users]
+            part_reserves = [
+                reserves.setdefault(reserve, len(reserves)) for reserve in part.reserves
+            ]
+            user_codes.append(
+                np.asarray(part_users, dtype=np.int32)[part.user_codes]
+                if len(part)
+                else part.user_codes
+            )
+            reserve_codes.append(
+                np.asarray(part_reserves, dtype=np.int16)[part.reserve_codes]
+                if len(part)
+                else part.reserve_codes
+            )
+        snapshot_blocks = [part.snapshot_block for part in parts]
+        return cls(
+            users=list(users),
+            user_codes=np.concatenate(user_codes or [np.zeros(0, np.int32)]),
+            reserves=list(reserves),
+            reserve_codes=np.concatenate(reserve_codes or [np.zeros(0, np.int16)]),
+            positions=np.concatenate(
+                [part.positions for part in parts] or [np.zeros(0, np.int32)]
+            ),
+            usage_as_collateral=np.concatenate(
+                [part.usage_as_collateral for part in parts] or [np.zeros(0, bool)]
+            ),
+            scaled_atoken=_concat_limbs([part.scaled_atoken for part in parts]),
+            scaled_debt=_concat_limbs([part.scaled_debt for part in parts]),
+            snapshot_block=next(
+                (block for block in snapshot_blocks if block is not None), None
+            ),
+        )
+
+    def users_count(self) -> int:
+        return len(np.unique(self.user_codes))
+
+    def user_addresses(self, rows=slice(None)) -> np.ndarray:
+        # Object arrays of the interned str, not one str per row
+        return np.asarray(self.users, dtype=object)[self.user_codes[rows]]
+
+    def reserve_addresses(self, rows=slice(None)) -> np.ndarray:
+        return np.asarray(self.reserves, dtype=object)[self.reserve_codes[rows]]
+
+    def to_frame(self, rows=slice(None)) -> DataFrame:
+        """The raw balances DataFrame of the collector, of all or some `rows`."""
+        frame = DataFrame(
+            {
+                "underlyingAsset": self.reserve_addresses(rows),
+                "scaledATokenBalance": pd.Series(
+                    unpack_limbs(self.scaled_atoken[rows]), dtype=object
+                ),
+                "usageAsCollateralEnabledOnUser": self.usage_as_collateral[rows],
+                "scaledVariableDebt": pd.Series(
+                    unpack_limbs(self.scaled_debt[rows]), dtype=object
+                ),
+                "user_address": self.user_addresses(rows),
+            },
+            columns=RAW_BALANCES_COLUMNS,
+        )
+        frame.index = self.positions[rows].astype(np.int64)
+        if self.snapshot_block is not None:
+            frame["snapshot_block"] = self.snapshot_block
+        return frame
+
+    def nbytes(self) -> int:
+        """Bytes of the rows arrays, the addresses tables excluded."""
+        return sum(
+            array.nbytes
+            for array in [
+                self.user_codes,
+                self.reserve_codes,
+                self.positions,
+                self.usage_as_collateral,
+                self.scaled_atoken,
+                self.scaled_debt,
+            ]
+        )
+
+
+class CompactBalancesBuffer:
+    """
+    Rows appended one at a time, packed into fixed-width blocks of
+    `block_rows` rows so that only one block is held as Python objects.
+    Addresses are interned on append.
+    """
+
+    def __init__(self, block_rows: int = 65_536):
+        self.block_rows = block_rows
+        self.users = dict()
+        self.reserves = dict()
+        self.blocks = list()
+        self._rows = [list() for _ in range(6)]
+
+    def __len__(self) -> int:
+        return sum(len(block[0]) for block in self.blocks) + len(self._rows[0])
+
+    def append(
+        self,
+        user_address: str,
+        position: int,
+        underlying_asset: str,
+        scaled_atoken: int,
+        usage_as_collateral: bool,
+        scaled_debt: int,
+    ):
+        row = (
+            self.users.setdefault(user_address, len(self.users)),
+            self.reserves.setdefault(underlying_asset, len(self.reserves)),
+            position,
+            usage_as_collateral,
+            scaled_atoken,
+            scaled_debt,
+        )
+        for column_values, value in zip(self._rows, row):
+            column_values.append(value)
+        if len(self._rows[0]) >= self.block_rows:
+            self._pack_block()
+
+    def _pack_block(self):
+        user_codes, reserve_codes, positions, collateral, atoken, debt = self._rows
+        self.blocks.append(
+            (
+                np.asarray(user_codes, dtype=np.int32),
+                np.asarray(reserve_codes, dtype=np.int16),
+                np.asarray(positions, dtype=np.int32),
+                np.asarray(collateral, dtype=bool),
+                pack_limbs(atoken),
+                pack_limbs(debt),
+            )
+        )
+        self._rows = [list() for _ in range(6)]
+
+    def to_compact(self, snapshot_block: int = None) -> CompactBalances:
+        if self._rows[0] or not self.blocks:
+            self._pack_block()
+        columns = list(zip(*self.blocks))
+        return CompactBalances(
+            users=list(self.users),
+            user_codes=np.concatenate(columns[0]),
+            reserves=list(self.reserves),
+            reserve_codes=np.concatenate(columns[1]),
+            positions=np.concatenate(columns[2]),
+            usage_as_collateral=np.concatenate(columns[3]),
+            scaled_atoken=_concat_limbs(list(columns[4])),
+            scaled_debt=_concat_limbs(list(columns[5])),
+            snapshot_block=snapshot_block,
+        )
@@ -0,0 +1,35 @@
+"""Functions for encoding and decoding raw contract calls"""
+
+from eth_utils.abi import get_abi_output_types
+from hexbytes import HexBytes
+from web3._utils.abi import map_abi_data
+from web3._utils.normalizers import BASE_RETURN_NORMALIZERS
+
+REVERT_ERROR_SELECTOR = HexBytes("0x08c379a0")
+
+
+def encode_call(contract_function) -> tuple:
+    return contract_function.address, HexBytes(
+        contract_function._encode_transaction_data()
+    )
+
+
+def decode_call_result(w3, contract_function, return_data: bytes):
+    output_types = get_abi_output_types(contract_function.abi)
+    output_data = w3.codec.decode(output_types, HexBytes(return_data))
+    normalized_data = map_abi_data(BASE_RETURN_NORMALIZERS, output_types, output_data)
+    if len(normalized_data) == 1:
+        return normalized_data[0]
+    return normalized_data
+
+
+def decode_revert_reason(w3, return_data: bytes) -> str:
+    return_data = HexBytes(return_data)
+    if return_data[:4] == REVERT_ERROR_SELECTOR:
+        try:
+            return w3.codec.decode(["string"], return_data[4:])[0]
+        except Exception:
+            pass
+    if len(return_data) == 0:
+        return "execution reverted"
+    return f"execution reverted: {return_data.hex()}"
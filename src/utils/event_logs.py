@@ -0,0 +1,45 @@
+"""Chunked eth_getLogs scans over long block ranges"""
+
+from web3.exceptions import Web3RPCError
+
+from src.utils.logs import logger
+
+# Block of the Aave V3 Ethereum Pool deployment, no Pool event precedes it
+POOL_DEPLOYMENT_BLOCK = 16_291_127
+
+
+def get_logs_chunked(
+    w3,
+    address,
+    topics: list,
+    from_block: int,
+    to_block: int,
+    chunk_size: int = 50_000,
+    min_chunk_size: int = 100,
+):
+    """
+    Yield the logs of `address` matching `topics` between `from_block` and
+    `to_block` included, one `chunk_size` block range per eth_getLogs request,
+    in block order. A range refused by the node (too many results, range too
+    large) is retried in halves down to `min_chunk_size` blocks.
+    """
+    start = from_block
+    while start <= to_block:
+        end = min(start + chunk_size - 1, to_block)
+        try:
+            logs = w3.eth.get_logs(
+                {
+                    "address": address,
+                    "topics": topics,
+                    "fromBlock": start,
+                    "toBlock": end,
+                }
+            )
+        except Web3RPCError as e:
+            if chunk_size <= min_chunk_size:
+                raise
+            chunk_size = max(chunk_size // 2, min_chunk_size)
+            logger.debug(f"eth_getLogs refused [{start}, {end}], {chunk_size}: {e}")
+            continue
+        yield from sorted(logs, key=lambda log: (log["blockNumber"], log["logIndex"]))
+        start = end + 1
@@ -0,0 +1,71 @@
+"""Leveled logging and sampled progress logging of the collection loops"""
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger("aavev3_balances")
+
+
+def configure_logging(level: str = None):
+    # Messages keep the layout of the former print output
+    logging.basicConfig(
+        format="%(message)s", level=(level or os.environ.get("LOG_LEVEL", "INFO"))
+    )
+
+
+class SampledProgress:
+    """
+    Progress of a loop over `total` items, logged at most every `interval`
+    seconds. The first `max_logged_errors` item errors are logged as warnings,
+    the following ones only at debug level and in the counts.
+    """
+
+    def __init__(
+        self,
+        label: str,
+        total: int,
+        interval: float = 10.0,
+        max_logged_errors: int = 10,
+    ):
+        self.label = label
+        self.total = total
+        self.interval = interval
+        self.max_logged_errors = max_logged_errors
+        self.done = 0
+        self.errors = 0
+        self._started_at = time.monotonic()
+        self._logged_at = self._started_at
+        self._lock = threading.Lock()
+
+    def update(self, items: int = 1):
+        with self._lock:
+            self.done += items
+            now = time.monotonic()
+            if now - self._logged_at < self.interval:
+                return
+            self._logged_at = now
+            rate = self.done / max(now - self._started_at, 1e-9)
+            logger.info(
+                f"   --> {self.label}: {self.done}/{self.total} "
+                f"({rate:.0f}/s, {self.errors} errors)"
+            )
+
+    def error(self, item, error):
+        with self._lock:
+            self.errors += 1
+            errors = self.errors
+        if errors <= self.max_logged_errors:
+            logger.warning(f"Warning: got an error for {item}: {error}")
+            if errors == self.max_logged_errors:
+                logger.warning(f"   --> Further {self.label} errors at debug level")
+        else:
+            logger.debug(f"Got an error for {item}: {error}")
+
+    def finish(self):
+        elapsed = time.monotonic() - self._started_at
+        logger.info(
+            f"   --> {self.label}: {self.done}/{self.total} in {elapsed:.1f}s "
+            f"({self.errors} errors)"
+        )
@@ -0,0 +1,289 @@
+"""Per-stage run metrics, exported as a JSON report and a Prometheus textfile"""
+
+import bisect
+import contextlib
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+
+from toolz import curry
+from web3.middleware.base import Web3MiddlewareBuilder
+
+from src.utils.logs import logger
+
+# Upper bounds, in seconds, of the RPC latency histogram buckets
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0]
+METRICS_PREFIX = "aave_balances_etl"
+
+
+class StageMetrics:
+    def __init__(self, snapshot_date: str, name: str):
+        self.snapshot_date = snapshot_date
+        self.name = name
+        self.wall_time = 0.0
+        self.rpc_calls = Counter()
+        self.rpc_errors = 0
+        self.rpc_retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.latency_sum = 0.0
+        self.rows = dict()
+
+    def observe_latency(self, latency: float):
+        self.latency_buckets[bisect.bisect_left(LATENCY_BUCKETS, latency)] += 1
+        self.latency_sum += latency
+
+    def to_dict(self) -> dict:
+        return {
+            "snapshot_date": self.snapshot_date,
+            "stage": self.name,
+            "wall_time_seconds": round(self.wall_time, 6),
+            "rpc_calls": dict(self.rpc_calls),
+            "rpc_errors": self.rpc_errors,
+            "rpc_retries": self.rpc_retries,
+            "rpc_bytes_sent": self.bytes_sent,
+            "rpc_bytes_received": self.bytes_received,
+            "rpc_latency_seconds": {
+                "buckets": dict(
+                    zip(
+                        [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                        self.latency_buckets,
+                    )
+                ),
+                "sum": round(self.latency_sum, 6),
+                "count": sum(self.latency_buckets),
+            },
+            "rows": self.rows,
+        }
+
+
+class RunMetrics:
+    """
+    Metrics of an ETL run, grouped by (snapshot date, stage). RPC calls are
+    attributed to the stage entered in the calling context. Worker threads run
+    their calls in a copy of the submitting context to keep its stage, calls
+    made from other threads go to an "unstaged" stage of the run.
+    """
+
+    def __init__(self):
+        self.started_at = time.time()
+        self.stages = dict()
+        self.limiter = None
+        self._lock = threading.Lock()
+        self._current_stage = contextvars.ContextVar(
+            f"run_metrics_stage_{id(self)}", default=None
+        )
+
+    def _stage(self, snapshot_date: str, name: str) -> StageMetrics:
+        key = (snapshot_date, name)
+        if key not in self.stages:
+            self.stages[key] = StageMetrics(snapshot_date, name)
+        return self.stages[key]
+
+    def current_stage(self) -> StageMetrics:
+        stage = self._current_stage.get()
+        if stage is None:
+            with self._lock:
+                return self._stage(None, "unstaged")
+        return stage
+
+    @contextlib.contextmanager
+    def stage(self, name: str, snapshot_date: str = None):
+        with self._lock:
+            stage = self._stage(snapshot_date, name)
+        token = self._current_stage.set(stage)
+        # The retries of the adaptive limiter are counted run-wide
+        retries = self.limiter.retries if self.limiter is not None else 0
+        start = time.perf_counter()
+        try:
+            yield stage
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                stage.wall_time += elapsed
+                if self.limiter is not None:
+                    stage.rpc_retries += self.limiter.retries - retries
+            self._current_stage.reset(token)
+
+    def record_rows(self, name: str, rows: int):
+        stage = self.current_stage()
+        with self._lock:
+            stage.rows[name] = stage.rows.get(name, 0) + rows
+
+    def record_rpc(
+        self,
+        methods: list,
+        latency: float,
+        bytes_sent: int,
+        bytes_received: int,
+        errors: int,
+    ):
+        stage = self.current_stage()
+        with self._lock:
+            stage.rpc_calls.update(methods)
+            stage.observe_latency(latency)
+            stage.bytes_sent += bytes_sent
+            stage.bytes_received += bytes_received
+            stage.rpc_errors += errors
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "started_at": self.started_at,
+                "finished_at": time.time(),
+                "stages": [stage.to_dict() for stage in self.stages.values()],
+            }
+
+    def write_json_report(self, path: str):
+        _write_atomically(path, json.dumps(self.report(), indent=2))
+
+    def write_prometheus_textfile(self, path: str):
+        """Textfile for the node exporter textfile collector."""
+        _write_atomically(path, prometheus_text(self.report()))
+
+
+def _labels(**labels) -> str:
+    return ",".join(
+        f'{name}="{value}"' for name, value in labels.items() if value is not None
+    )
+
+
+def prometheus_text(report: dict) -> str:
+    metrics = defaultdict(list)
+    for stage in report["stages"]:
+        labels = dict(snapshot_date=stage["snapshot_date"], stage=stage["stage"])
+        metrics["stage_duration_seconds gauge"].append(
+            (_labels(**labels), stage["wall_time_seconds"])
+        )
+        for method, calls in stage["rpc_calls"].items():
+            metrics["rpc_requests_total counter"].append(
+                (_labels(**labels, method=method), calls)
+            )
+        metrics["rpc_errors_total counter"].append(
+            (_labels(**labels), stage["rpc_errors"])
+        )
+        metrics["rpc_retries_total counter"].append(
+            (_labels(**labels), stage["rpc_retries"])
+        )
+        for direction in ["sent", "received"]:
+            metrics["rpc_bytes_total counter"].append(
+                (
+                    _labels(**labels, direction=direction),
+                    stage[f"rpc_bytes_{direction}"],
+                )
+            )
+        for output, rows in stage["rows"].items():
+            metrics["stage_rows gauge"].append((_labels(**labels, output=output), rows))
+        latency = stage["rpc_latency_seconds"]
+        cumulative_count = 0
+        for bound, count in latency["buckets"].items():
+            cumulative_count += count
+            metrics["rpc_request_duration_seconds histogram"].append(
+                (_labels(**labels, le=bound), cumulative_count, "_bucket")
+            )
+        metrics["rpc_request_duration_seconds histogram"].append(
+            (_labels(**labels), latency["sum"], "_sum")
+        )
+        metrics["rpc_request_duration_seconds histogram"].append(
+            (_labels(**labels), latency["count"], "_count")
+        )
+
+    lines = list()
+    for name_and_type, samples in metrics.items():
+        name, metric_type = name_and_type.split()
+        lines.append(f"# TYPE {METRICS_PREFIX}_{name} {metric_type}")
+        for labels, value, *suffix in samples:
+            suffix = suffix[0] if suffix else ""
+            lines.append(f"{METRICS_PREFIX}_{name}{suffix}{{{labels}}} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def _write_atomically(path: str, content: str):
+    # Scrapers never read a partially written file
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path + ".tmp", "w") as file:
+        file.write(content)
+    os.replace(path + ".tmp", path)
+
+
+def _payload_size(payload) -> int:
+    return len(json.dumps(payload, default=str))
+
+
+def _error_count(response) -> int:
+    responses = response if isinstance(response, list) else [response]
+    return sum(
+        1
+        for response in responses
+        if isinstance(response, dict) and "error" in response
+    )
+
+
+class RpcMetricsMiddlewareBuilder(Web3MiddlewareBuilder):
+    metrics: RunMetrics = None
+
+    @staticmethod
+    @curry
+    def build(metrics: RunMetrics, w3) -> "RpcMetricsMiddlewareBuilder":
+        middleware = RpcMetricsMiddlewareBuilder(w3)
+        middleware.metrics = metrics
+        return middleware
+
+    def _measure(self, send, request, methods: list):
+        start = time.perf_counter()
+        try:
+            response = send(request)
+        except Exception:
+            self.metrics.record_rpc(
+                methods, time.perf_counter() - start, _payload_size(request), 0, 1
+            )
+            raise
+        self.metrics.record_rpc(
+            methods,
+            time.perf_counter() - start,
+            _payload_size(request),
+            _payload_size(response),
+            _error_count(response),
+        )
+        return response
+
+    def wrap_make_request(self, make_request):
+        def middleware(method, params):
+            return self._measure(
+                lambda request: make_request(*request), (method, params), [method]
+            )
+
+        return middleware
+
+    def wrap_make_batch_request(self, make_batch_request):
+        def middleware(requests_info):
+            return self._measure(
+                make_batch_request,
+                requests_info,
+                [method for method, _ in requests_info],
+            )
+
+        return middleware
+
+
+def install_rpc_metrics(w3, metrics: RunMetrics, limiter=None):
+    """
+    Record the requests reaching the provider. Installed last, it is the
+    innermost layer: cached responses are not counted and every retry is.
+    Payload sizes are the JSON sizes of the params and responses.
+    """
+    metrics.limiter = limiter
+    w3.middleware_onion.inject(
+        RpcMetricsMiddlewareBuilder.build(metrics), name="rpc_metrics", layer=0
+    )
+    return metrics
+
+
+def write_run_reports(metrics: RunMetrics, directory: str):
+    metrics.write_json_report(os.path.join(directory, "run_report.json"))
+    metrics.write_prometheus_textfile(os.path.join(directory, f"{METRICS_PREFIX}.prom"))
+    logger.info(f"Run metrics written to {directory}")
@@ -0,0 +1,116 @@
+"""Class for batching contract calls through Multicall3 aggregate3"""
+
+from src.utils.abis import get_contract, load_abi
+from src.utils.contract_calls import (
+    decode_call_result,
+    decode_revert_reason,
+    encode_call,
+)
+from src.utils.logs import logger
+
+MULTICALL3_ADDRESS = "0xcA11bde05977b3631167028862bE2a173976CA11"
+
+# ABI-encoded overhead of one Call3 / Result entry, excluding the payload
+CALL3_OVERHEAD_BYTES = 5 * 32
+RESULT_OVERHEAD_BYTES = 4 * 32
+
+
+class Multicall3:
+    def __init__(
+        self,
+        w3,
+        max_calldata_bytes: int = 120_000,
+        max_returndata_bytes: int = 1_500_000,
+        max_batch_size: int = 1_000,
+        initial_batch_size: int = 50,
+    ):
+        self.w3 = w3
+        self.multicall_abi = load_abi("multicall3_abi")
+        self.multicall_contract = get_contract(
+            self.w3, MULTICALL3_ADDRESS, self.multicall_abi
+        )
+        self.max_calldata_bytes = max_calldata_bytes
+        self.max_returndata_bytes = max_returndata_bytes
+        self.max_batch_size = max_batch_size
+        self.batch_size = initial_batch_size
+
+        # Largest payloads observed so far, used to size the next batches
+        self.calldata_bytes_per_call = 0
+        self.returndata_bytes_per_call = 0
+
+    def call(self, contract_functions: list, block_identifier="latest") -> list:
+        """
+        Execute the contract functions in as few aggregate3 calls as possible.
+        Returns one (success, result) tuple per function, in order, where result
+        is the decoded output on success and the revert reason otherwise.
+        """
+        results = list()
+        start = 0
+        while start < len(contract_functions):
+            batch = contract_functions[start : start + self._next_batch_size()]
+            try:
+                batch_results = self._aggregate3(batch, block_identifier)
+            except Exception as e:
+                if len(batch) == 1:
+                    batch_results = [(False, str(e))]
+                else:
+                    self.batch_size = max(1, len(batch) // 2)
+                    logger.warning(
+                        f"Warning: multicall batch of {len(batch)} calls failed ({e}), "
+                        f"retrying with {self.batch_size} calls per batch"
+                    )
+                    continue
+            results.extend(batch_results)
+            start += len(batch)
+        return results
+
+    def _next_batch_size(self) -> int:
+        batch_size = min(self.batch_size, self.max_batch_size)
+        if self.calldata_bytes_per_call > 0:
+            batch_size = min(
+                batch_size, self.max_calldata_bytes // self.calldata_bytes_per_call
+            )
+        if self.returndata_bytes_per_call > 0:
+            batch_size = min(
+                batch_size, self.max_returndata_bytes // self.returndata_bytes_per_call
+            )
+        return max(1, batch_size)
+
+    def _aggregate3(self, contract_functions: list, block_identifier) -> list:
+        calls = list()
+        for contract_function in contract_functions:
+            target, call_data = encode_call(contract_function)
+            calls.append((target, True, call_data))
+            self.calldata_bytes_per_call = max(
+                self.calldata_bytes_per_call,
+                CALL3_OVERHEAD_BYTES + _padded_length(call_data),
+            )
+
+        response = self.multicall_contract.functions.aggregate3(calls).call(
+            block_identifier=block_identifier
+        )
+
+        results = list()
+        for contract_function, (success, return_data) in zip(
+            contract_functions, response
+        ):
+            self.returndata_bytes_per_call = max(
+                self.returndata_bytes_per_call,
+                RESULT_OVERHEAD_BYTES + _padded_length(return_data),
+            )
+            if not success:
+                results.append((False, decode_revert_reason(self.w3, return_data)))
+                continue
+            try:
+                result = decode_call_result(self.w3, contract_function, return_data)
+                results.append((True, result))
+            except Exception as e:
+                results.append((False, f"could not decode result: {e}"))
+
+        # Successful batch: grow back towards the configured maximum
+        self.batch_size = min(self.max_batch_size, len(contract_functions) * 2)
+        return results
+
+
+def _padded_length(data: bytes) -> int:
+    return 32 * ((len(data) + 31) // 32)
@@ -0,0 +1,166 @@
+"""Functions for writing and reading DataFrames as typed Parquet files"""
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from eth_utils import to_checksum_address
+
+ADDRESS_COLUMNS = {
+    "underlyingAsset",
+    "user_address",
+    "active_user_address",
+    "aTokenAddress",
+    "variableDebtTokenAddress",
+    "interestRateStrategyAddress",
+}
+# Integer columns kept exact, whatever the size of their values
+UINT256_COLUMNS = {
+    "scaledATokenBalance",
+    "scaledVariableDebt",
+    "liquidityIndex",
+    "variableBorrowIndex",
+    "liquidityRate",
+    "variableBorrowRate",
+    "availableLiquidity",
+    "totalScaledVariableDebt",
+    "treasury_balance",
+    "collateral_bitmap",
+}
+
+# Field metadata telling readers how the fixed size binary columns are encoded
+ADDRESS_METADATA = {b"logical_type": b"address"}
+UINT256_METADATA = {b"logical_type": b"uint256", b"byte_order": b"big"}
+
+
+def _first_value(series: pd.Series):
+    values = series.dropna()
+    return None if len(values) == 0 else values.iloc[0]
+
+
+def arrow_field(name: str, series: pd.Series) -> pa.Field:
+    """
+    Arrow field of a column: addresses are 20 bytes binaries and uint256 are
+    32 bytes big-endian binaries, which sort like the numbers they encode.
+    uint256 does not fit decimal256, limited to 76 digits.
+    """
+    first_value = _first_value(series)
+    if name in ADDRESS_COLUMNS:
+        return pa.field(name, pa.binary(20), metadata=ADDRESS_METADATA)
+    if pd.api.types.is_bool_dtype(series):
+        return pa.field(name, pa.bool_())
+    if pd.api.types.is_float_dtype(series) or isinstance(first_value, float):
+        return pa.field(name, pa.float64())
+    if name in UINT256_COLUMNS or (
+        series.dtype == object and isinstance(first_value, int)
+    ):
+        return pa.field(name, pa.binary(32), metadata=UINT256_METADATA)
+    if pd.api.types.is_integer_dtype(series):
+        return pa.field(name, pa.int64())
+    return pa.field(name, pa.string())
+
+
+def arrow_schema(frame: pd.DataFrame) -> pa.Schema:
+    return pa.schema([arrow_field(name, frame[name]) for name in frame.columns])
+
+
+def _to_arrow_array(series: pd.Series, field: pa.Field) -> pa.Array:
+    if field.metadata == ADDRESS_METADATA:
+        values = [
+            None if pd.isna(value) else bytes.fromhex(value[2:]) for value in series
+        ]
+    elif field.metadata == UINT256_METADATA:
+        values = [
+            None if pd.isna(value) else int(value).to_bytes(32, "big")
+            for value in series
+        ]
+    elif pa.types.is_float64(field.type):
+        values = pd.to_numeric(series, errors="coerce").astype("float64")
+    else:
+        values = series
+    return pa.array(values, type=field.type, from_pandas=True)
+
+
+def frame_to_table(frame: pd.DataFrame, schema: pa.Schema = None) -> pa.Table:
+    if schema is None:
+        schema = arrow_schema(frame)
+    arrays = [_to_arrow_array(frame[field.name], field) for field in schema]
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def table_to_frame(table: pa.Table) -> pd.DataFrame:
+    """Inverse of frame_to_table, uint256 come back as Python ints."""
+    columns = dict()
+    for field, column in zip(table.schema, table.columns):
+        values = column.to_pylist()
+        if field.metadata == ADDRESS_METADATA:
+            columns[field.name] = [
+                None if value is None else to_checksum_address(value)
+                for value in values
+            ]
+        elif field.metadata == UINT256_METADATA:
+            columns[field.name] = pd.Series(
+                [
+                    None if value is None else int.from_bytes(value, "big")
+                    for value in values
+                ],
+                dtype=object,
+            )
+        else:
+            columns[field.name] = column.to_pandas()
+    return pd.DataFrame(columns)
+
+
+def write_parquet(
+    frame: pd.DataFrame, sink, row_group_size: int = 100_000, compression="zstd"
+):
+    """
+    Write `frame` to the file-like `sink` one row group at a time, so that only
+    one row group is converted to Arrow at once.
+    """
+    schema = arrow_schema(frame)
+    with pq.ParquetWriter(sink, schema, compression=compression) as writer:
+        for start in range(0, max(len(frame), 1), row_group_size):
+            chunk = frame.iloc[start : start + row_group_size]
+            writer.write_table(frame_to_table(chunk, schema))
+
+
+def read_parquet(source) -> pd.DataFrame:
+    return table_to_frame(pq.read_table(source))
+
+
+class ParquetChunkWriter:
+    """
+    DataFrames appended as row groups of one Parquet file written to `sink`.
+    The schema is the one of the first non-empty frame, an output without rows
+    is written with the schema of its last empty frame.
+    """
+
+    def __init__(self, sink, compression="zstd"):
+        self.sink = sink
+        self.compression = compression
+        self.schema = None
+        self.writer = None
+        self.empty_frame = pd.DataFrame()
+
+    def write(self, frame: pd.DataFrame):
+        if len(frame) == 0:
+            self.empty_frame = frame
+            return
+        if self.writer is None:
+            self.schema = arrow_schema(frame)
+            self.writer = pq.ParquetWriter(
+                self.sink, self.schema, compression=self.compression
+            )
+        self.writer.write_table(frame_to_table(frame, self.schema))
+
+    def close(self):
+        if self.writer is None:
+            write_parquet(self.empty_frame, self.sink, compression=self.compression)
+        else:
+            self.writer.close()
+
+
+def iter_parquet(source, batch_size: int = 100_000):
+    """DataFrames of at most `batch_size` rows of the Parquet file `source`."""
+    for batch in pq.ParquetFile(source).iter_batches(batch_size=batch_size):
+        yield table_to_frame(pa.Table.from_batches([batch]))
@@ -0,0 +1,181 @@
+"""Exact vectorized Aave WadRayMath on uint256 values split into limbs"""
+
+import numpy as np
+
+RAY = 10**27
+HALF_RAY = RAY // 2
+
+# Values are (N, n_limbs) uint64 arrays of little-endian 32 bits limbs, so
+# that the product of two limbs and the carries of a column fit in uint64.
+# Arrays are column-major, every limb is contiguous for the vectorized ops.
+LIMB_BITS = 32
+LIMB_MASK = np.uint64((1 << LIMB_BITS) - 1)
+UINT256_LIMBS = 256 // LIMB_BITS
+
+
+def to_limbs(values) -> np.ndarray:
+    """Split non-negative integers, numpy integers or Python ints, into limbs."""
+    if hasattr(values, "dtype"):
+        values = np.asarray(values)
+    else:
+        # numpy would turn a list mixing small and large ints into floats
+        values = np.array(values, dtype=object)
+    if values.dtype.kind in "iu":
+        return _split_groups(values.astype(np.uint64)[:, np.newaxis])
+    if values.dtype != object:
+        raise TypeError(f"Expected integer values, got {values.dtype}")
+
+    # Only the Python ints larger than 64 bits go through object ufuncs
+    small_rows = np.asarray(values < 1 << 64, dtype=bool)
+    if small_rows.all():
+        return _split_groups(values.astype(np.uint64)[:, np.newaxis])
+    large_values = values[~small_rows]
+    n_groups = -(-max(large_values.tolist()).bit_length() // 64)
+    groups = np.zeros((len(values), n_groups), dtype=np.uint64, order="F")
+    groups[small_rows, 0] = values[small_rows].astype(np.uint64)
+    for group in range(n_groups):
+        shifted = large_values >> (64 * group) if group > 0 else large_values
+        if group < n_groups - 1:
+            shifted = shifted & ((1 << 64) - 1)
+        groups[~small_rows, group] = shifted.astype(np.uint64)
+    return _trim(_split_groups(groups))
+
+
+def _split_groups(groups: np.ndarray) -> np.ndarray:
+    # Each 64 bits group gives two limbs
+    limbs = np.empty((len(groups), 2 * groups.shape[1]), dtype=np.uint64, order="F")
+    for group in range(groups.shape[1]):
+        limbs[:, 2 * group] = groups[:, group] & LIMB_MASK
+        limbs[:, 2 * group + 1] = groups[:, group] >> np.uint64(LIMB_BITS)
+    return limbs
+
+
+def take_rows(limbs: np.ndarray, rows: np.ndarray) -> np.ndarray:
+    result = np.empty((len(rows), limbs.shape[1]), dtype=np.uint64, order="F")
+    for limb in range(limbs.shape[1]):
+        result[:, limb] = limbs[:, limb][rows]
+    return result
+
+
+def _trim(limbs: np.ndarray) -> np.ndarray:
+    # Most significant limbs equal to zero on every row do not change the value
+    n_limbs = limbs.shape[1]
+    while n_limbs > 1 and not limbs[:, n_limbs - 1].any():
+        n_limbs -= 1
+    return limbs[:, :n_limbs]
+
+
+def _propagate_carries(limbs: np.ndarray) -> np.ndarray:
+    for limb in range(limbs.shape[1] - 1):
+        limbs[:, limb + 1] += limbs[:, limb] >> np.uint64(LIMB_BITS)
+        limbs[:, limb] &= LIMB_MASK
+    return limbs
+
+
+def add(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    n_limbs = max(a.shape[1], b.shape[1]) + 1
+    result = np.zeros((a.shape[0], n_limbs), dtype=np.uint64, order="F")
+    result[:, : a.shape[1]] += a
+    result[:, : b.shape[1]] += b
+    return _propagate_carries(result)
+
+
+def mul(a: np.ndarray, b: np.ndarray, addend: int = 0) -> np.ndarray:
+    """
+    Schoolbook product a * b + addend of uint256 values. A column receives at
+    most 17 terms below 2^32, so carries are propagated once at the end.
+    """
+    addend_limbs = to_limbs([addend])[0]
+    n_limbs = max(a.shape[1] + b.shape[1], len(addend_limbs) + 1)
+    result = np.zeros((a.shape[0], n_limbs), dtype=np.uint64, order="F")
+    result[:, : len(addend_limbs)] = addend_limbs
+    product = np.empty(a.shape[0], dtype=np.uint64)
+    low_half = np.empty(a.shape[0], dtype=np.uint64)
+    for i in range(a.shape[1]):
+        for j in range(b.shape[1]):
+            np.multiply(a[:, i], b[:, j], out=product)
+            np.bitwise_and(product, LIMB_MASK, out=low_half)
+            result[:, i + j] += low_half
+            np.right_shift(product, np.uint64(LIMB_BITS), out=product)
+            result[:, i + j + 1] += product
+    return _trim(_propagate_carries(result))
+
+
+def div_small(a: np.ndarray, divisor: int) -> np.ndarray:
+    """Floor division by a divisor smaller than 2^32, by long division."""
+    if not 0 < divisor < 1 << LIMB_BITS:
+        raise ValueError(f"Divisor must be a positive 32 bits integer: {divisor}")
+    divisor = np.uint64(divisor)
+    result = np.empty(a.shape, dtype=np.uint64, order="F")
+    remainder = np.zeros(a.shape[0], dtype=np.uint64)
+    for limb in range(a.shape[1] - 1, -1, -1):
+        current = (remainder << np.uint64(LIMB_BITS)) | a[:, limb]
+        result[:, limb] = current // divisor
+        remainder = current - result[:, limb] * divisor
+    return _trim(result)
+
+
+def ray_mul(a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    """WadRayMath.rayMul: (a * b + RAY / 2) / RAY, rounded half up."""
+    result = mul(a, b, addend=HALF_RAY)
+    # RAY = (10^9)^3 and 10^9 < 2^32
+    for _ in range(3):
+        result = div_small(result, 10**9)
+    return result
+
+
+def to_float(limbs: np.ndarray) -> np.ndarray:
+    result = np.zeros(limbs.shape[0], dtype=np.float64)
+    for limb in range(limbs.shape[1] - 1, -1, -1):
+        result = result * float(1 << LIMB_BITS) + limbs[:, limb]
+    return result
+
+
+def to_int(limbs: np.ndarray) -> list:
+    padded = np.zeros((limbs.shape[0], max(limbs.shape[1], UINT256_LIMBS)), dtype="<u4")
+    padded[:, : limbs.shape[1]] = limbs
+    return [int.from_bytes(row.tobytes(), "little") for row in padded]
+
+
+def current_balances(
+    scaled_balances,
+    reserve_positions: np.ndarray,
+    reserves_indices: list,
+    reserves_decimals: list,
+) -> np.ndarray:
+    """
+    Balances in token units of scaled balances, rayMul(scaled, index) / 10^decimals,
+    where row i uses the index and decimals of the reserve at position
+    `reserve_positions[i]`. Rows of unknown reserves, at position -1, are NaN.
+    """
+    return current_balances_from_limbs(
+        to_limbs(scaled_balances),
+        reserve_positions,
+        reserves_indices,
+        reserves_decimals,
+    )
+
+
+def current_balances_from_limbs(
+    scaled_limbs: np.ndarray,
+    reserve_positions: np.ndarray,
+    reserves_indices: list,
+    reserves_decimals: list,
+) -> np.ndarray:
+    """current_balances of scaled balances already split into limbs."""
+    reserve_positions = np.asarray(reserve_positions)
+    known_reserves = reserve_positions >= 0
+    # Zero balances, most debts, and unknown reserves skip the computation
+    computed_rows = np.flatnonzero(
+        known_reserves & np.logical_or.reduce(scaled_limbs, axis=1)
+    )
+    indices_limbs = take_rows(
+        to_limbs(reserves_indices), reserve_positions[computed_rows]
+    )
+    balances = np.zeros(len(reserve_positions), dtype=np.float64)
+    balances[computed_rows] = to_float(
+        ray_mul(take_rows(scaled_limbs, computed_rows), indices_limbs)
+    )
+    units = 10.0 ** -np.asarray(reserves_decimals, dtype=np.float64)
+    balances *= np.where(known_reserves, units[reserve_positions], np.nan)
+    return balances
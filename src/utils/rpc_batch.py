@@ -0,0 +1,110 @@
+"""Class for sending contract calls as JSON-RPC batch payloads"""
+
+import concurrent.futures
+import contextvars
+
+from web3.datastructures import NamedElementOnion
+
+from src.utils.contract_calls import decode_call_result, encode_call
+
+# The default validation middleware requests eth_chainId for every batched
+# eth_call, the batch payloads are already built from the contract functions
+BATCH_SKIPPED_MIDDLEWARES = {"validation"}
+
+
+class JsonRpcBatchTransport:
+    def __init__(self, w3, batch_size: int = 100, max_in_flight: int = 4):
+        self.w3 = w3
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+
+    def call(self, contract_functions: list, block_identifier="latest") -> list:
+        """
+        Execute the contract functions as eth_call requests grouped into batch
+        payloads of `batch_size`, with at most `max_in_flight` payloads sent at
+        the same time. Returns one (success, result) tuple per function, in order.
+        """
+        batches = [
+            contract_functions[start : start + self.batch_size]
+            for start in range(0, len(contract_functions), self.batch_size)
+        ]
+        if len(batches) <= 1 or self.max_in_flight <= 1:
+            batches_results = [
+                self._send_batch(batch, block_identifier) for batch in batches
+            ]
+        else:
+            with concurrent.futures.ThreadPoolExecutor(
+                max_workers=self.max_in_flight
+            ) as executor:
+                # Batches are sent in copies of the caller context, which
+                # keeps its run metrics stage
+                batches_results = list(
+                    executor.map(
+                        lambda context, batch: context.run(
+                            self._send_batch, batch, block_identifier
+                        ),
+                        [contextvars.copy_context() for _ in batches],
+                        batches,
+                    )
+                )
+        return [result for batch_results in batches_results for result in batch_results]
+
+    def _send_batch(self, contract_functions: list, block_identifier) -> list:
+        block_param = (
+            hex(block_identifier)
+            if isinstance(block_identifier, int)
+            else block_identifier
+        )
+        requests = list()
+        for contract_function in contract_functions:
+            target, call_data = encode_call(contract_function)
+            requests.append(
+                (
+                    "eth_call",
+                    [{"to": target, "data": call_data.to_0x_hex()}, block_param],
+                )
+            )
+
+        make_batch_request = self.w3.provider.batch_request_func(
+            self.w3, self._batch_middleware_onion()
+        )
+        try:
+            responses = make_batch_request(requests)
+        except Exception as e:
+            return [(False, str(e))] * len(contract_functions)
+        if not isinstance(responses, list):
+            # The provider rejected the whole payload with a single error object
+            error = responses.get("error", responses)
+            return [(False, str(error))] * len(contract_functions)
+        if len(responses) != len(contract_functions):
+            error = f"got {len(responses)} responses for {len(requests)} requests"
+            return [(False, error)] * len(contract_functions)
+
+        results = list()
+        for contract_function, response in zip(contract_functions, responses):
+            if "error" in response:
+                results.append((False, str(response["error"])))
+                continue
+            try:
+                result = decode_call_result(
+                    self.w3, contract_function, response["result"]
+                )
+                results.append((True, result))
+            except Exception as e:
+                results.append((False, f"could not decode result: {e}"))
+        return results
+
+    def _batch_middleware_onion(self) -> NamedElementOnion:
+        skipped = [
+            self.w3.middleware_onion.get(name)
+            for name in BATCH_SKIPPED_MIDDLEWARES
+            if name in self.w3.middleware_onion.keys()
+        ]
+        # Same order as the Web3 middlewares, outermost first
+        return NamedElementOnion(
+            [
+                middleware
+                for middleware in self.w3.middleware_onion.as_tuple_of_middleware()
+                if middleware not in skipped
+            ]
+        )
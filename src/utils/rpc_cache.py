@@ -0,0 +1,295 @@
+"""Persistent cache of block-pinned JSON-RPC responses, as web3 middleware"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from toolz import curry
+from web3.middleware.base import Web3MiddlewareBuilder
+
+DEFAULT_RPC_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "aavev3-raw-balances-collector", "rpc.sqlite"
+)
+
+# Methods whose response only depends on their params once pinned to a block
+BLOCK_PINNED_METHODS = {
+    "eth_call": lambda params: params[1:2],
+    "eth_getBlockByNumber": lambda params: params[0:1],
+    "eth_getLogs": lambda params: [
+        params[0].get("fromBlock"),
+        params[0].get("toBlock"),
+    ],
+}
+
+
+# Blocks closer than this to the latest known head may still be reorganized
+FINALITY_MARGIN = 64
+
+
+def is_pinned_block(block_identifier) -> bool:
+    # "latest", "pending", "safe", ... and missing blocks are never cached
+    return isinstance(block_identifier, str) and block_identifier.startswith("0x")
+
+
+def is_final(method: str, params, head_block: int, finality_margin: int) -> bool:
+    """Whether the pinned blocks of a cacheable request are all final."""
+    if head_block is None:
+        return False
+    return all(
+        int(block, 16) <= head_block - finality_margin
+        for block in BLOCK_PINNED_METHODS[method](params)
+    )
+
+
+def cache_key(chain_id: int, method: str, params) -> str:
+    if method not in BLOCK_PINNED_METHODS:
+        return None
+    try:
+        blocks = BLOCK_PINNED_METHODS[method](params)
+    except (AttributeError, IndexError, TypeError):
+        return None
+    if len(blocks) == 0 or not all(is_pinned_block(block) for block in blocks):
+        return None
+    payload = json.dumps([chain_id, method, params], sort_keys=True, default=str)
+    return hashlib.sha256(payload.lower().encode()).hexdigest()
+
+
+class RpcResponseCache:
+    def __init__(
+        self,
+        path: str = DEFAULT_RPC_CACHE_PATH,
+        max_size_bytes: int = 2 * 1024**3,
+        finality_margin: int = FINALITY_MARGIN,
+    ):
+        self.path = path
+        self.max_size_bytes = max_size_bytes
+        self.finality_margin = finality_margin
+        self.chain_id = None
+        # Latest block number seen from the provider, only the responses of the
+        # blocks `finality_margin` below it are stored
+        self.head_block = None
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._connection = sqlite3.connect(
+            path, check_same_thread=False, isolation_level=None
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, result TEXT NOT NULL, "
+            "size INTEGER NOT NULL, accessed_at REAL NOT NULL)"
+        )
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS responses_accessed_at "
+            "ON responses (accessed_at)"
+        )
+        self.size_bytes = self._connection.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key: str):
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT result FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._connection.execute(
+                "UPDATE responses SET accessed_at = ? WHERE key = ?",
+                (time.time(), key),
+            )
+        return json.loads(row[0])
+
+    def put(self, key: str, result):
+        serialized_result = json.dumps(result)
+        size = len(key) + len(serialized_result)
+        with self._lock:
+            previous = self._connection.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, serialized_result, size, time.time()),
+            )
+            self.size_bytes += size - (previous[0] if previous else 0)
+            if self.size_bytes > self.max_size_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Least recently used entries go first, down to 90% of the maximum size
+        target_size = 0.9 * self.max_size_bytes
+        while self.size_bytes > target_size:
+            rows = self._connection.execute(
+                "SELECT key, size FROM responses ORDER BY accessed_at LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                self.size_bytes = 0
+                break
+            evicted_keys = list()
+            for key, size in rows:
+                evicted_keys.append((key,))
+                self.size_bytes -= size
+                if self.size_bytes <= target_size:
+                    break
+            self._connection.executemany(
+                "DELETE FROM responses WHERE key = ?", evicted_keys
+            )
+
+    def close(self):
+        self._connection.close()
+
+
+class RpcCacheMiddlewareBuilder(Web3MiddlewareBuilder):
+    cache: RpcResponseCache = None
+
+    @staticmethod
+    @curry
+    def build(cache: RpcResponseCache, w3) -> "RpcCacheMiddlewareBuilder":
+        middleware = RpcCacheMiddlewareBuilder(w3)
+        middleware.cache = cache
+        return middleware
+
+    def _get_chain_id(self, make_request) -> int:
+        if self.cache.chain_id is None:
+            self.cache.chain_id = int(make_request("eth_chainId", [])["result"], 16)
+        return self.cache.chain_id
+
+    def _chain_id_response(self) -> dict:
+        # web3 validates the chain id before every eth_call, it is answered
+        # from memory once known
+        return {"jsonrpc": "2.0", "id": 0, "result": hex(self.cache.chain_id)}
+
+    def _observe_head(self, response):
+        if isinstance(response, dict) and response.get("result") is not None:
+            self.cache.head_block = max(
+                self.cache.head_block or 0, int(response["result"], 16)
+            )
+
+    def _get_head_block(self, make_request) -> int:
+        if self.cache.head_block is None:
+            self._observe_head(make_request("eth_blockNumber", []))
+        return self.cache.head_block
+
+    def _store(self, key: str, method: str, params, response: dict, head_block: int):
+        # A block near the head may be reorganized, its responses are not kept
+        if (
+            key is not None
+            and response.get("result") is not None
+            and is_final(method, params, head_block, self.cache.finality_margin)
+        ):
+            self.cache.put(key, response["result"])
+
+    def wrap_make_request(self, make_request):
+        def middleware(method, params):
+            if method == "eth_chainId":
+                self._get_chain_id(make_request)
+                return self._chain_id_response()
+            if method == "eth_blockNumber":
+                response = make_request(method, params)
+                self._observe_head(response)
+                return response
+            if method not in BLOCK_PINNED_METHODS:
+                return make_request(method, params)
+            key = cache_key(self._get_chain_id(make_request), method, params)
+            if key is None:
+                return make_request(method, params)
+            result = self.cache.get(key)
+            if result is not None:
+                return {"jsonrpc": "2.0", "id": 0, "result": result}
+            response = make_request(method, params)
+            self._store(
+                key, method, params, response, self._get_head_block(make_request)
+            )
+            return response
+
+        return middleware
+
+    def wrap_make_batch_request(self, make_batch_request):
+        def middleware(requests_info):
+            chain_id = None
+            responses = [None] * len(requests_info)
+            keys = [None] * len(requests_info)
+
+            def make_request(method, params):
+                return make_batch_request([(method, params)])[0]
+
+            for index, (method, params) in enumerate(requests_info):
+                if method not in BLOCK_PINNED_METHODS:
+                    continue
+                if chain_id is None:
+                    chain_id = self._get_chain_id(make_request)
+                keys[index] = cache_key(chain_id, method, params)
+                if keys[index] is not None:
+                    result = self.cache.get(keys[index])
+                    if result is not None:
+                        responses[index] = {
+                            "jsonrpc": "2.0",
+                            "id": index,
+                            "result": result,
+                        }
+
+            missing = [
+                index for index, response in enumerate(responses) if response is None
+            ]
+            if not missing:
+                return responses
+            missing_responses = make_batch_request(
+                [requests_info[index] for index in missing]
+            )
+            if not isinstance(missing_responses, list):
+                return missing_responses
+            head_block = (
+                self._get_head_block(make_request)
+                if any(keys[index] is not None for index in missing)
+                else None
+            )
+            for index, response in zip(missing, missing_responses):
+                responses[index] = response
+                self._store(keys[index], *requests_info[index], response, head_block)
+            return responses
+
+        return middleware
+
+    async def async_wrap_make_request(self, make_request):
+        async def middleware(method, params):
+            if method == "eth_blockNumber":
+                response = await make_request(method, params)
+                self._observe_head(response)
+                return response
+            if method != "eth_chainId" and method not in BLOCK_PINNED_METHODS:
+                return await make_request(method, params)
+            if self.cache.chain_id is None:
+                response = await make_request("eth_chainId", [])
+                self.cache.chain_id = int(response["result"], 16)
+            if method == "eth_chainId":
+                return self._chain_id_response()
+            key = cache_key(self.cache.chain_id, method, params)
+            if key is None:
+                return await make_request(method, params)
+            result = self.cache.get(key)
+            if result is not None:
+                return {"jsonrpc": "2.0", "id": 0, "result": result}
+            response = await make_request(method, params)
+            if self.cache.head_block is None:
+                self._observe_head(await make_request("eth_blockNumber", []))
+            self._store(key, method, params, response, self.cache.head_block)
+            return response
+
+        return middleware
+
+
+def install_rpc_cache(w3, cache: RpcResponseCache):
+    # Innermost layer, so that raw provider responses are cached
+    w3.middleware_onion.inject(
+        RpcCacheMiddlewareBuilder.build(cache), name="rpc_cache", layer=0
+    )
+    return w3
@@ -0,0 +1,206 @@
+"""Adaptive limit of in-flight JSON-RPC requests as web3 middleware, retries and
+re-drive of failed items"""
+
+import collections
+import concurrent.futures
+import contextvars
+import random
+import threading
+import time
+
+import requests
+
+from toolz import curry
+from web3.middleware.base import Web3MiddlewareBuilder
+
+from src.utils.logs import logger
+
+# JSON-RPC error codes and HTTP statuses of a provider asking to slow down
+THROTTLING_ERROR_CODES = {-32005, -32029, 429}
+RETRYABLE_HTTP_STATUSES = {429, 500, 502, 503, 504}
+
+
+def is_throttling_response(response) -> bool:
+    if not isinstance(response, dict) or not isinstance(response.get("error"), dict):
+        return False
+    error = response["error"]
+    message = str(error.get("message", "")).lower()
+    return (
+        error.get("code") in THROTTLING_ERROR_CODES
+        or "rate limit" in message
+        or "too many requests" in message
+    )
+
+
+def is_retryable_exception(exception: Exception) -> bool:
+    if isinstance(exception, requests.exceptions.HTTPError):
+        response = exception.response
+        return response is not None and response.status_code in RETRYABLE_HTTP_STATUSES
+    return isinstance(
+        exception,
+        (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.Timeout,
+            TimeoutError,
+        ),
+    )
+
+
+def jittered_backoff(attempt: int, base_delay: float, max_delay: float) -> float:
+    # Full jitter: spreads the retries of the threads throttled together
+    return random.uniform(0, min(max_delay, base_delay * 2**attempt))
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    AIMD limit of in-flight requests: the limit grows by one request per window
+    of `limit` healthy responses, and is multiplied by `decrease_factor` on a
+    throttling response, an error, or a latency above `latency_threshold`.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int,
+        min_in_flight: int = 1,
+        initial_in_flight: int = None,
+        latency_threshold: float = 2.0,
+        decrease_factor: float = 0.5,
+    ):
+        self.max_in_flight = max_in_flight
+        self.min_in_flight = min_in_flight
+        self.limit = float(initial_in_flight or min(max_in_flight, 4))
+        self.latency_threshold = latency_threshold
+        self.decrease_factor = decrease_factor
+        self.in_flight = 0
+        self.throttled = 0
+        self.retries = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, sent_at: float, healthy: bool):
+        now = time.monotonic()
+        with self._condition:
+            self.in_flight -= 1
+            if healthy and now - sent_at <= self.latency_threshold:
+                self.limit = min(self.max_in_flight, self.limit + 1 / self.limit)
+            elif sent_at > self._last_decrease:
+                # Requests sent before the last decrease were sent at the
+                # previous limit, one decrease accounts for all of them
+                self._last_decrease = now
+                self.limit = max(self.min_in_flight, self.limit * self.decrease_factor)
+            self._condition.notify_all()
+
+
+class AdaptiveRpcMiddlewareBuilder(Web3MiddlewareBuilder):
+    limiter: AdaptiveConcurrencyLimiter = None
+    max_retries: int = 6
+    base_delay: float = 0.25
+    max_delay: float = 30.0
+
+    @staticmethod
+    @curry
+    def build(
+        limiter: AdaptiveConcurrencyLimiter,
+        w3,
+        max_retries: int = 6,
+        base_delay: float = 0.25,
+        max_delay: float = 30.0,
+    ) -> "AdaptiveRpcMiddlewareBuilder":
+        middleware = AdaptiveRpcMiddlewareBuilder(w3)
+        middleware.limiter = limiter
+        middleware.max_retries = max_retries
+        middleware.base_delay = base_delay
+        middleware.max_delay = max_delay
+        return middleware
+
+    def _send(self, send, request):
+        for attempt in range(self.max_retries + 1):
+            self.limiter.acquire()
+            start = time.monotonic()
+            try:
+                response = send(request)
+            except Exception as e:
+                self.limiter.release(start, healthy=False)
+                if not is_retryable_exception(e) or attempt == self.max_retries:
+                    raise
+            else:
+                responses = response if isinstance(response, list) else [response]
+                throttled = any(map(is_throttling_response, responses))
+                self.limiter.release(start, healthy=not throttled)
+                if not throttled or attempt == self.max_retries:
+                    return response
+                self.limiter.throttled += 1
+            self.limiter.retries += 1
+            time.sleep(jittered_backoff(attempt, self.base_delay, self.max_delay))
+
+    def wrap_make_request(self, make_request):
+        def middleware(method, params):
+            return self._send(lambda request: make_request(*request), (method, params))
+
+        return middleware
+
+    def wrap_make_batch_request(self, make_batch_request):
+        def middleware(requests_info):
+            # A batch payload is a single HTTP request and takes a single slot
+            return self._send(make_batch_request, requests_info)
+
+        return middleware
+
+
+def install_adaptive_rpc_concurrency(w3, max_in_flight: int, **retry_options):
+    """
+    Gate the requests sent through `w3` with an AIMD concurrency limit, and
+    retry the throttled and failed ones with jittered exponential backoff.
+    Installed after the RPC cache, it sits closer to the provider and cached
+    responses do not take a slot.
+    """
+    limiter = AdaptiveConcurrencyLimiter(max_in_flight)
+    w3.middleware_onion.inject(
+        AdaptiveRpcMiddlewareBuilder.build(limiter, **retry_options),
+        name="adaptive_rpc_concurrency",
+        layer=0,
+    )
+    return limiter
+
+
+def redrive(failed_items: list, collect, max_rounds: int = 3, base_delay: float = 5.0):
+    """
+    Re-drive queue processed at the end of a run: call `collect(items)`, which
+    returns the items failing again, on the failed items until none is left or
+    after `max_rounds` rounds spaced by jittered backoff. Return the items
+    still failing.
+    """
+    for redrive_round in range(max_rounds):
+        if not failed_items:
+            break
+        logger.warning(
+            f"   --> Re-driving {len(failed_items)} failed items ({redrive_round + 1})"
+        )
+        time.sleep(jittered_backoff(redrive_round + 1, base_delay, 60.0))
+        failed_items = collect(failed_items)
+    return failed_items
+
+
+def fan_out(func, items, max_workers: int):
+    """
+    Yield `func(item)` for every item, in the order of `items`, called from
+    `max_workers` threads. At most twice `max_workers` calls are pending, so
+    long items lists are not all submitted at once. With an adaptive RPC limit
+    on w3, `max_workers` set to its maximum leaves the limit as the only bound
+    of the requests in flight. Calls run in a copy of the caller context, so
+    they keep its run metrics stage.
+    """
+    with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+        pending = collections.deque()
+        for item in items:
+            if len(pending) >= 2 * max_workers:
+                yield pending.popleft().result()
+            pending.append(executor.submit(contextvars.copy_context().run, func, item))
+        while pending:
+            yield pending.popleft().result()
@@ -0,0 +1,248 @@
+"""JSON-RPC provider routing requests over several endpoints, with hedging"""
+
+import collections
+import concurrent.futures
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+from web3._utils.batching import sort_batch_response_by_response_ids
+from web3.providers.base import JSONBaseProvider
+
+from src.utils.rpc_limits import is_retryable_exception, is_throttling_response
+
+# Writes are sent once, to one endpoint
+NOT_HEDGED_METHODS = {"eth_sendRawTransaction", "eth_sendTransaction"}
+
+
+class RpcEndpoint:
+    """
+    One provider URL, with its keep-alive connection pool and its observed
+    health: moving averages of latency and error rate, and recent latencies
+    for the hedging delay. After `max_failures` failures in a row it is left
+    out for a cooldown doubling at each new failure.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        pool_size: int = 32,
+        initial_latency: float = 0.2,
+        smoothing: float = 0.1,
+        max_failures: int = 3,
+        cooldown: float = 1.0,
+        max_cooldown: float = 60.0,
+    ):
+        self.url = url
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.latency = initial_latency
+        self.error_rate = 0.0
+        self.smoothing = smoothing
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.consecutive_failures = 0
+        self.unavailable_until = 0.0
+        self.requests = 0
+        self.errors = 0
+        self.hedges = 0
+        self._latencies = collections.deque(maxlen=256)
+        self._tail_latency = None
+        self._lock = threading.Lock()
+
+    def post(self, data: bytes, headers: dict, timeout: float) -> bytes:
+        response = self.session.post(
+            self.url, data=data, headers=headers, timeout=timeout
+        )
+        response.raise_for_status()
+        return response.content
+
+    def available(self, now: float) -> bool:
+        return now >= self.unavailable_until
+
+    def weight(self) -> float:
+        # Faster endpoints get more requests, failing ones quickly fewer
+        return (1 - self.error_rate) ** 2 / max(self.latency, 1e-3)
+
+    def tail_latency(self, quantile: float) -> float:
+        """Latency `quantile` of the recent requests, recomputed every 32 ones."""
+        with self._lock:
+            if self._tail_latency is None or self.requests % 32 == 0:
+                if len(self._latencies) < 16:
+                    return None
+                latencies = sorted(self._latencies)
+                self._tail_latency = latencies[int(quantile * (len(latencies) - 1))]
+            return self._tail_latency
+
+    def record(self, latency: float, healthy: bool):
+        with self._lock:
+            self.requests += 1
+            self.error_rate += self.smoothing * ((not healthy) - self.error_rate)
+            if healthy:
+                self.latency += self.smoothing * (latency - self.latency)
+                self._latencies.append(latency)
+                self.consecutive_failures = 0
+                return
+            self.errors += 1
+            self.consecutive_failures += 1
+            if self.consecutive_failures >= self.max_failures:
+                cooldown = self.cooldown * 2 ** (
+                    self.consecutive_failures - self.max_failures
+                )
+                self.unavailable_until = time.monotonic() + min(
+                    cooldown, self.max_cooldown
+                )
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "hedges": self.hedges,
+            "latency": round(self.latency, 4),
+            "error_rate": round(self.error_rate, 4),
+        }
+
+
+class RoutedHTTPProvider(JSONBaseProvider):
+    """
+    HTTP provider spreading requests over `endpoint_urls`, a drop-in provider
+    for Web3(...) and the middlewares of the ETL.
+
+    Each request goes to an endpoint drawn with a weight favoring low latency
+    and low error rate. A request failing with a connection error, a timeout,
+    a retryable HTTP status or a throttling response is sent again to another
+    endpoint, until every endpoint was tried. A read still pending after the
+    `hedge_quantile` latency of its endpoint is duplicated to another endpoint,
+    and the first response is used.
+    """
+
+    def __init__(
+        self,
+        endpoint_urls: list,
+        pool_size: int = 32,
+        request_timeout: float = 30.0,
+        hedge_quantile: float = 0.95,
+        min_hedge_delay: float = 0.05,
+        **endpoint_options,
+    ):
+        super().__init__()
+        if not endpoint_urls:
+            raise ValueError("At least one endpoint URL is required")
+        self.endpoints = [
+            RpcEndpoint(url, pool_size=pool_size, **endpoint_options)
+            for url in endpoint_urls
+        ]
+        self.request_timeout = request_timeout
+        self.hedge_quantile = hedge_quantile
+        self.min_hedge_delay = min_hedge_delay
+        self.headers = {"Content-Type": "application/json"}
+        self._random = random.Random()
+        # Hedged requests run in these threads, the caller waits for the first
+        self._executor = (
+            concurrent.futures.ThreadPoolExecutor(
+                max_workers=2 * pool_size * len(self.endpoints),
+                thread_name_prefix="rpc-router",
+            )
+            if len(self.endpoints) > 1 and hedge_quantile is not None
+            else None
+        )
+
+    def __str__(self) -> str:
+        return f"Routed RPC connection {[endpoint.url for endpoint in self.endpoints]}"
+
+    def endpoint_stats(self) -> dict:
+        return {endpoint.url: endpoint.stats() for endpoint in self.endpoints}
+
+    def _choose(self, excluded: list) -> RpcEndpoint:
+        now = time.monotonic()
+        candidates = [
+            endpoint for endpoint in self.endpoints if endpoint not in excluded
+        ]
+        available = [endpoint for endpoint in candidates if endpoint.available(now)]
+        if not available:
+            # All endpoints cooling down: the one available first is tried
+            return min(candidates, key=lambda endpoint: endpoint.unavailable_until)
+        return self._random.choices(
+            available, weights=[endpoint.weight() for endpoint in available]
+        )[0]
+
+    def _send(self, endpoint: RpcEndpoint, request_data: bytes):
+        """(response, exception) of the request sent to `endpoint`."""
+        start = time.monotonic()
+        try:
+            response = self.decode_rpc_response(
+                endpoint.post(request_data, self.headers, self.request_timeout)
+            )
+        except Exception as e:
+            endpoint.record(time.monotonic() - start, healthy=False)
+            return None, e
+        responses = response if isinstance(response, list) else [response]
+        throttled = any(map(is_throttling_response, responses))
+        endpoint.record(time.monotonic() - start, healthy=not throttled)
+        return response, None
+
+    def _send_hedged(self, endpoint: RpcEndpoint, request_data: bytes, tried: list):
+        hedge_delay = endpoint.tail_latency(self.hedge_quantile)
+        if hedge_delay is None or len(tried) == len(self.endpoints):
+            return self._send(endpoint, request_data)
+        futures = {self._executor.submit(self._send, endpoint, request_data)}
+        done, pending = concurrent.futures.wait(
+            futures, timeout=max(hedge_delay, self.min_hedge_delay)
+        )
+        if not done:
+            hedge_endpoint = self._choose(tried)
+            if hedge_endpoint.available(time.monotonic()):
+                tried.append(hedge_endpoint)
+                hedge_endpoint.hedges += 1
+                futures.add(
+                    self._executor.submit(self._send, hedge_endpoint, request_data)
+                )
+        # The first usable response wins, the other request completes unused
+        result = (None, None)
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            if _usable(*result):
+                return result
+        return result
+
+    def _route(self, method: str, request_data: bytes):
+        tried = list()
+        response, exception = None, None
+        while len(tried) < len(self.endpoints):
+            endpoint = self._choose(tried)
+            tried.append(endpoint)
+            if self._executor is not None and method not in NOT_HEDGED_METHODS:
+                response, exception = self._send_hedged(endpoint, request_data, tried)
+            else:
+                response, exception = self._send(endpoint, request_data)
+            if _usable(response, exception):
+                return response
+            if exception is not None and not is_retryable_exception(exception):
+                raise exception
+        # Every endpoint failed: the last throttling response or error is left
+        # to the retry middlewares
+        if exception is not None:
+            raise exception
+        return response
+
+    def make_request(self, method, params):
+        return self._route(method, self.encode_rpc_request(method, params))
+
+    def make_batch_request(self, batch_requests: list):
+        response = self._route("batch", self.encode_batch_rpc_request(batch_requests))
+        if not isinstance(response, list):
+            # RPC errors return only one response with the error object
+            return response
+        return sort_batch_response_by_response_ids(response)
+
+
+def _usable(response, exception) -> bool:
+    if exception is not None:
+        return False
+    responses = response if isinstance(response, list) else [response]
+    return not any(map(is_throttling_response, responses))
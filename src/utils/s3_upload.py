@@ -0,0 +1,90 @@
+"""File-like writer streaming its content to S3 as a multipart upload"""
+
+import io
+
+# S3 rejects parts smaller than 5 MiB, except for the last one
+MIN_PART_SIZE = 5 * 1024**2
+
+
+class S3MultipartWriter(io.RawIOBase):
+    """
+    Buffer written bytes and upload them as `part_size` parts, so that at most
+    one part is held in memory. Content smaller than one part is sent with a
+    single put_object on close. The upload is aborted if the writer is closed
+    by an exception inside a `with` block.
+    """
+
+    def __init__(self, client_s3, bucket: str, key: str, part_size: int = 16 * 1024**2):
+        super().__init__()
+        self.client_s3 = client_s3
+        self.bucket = bucket
+        self.key = key
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.upload_id = None
+        self.parts = list()
+        self.position = 0
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def write(self, data) -> int:
+        if isinstance(data, str):
+            data = data.encode()
+        self._buffer.extend(data)
+        self.position += len(data)
+        while len(self._buffer) >= self.part_size:
+            self._upload_part(bytes(self._buffer[: self.part_size]))
+            del self._buffer[: self.part_size]
+        return len(data)
+
+    def _upload_part(self, body: bytes):
+        if self.upload_id is None:
+            self.upload_id = self.client_s3.create_multipart_upload(
+                Bucket=self.bucket, Key=self.key
+            )["UploadId"]
+        part_number = len(self.parts) + 1
+        response = self.client_s3.upload_part(
+            Body=body,
+            Bucket=self.bucket,
+            Key=self.key,
+            PartNumber=part_number,
+            UploadId=self.upload_id,
+        )
+        self.parts.append({"ETag": response["ETag"], "PartNumber": part_number})
+
+    def close(self):
+        if self.closed:
+            return
+        if self.upload_id is None:
+            self.client_s3.put_object(
+                Body=bytes(self._buffer), Bucket=self.bucket, Key=self.key
+            )
+        else:
+            if self._buffer:
+                self._upload_part(bytes(self._buffer))
+            self.client_s3.complete_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.key,
+                UploadId=self.upload_id,
+                MultipartUpload={"Parts": self.parts},
+            )
+        self._buffer = bytearray()
+        super().close()
+
+    def abort(self):
+        if self.upload_id is not None:
+            self.client_s3.abort_multipart_upload(
+                Bucket=self.bucket, Key=self.key, UploadId=self.upload_id
+            )
+        self._buffer = bytearray()
+        super().close()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.abort()
+        else:
+            self.close()